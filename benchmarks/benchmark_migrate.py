@@ -0,0 +1,219 @@
+"""
+benchmark_migrate
+=================
+
+Benchmark the migration stages on synthetic v0.7.0.dev0 documents of increasing size.
+
+Each measurement runs in a fresh process so that the reported peak RSS belongs to that stage alone. Results are
+written as JSON and may be compared against a previous run to catch regressions:
+
+.. code-block:: bash
+
+    ~$ python benchmarks/benchmark_migrate.py --scales 1 2 4 8 --output results.json
+    ~$ python benchmarks/benchmark_migrate.py --scales 1 2 4 8 --baseline results.json --tolerance 0.25
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+STAGES = ['get_source_version', 'migrate_by_stylesheet', 'migrate_mesh', 'do_migration', 'cli']
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _run_stage(stage, infile, outfile):
+    """Run one stage; executed in a fresh process"""
+    from lxml import etree
+    from sfftk_migrate import VERSION_LIST
+    from sfftk_migrate.core import get_module, get_source_version, get_stylesheet
+    from sfftk_migrate.migrate import do_migration, migrate_by_stylesheet
+    stylesheet = get_stylesheet(VERSION_LIST[0], VERSION_LIST[1])
+    baseline_rss = _peak_rss()
+    if stage == 'get_source_version':
+        start = time.perf_counter()
+        get_source_version(infile)
+    elif stage == 'migrate_by_stylesheet':
+        start = time.perf_counter()
+        migrate_by_stylesheet(infile, stylesheet)
+    elif stage == 'migrate_mesh':
+        module = get_module(VERSION_LIST[0], VERSION_LIST[1])
+        meshes = etree.parse(infile).xpath('/segmentation/segmentList/segment/meshList/mesh')
+        start = time.perf_counter()
+        for mesh in meshes:
+            module.migrate_mesh(mesh)
+    elif stage == 'do_migration':
+        start = time.perf_counter()
+        do_migration(argparse.Namespace(infile=infile, outfile=outfile, target_version=VERSION_LIST[-1],
+                                        verbose=False))
+    elif stage == 'cli':
+        # includes interpreter startup and imports
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPOSITORY] + sys.path[1:]))
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-m', 'sfftk_migrate.main', infile, '-o', outfile], env=env)
+    else:
+        raise ValueError("unknown stage: {}".format(stage))
+    seconds = time.perf_counter() - start
+    if stage == 'cli':
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    else:
+        peak_rss = _peak_rss()
+    return dict(seconds=seconds, peak_rss=peak_rss, baseline_rss=baseline_rss)
+
+
+def measure(stage, infile, outfile, repeat=3):
+    """Measure `stage` `repeat` times, each in a fresh process, and keep the fastest run"""
+    context = multiprocessing.get_context('spawn')
+    runs = list()
+    for _ in range(repeat):
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(_run_stage, (stage, infile, outfile)))
+    return min(runs, key=lambda run: run['seconds'])
+
+
+def scaling_exponent(sizes, seconds):
+    """Least-squares slope of log(seconds) against log(size); 1.0 means linear scaling"""
+    points = [(math.log(size), math.log(second)) for size, second in zip(sizes, seconds) if size > 0 and second > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    denominator = sum((x - mean_x) ** 2 for x, _ in points)
+    if denominator == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator
+
+
+def run(scales, segments=10, vertices=1000, normals=True, shapes=4, transforms=4, lattice_size=100000, repeat=3,
+        stages=STAGES):
+    """Run the benchmark suite
+
+    Every size parameter is multiplied by each of `scales` in turn.
+
+    :return: the results as a JSON-serialisable dictionary
+    :rtype: dict
+    """
+    import lxml
+    from sfftk_migrate import SFFTK_MIGRATIONS_VERSION
+    from sfftk_migrate.synthetic import generate
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    tmpdir = tempfile.mkdtemp()
+    results = list()
+    try:
+        for scale in scales:
+            infile = os.path.join(tmpdir, 'synthetic_{}.sff'.format(scale))
+            outfile = os.path.join(tmpdir, 'synthetic_{}_out.sff'.format(scale))
+            params = generate(infile, segments=int(segments * scale), vertices=vertices, normals=normals,
+                              shapes=shapes, transforms=transforms, lattice_size=int(lattice_size * scale))
+            file_size = os.path.getsize(infile)
+            result = dict(scale=scale, params=params, file_size=file_size, stages=dict())
+            for stage in stages:
+                measurement = measure(stage, infile, outfile, repeat=repeat)
+                measurement['throughput_mb_s'] = file_size / 2 ** 20 / measurement['seconds']
+                if params['num_vertices']:
+                    measurement['vertices_per_s'] = params['num_vertices'] / measurement['seconds']
+                result['stages'][stage] = measurement
+                print("scale {scale}: {stage}: {seconds:.4f}s {peak_rss_mb:.1f}MB".format(
+                    scale=scale, stage=stage, seconds=measurement['seconds'],
+                    peak_rss_mb=measurement['peak_rss'] / 2 ** 20,
+                ), file=sys.stderr)
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir)
+    scaling = dict()
+    for stage in stages:
+        scaling[stage] = scaling_exponent(
+            [result['file_size'] for result in results], [result['stages'][stage]['seconds'] for result in results],
+        )
+    return dict(
+        sfftk_migrate=SFFTK_MIGRATIONS_VERSION,
+        python=platform.python_version(),
+        lxml=lxml.__version__,
+        numpy=numpy_version,
+        platform=platform.platform(),
+        results=results,
+        scaling=scaling,
+    )
+
+
+def compare(report, baseline, tolerance=0.25):
+    """Compare `report` against `baseline`
+
+    :return: a list of regressions; each stage at each scale may be at most `tolerance` slower than the baseline
+    :rtype: list
+    """
+    regressions = list()
+    baseline_results = dict((result['scale'], result) for result in baseline['results'])
+    for result in report['results']:
+        if result['scale'] not in baseline_results:
+            continue
+        for stage, measurement in result['stages'].items():
+            try:
+                reference = baseline_results[result['scale']]['stages'][stage]
+            except KeyError:
+                continue
+            for key in ['seconds', 'peak_rss']:
+                if measurement[key] > reference[key] * (1 + tolerance):
+                    regressions.append("scale {}: {}: {} {:.4g} > {:.4g}".format(
+                        result['scale'], stage, key, measurement[key], reference[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sfftk-migrate on synthetic EMDB-SFF documents')
+    parser.add_argument('--scales', nargs='+', type=float, default=[1, 2, 4, 8],
+                        help='multipliers applied to the number of segments and the lattice size')
+    parser.add_argument('--segments', type=int, default=10, help='number of segments at scale 1')
+    parser.add_argument('--vertices', type=int, default=1000, help='number of vertices per mesh')
+    parser.add_argument('--no-normals', dest='normals', default=True, action='store_false', help='omit normals')
+    parser.add_argument('--shapes', type=int, default=4, help='shape primitives per segment')
+    parser.add_argument('--transforms', type=int, default=4, help='number of transforms')
+    parser.add_argument('--lattice-size', type=int, default=100000, help='lattice bytes at scale 1')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='stages to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement; the fastest is kept')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='a previous JSON results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed fractional slowdown [default: 0.25]')
+    args = parser.parse_args()
+
+    report = run(args.scales, segments=args.segments, vertices=args.vertices, normals=args.normals,
+                 shapes=args.shapes, transforms=args.transforms, lattice_size=args.lattice_size, repeat=args.repeat,
+                 stages=args.stages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print("regression: {}".format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
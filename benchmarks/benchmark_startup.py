@@ -0,0 +1,108 @@
+"""
+benchmark_startup
+=================
+
+Measure how long the `sff-migrate` command line takes to start using `python -X importtime`.
+
+The informational commands (`-V`, `-l` and `-s`) are run very many times when triaging files so the import of
+`sfftk_migrate.main` must stay cheap: it should not import `lxml`, `multiprocessing` or `numpy`, which are only
+needed once a migration runs. The benchmark fails (exits with a non-zero status) if any of these modules is imported
+or if the cumulative import time of `sfftk_migrate.main` exceeds the budget:
+
+.. code-block:: bash
+
+    ~$ python benchmarks/benchmark_startup.py --budget-ms 75
+
+`-X importtime` was added in Python 3.7; on older interpreters the benchmark is skipped.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULE = 'sfftk_migrate.main'
+FORBIDDEN = ['lxml', 'multiprocessing', 'numpy', 'sfftk_migrate.migrate', 'sfftk_migrate.batch']
+
+
+def _env():
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([REPOSITORY] + sys.path[1:]))
+
+
+def import_times(module=MODULE):
+    """Import `module` in a fresh interpreter with `-X importtime`
+
+    :return: a dictionary of cumulative import times in microseconds keyed by module name
+    :rtype: dict
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        env=_env(), stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True,
+    )
+    times = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def command_seconds(argv):
+    """Wall-clock time of running `python -m sfftk_migrate.main` with `argv` in a fresh interpreter"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', MODULE] + argv, env=_env(), stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def run(repeat=5):
+    """Run the benchmark
+
+    :return: the results as a JSON-serialisable dictionary; times are the fastest of `repeat` runs
+    :rtype: dict
+    """
+    runs = [import_times() for _ in range(repeat)]
+    best = min(runs, key=lambda times: times[MODULE])
+    return dict(
+        python=sys.version.split()[0],
+        import_ms=best[MODULE] / 1000.0,
+        forbidden=sorted(name for name in best if name.split('.')[0] in FORBIDDEN or name in FORBIDDEN),
+        version_seconds=min(command_seconds(['-V']) for _ in range(repeat)),
+        list_versions_seconds=min(command_seconds(['-l']) for _ in range(repeat)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the start-up time of sff-migrate')
+    parser.add_argument('--budget-ms', type=float, default=75.0,
+                        help='the maximum cumulative import time of {} in milliseconds [default: 75]'.format(MODULE))
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement; the fastest is kept')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    if sys.version_info < (3, 7):
+        print("skipped: measuring import times needs 'python -X importtime', which was added in Python 3.7",
+              file=sys.stderr)
+        return 0
+    report = run(repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    failures = list()
+    if report['forbidden']:
+        failures.append("{} imports {}".format(MODULE, ", ".join(report['forbidden'])))
+    if report['import_ms'] > args.budget_ms:
+        failures.append("importing {} took {:.1f}ms > {:.1f}ms".format(MODULE, report['import_ms'], args.budget_ms))
+    for failure in failures:
+        print("regression: {}".format(failure), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,9 @@ setup(
     long_description_content_type='text/x-rst',
     long_description=LONG_DESCRIPTION,
     install_requires=['lxml'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     python_requires='>=3',
     classifiers=[
         # maturity
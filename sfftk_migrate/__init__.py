@@ -4,6 +4,8 @@ sfftk-migrate
 
 This is a simple tool to allow users to easily migrate older versions of EMDB-SFF files to the latest (supported version).
 It has only one dependency: `lxml` which effects part of the migrations.
+If `numpy` is installed (`pip install sfftk-migrate[numpy]`) mesh data is converted using vectorised array
+operations; otherwise a pure-Python implementation is used.
 
 Presently it only works with XML (.sff) EMDB-SFF files.
 
@@ -27,13 +29,24 @@ where `infile` and `outfile` are the names of the source and target files, `styl
 XSL file, `args` is the argument namespace, `encoding` defines what encoding the outfile will
 be writing in, and `**params` is a dictionary of any params specified in the XSL file.
 
+Modules may also implement a `migrate_tree` function which works on parsed documents:
+
+.. code-block:: python
+
+    def migrate_tree(original, stylesheet, args, **params):
+        ...
+
+where `original` is an `lxml.etree._ElementTree` and the migrated `_ElementTree` is returned. Consecutive hops
+implemented by `migrate_tree` are chained in memory by `do_migration` so that only the final document is written
+to disk (atomically, by renaming a temporary file). Modules which only implement `migrate` are passed a file.
+
 Please reference https://www.w3schools.com/xml/xsl_intro.asp on how XSL works.
 
 Migrations are effected using the `migrate.do_migration` function which has the following signature:
 
 .. code-block:: python
 
-    def do_migration(args, value_list=None, version_list=VERSION_LIST):
+    def do_migration(args, value_list=None, version_list=None, param_dict=None):
         ...
 
 
@@ -86,6 +99,7 @@ XSL = os.path.join(TEST_DATA_PATH, 'data', 'xsl')
 XML = os.path.join(TEST_DATA_PATH, 'data', 'xml')
 
 MIGRATIONS_PACKAGE = 'sfftk_migrate.migrations'
+ENGINES = ['tree', 'streaming', 'native']
 STYLESHEETS_DIR = os.path.join(os.path.dirname(__file__), 'stylesheets')
 
 ENDIANNESS = {
@@ -0,0 +1,97 @@
+"""
+aio
+===
+
+The `aio` module provides an `asyncio` interface for running migrations concurrently on a pool of threads.
+
+`lxml` releases the GIL while parsing, transforming and serialising so threads give real concurrency without the
+memory cost of separate processes. Compiled stylesheets are shared between threads through the process-wide
+stylesheet cache.
+
+.. code-block:: python
+
+    import asyncio
+    from sfftk_migrate.aio import migrate_many
+
+    results = asyncio.run(migrate_many(['emd_1547.sff', 'test2.sff'], limit=4))
+"""
+import argparse
+import asyncio
+import functools
+import os
+
+from . import VERSION_LIST
+from .core import get_output_name
+from .migrate import do_migration
+
+
+def _migrate(infile, outfile, target_version, param_dict, verbose):
+    args = argparse.Namespace(infile=infile, outfile=outfile, target_version=target_version, verbose=verbose)
+    return do_migration(args, param_dict=param_dict)
+
+
+async def migrate_file(infile, outfile=None, target_version=VERSION_LIST[-1], param_dict=None, executor=None,
+                       verbose=False):
+    """Migrate `infile` on a thread without blocking the event loop
+
+    Cancelling the returned coroutine does not interrupt a migration which has already started: it runs to completion
+    on its thread but, because the output is written atomically, no partial output is ever visible.
+
+    :param str infile: the name of the file to migrate
+    :param str outfile: the name of the output file [default: <infile>_<target>.<ext>]
+    :param str target_version: a valid version string
+    :param dict param_dict: XSL param values by name
+    :param executor: the executor to run the migration on [default: the event loop's default executor]
+    :type executor: `concurrent.futures.Executor`
+    :param bool verbose: verbose output
+    :return: status using `os` exit codes
+    :rtype: int
+    """
+    if outfile is None:
+        outfile = get_output_name(infile, target_version, prefix="")
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(
+        _migrate, infile, outfile, target_version, param_dict if param_dict is not None else dict(), verbose,
+    ))
+
+
+async def migrate_many(infiles, target_version=VERSION_LIST[-1], param_dict=None, limit=4, executor=None,
+                       verbose=False):
+    """Migrate `infiles` concurrently with at most `limit` migrations running at once
+
+    Failures do not affect other files. If the coroutine is cancelled, migrations that have not started are never
+    started.
+
+    :param list infiles: the names of the files to migrate; outputs are named as by :py:func:`migrate_file`
+    :param str target_version: a valid version string
+    :param dict param_dict: XSL param values by name
+    :param int limit: the maximum number of concurrent migrations [default: 4]
+    :param executor: the executor to run migrations on [default: the event loop's default executor]
+    :type executor: `concurrent.futures.Executor`
+    :param bool verbose: verbose output
+    :return: one dictionary per input file, in the same order as `infiles`, with keys `infile`, `outfile`, `status`
+        and `error`
+    :rtype: list
+    """
+    if limit < 1:
+        raise ValueError("limit should be at least 1")
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _migrate_one(infile):
+        outfile = get_output_name(infile, target_version, prefix="")
+        result = dict(infile=infile, outfile=outfile, status=os.EX_SOFTWARE, error=None)
+        async with semaphore:
+            try:
+                result['status'] = await migrate_file(
+                    infile, outfile, target_version=target_version, param_dict=param_dict, executor=executor,
+                    verbose=verbose,
+                )
+                if result['status'] != os.EX_OK:
+                    result['error'] = "migration failed with status {}".format(result['status'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result['error'] = "{}: {}".format(e.__class__.__name__, e)
+        return result
+
+    return await asyncio.gather(*[_migrate_one(infile) for infile in infiles])
@@ -0,0 +1,344 @@
+"""
+batch
+=====
+
+The `batch` module migrates many files at once using a pool of worker processes.
+
+Workers are started once and kept warm: each one imports `lxml`, compiles the migration stylesheets and plans the
+migration paths to the target version when it starts and then handles many files. XSL params are passed in as a
+dictionary so that nobody is prompted for input.
+"""
+import argparse
+import fnmatch
+import glob
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+import traceback
+
+from . import STYLESHEETS_DIR
+from .compression import split_compression_extension
+from .core import get_output_name, get_source_version
+from .migrate import do_migration, STYLESHEET_CACHE
+from .registry import REGISTRY
+from .timing import profiling
+from .utils import _print
+
+
+# the seconds the parent allows a worker past its timeout before terminating it
+TIMEOUT_GRACE = 1.0
+
+
+class MigrationTimeout(Exception):
+    """Raised in a worker when a single migration takes longer than allowed"""
+
+
+def collect_files(paths, pattern='*.sff', manifest=None):
+    """Collect the names of the files to migrate
+
+    :param list paths: a list of file names, directories (searched recursively for files matching `pattern`) or glob
+        patterns
+    :param str pattern: the pattern of file names to pick from directories; compressed files whose names match it
+        once their compression extension is removed (e.g. 'file.sff.gz') are picked too [default: '*.sff']
+    :param str manifest: the name of a file listing one input file per line; blank lines and lines starting with '#'
+        are ignored
+    :return: an ordered list of unique file names
+    :rtype: list
+    """
+    _paths = list(paths)
+    if manifest is not None:
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    _paths.append(line)
+    infiles = list()
+    for path in _paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if fnmatch.fnmatch(filename, pattern) or \
+                            fnmatch.fnmatch(split_compression_extension(filename)[0], pattern):
+                        infiles.append(os.path.join(dirpath, filename))
+        elif glob.has_magic(path):
+            infiles += sorted(glob.glob(path, recursive=True))
+        else:
+            infiles.append(path)
+    # remove duplicates but keep the order
+    seen = set()
+    return [infile for infile in infiles if not (infile in seen or seen.add(infile))]
+
+
+def get_batch_output_name(infile, target_version, outdir=None, root=None, compress=None):
+    """The output name for `infile`
+
+    :param str infile: the input file name
+    :param str target_version: a valid version string
+    :param str outdir: the output directory; if not set outputs are written next to inputs
+    :param str root: the directory that inputs are relative to; their relative paths are mirrored in `outdir`
+    :param str compress: the compression of the output (see :py:func:`sfftk_migrate.core.get_output_name`)
+        [default: that of the input]
+    :return: the output file name
+    :rtype: str
+    """
+    outfile = get_output_name(infile, target_version, prefix="", compression=compress)
+    if outdir is None:
+        return outfile
+    if root is None:
+        return os.path.join(outdir, os.path.basename(outfile))
+    return os.path.join(outdir, os.path.relpath(outfile, root))
+
+
+def _alarm(signum, frame):
+    raise MigrationTimeout()
+
+
+def _init_worker(target_version=None):
+    """Warm up a worker: compile all the bundled stylesheets and plan the paths to `target_version` once"""
+    # the parent process handles interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    STYLESHEET_CACHE.preload(
+        os.path.join(STYLESHEETS_DIR, stylesheet) for stylesheet in sorted(os.listdir(STYLESHEETS_DIR)) if
+        stylesheet.startswith('migrate_') and stylesheet.endswith('.xsl')
+    )
+    if target_version is not None:
+        REGISTRY.plans(target_version)
+
+
+def migrate_file(job):
+    """Migrate a single file
+
+    This is the function executed by the workers; it never raises.
+
+    :param tuple job: a tuple of `infile`, `outfile`, `target_version`, `param_dict`, `timeout`, `verbose` and,
+        optionally, `profile` and a dictionary of further options which are set on the argument namespace (e.g.
+        `cache_dir`)
+    :return: a dictionary with keys `infile`, `outfile`, `status` (an `os` exit code), `error` and `skipped`; files
+        which are already at the target version are skipped and have no `outfile`; when profiling there is also a
+        `profile` report of the migration (see :py:mod:`sfftk_migrate.timing`)
+    :rtype: dict
+    """
+    infile, outfile, target_version, param_dict, timeout, verbose = job[:6]
+    profile = job[6] if len(job) > 6 else False
+    options = job[7] if len(job) > 7 else dict()
+    result = dict(infile=infile, outfile=outfile, status=os.EX_SOFTWARE, error=None, skipped=False)
+    args = argparse.Namespace(infile=infile, outfile=outfile, target_version=target_version, verbose=verbose,
+                              **options)
+    return _migrate_file(result, args, timeout, param_dict, profile)
+
+
+def _migrate_file(result, args, timeout, param_dict, profile=False):
+    outfile = args.outfile
+    # timeouts use SIGALRM which is only available on Unix and only to the main thread
+    use_alarm = timeout and hasattr(signal, 'setitimer')
+    try:
+        if use_alarm:
+            previous_handler = signal.signal(signal.SIGALRM, _alarm)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            if _is_up_to_date(args):
+                # nothing is written so there is no output to report
+                result.update(status=os.EX_OK, outfile=None, skipped=True)
+                return result
+            outdir = os.path.dirname(outfile)
+            if outdir:
+                os.makedirs(outdir, exist_ok=True)
+            if profile:
+                with profiling(listener=lambda report: result.update(profile=report)):
+                    result['status'] = do_migration(args, param_dict=param_dict)
+            else:
+                result['status'] = do_migration(args, param_dict=param_dict)
+            if result['status'] != os.EX_OK:
+                result['error'] = "migration failed with status {}".format(result['status'])
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+    except MigrationTimeout:
+        result['status'] = os.EX_TEMPFAIL
+        result['error'] = "timed out after {} seconds".format(timeout)
+    except Exception as e:
+        result['status'] = os.EX_SOFTWARE
+        result['error'] = "{}: {}".format(e.__class__.__name__, e)
+        if args.verbose:
+            _print(traceback.format_exc())
+    return result
+
+
+def _is_up_to_date(args):
+    """Whether `args.infile` is already at `args.target_version`; unreadable files are left to
+    :py:func:`sfftk_migrate.migrate.do_migration` to report
+    """
+    try:
+        return get_source_version(args.infile) == args.target_version
+    except OSError:
+        return False
+
+
+def migrate_batch(infiles, target_version, outdir=None, root=None, param_dict=None, workers=None, timeout=None,
+                  maxtasksperchild=None, verbose=False, profile=False, cache_dir=None, cache_size=None,
+                  incremental=False, parser_options=None, mesh_encoding=None, compact_meshes=False, compress=None):
+    """Migrate many files using a pool of worker processes
+
+    :param list infiles: the names of the files to migrate
+    :param str target_version: a valid version string
+    :param str outdir: the output directory; if not set outputs are written next to inputs
+    :param str root: the directory that inputs are relative to; their relative paths are mirrored in `outdir`
+    :param dict param_dict: XSL param values by name
+    :param int workers: the number of worker processes [default: the number of CPUs]; with `workers=0` files are
+        migrated in this process
+    :param float timeout: the maximum number of seconds to spend on each file; workers which cannot stop a migration
+        in time (e.g. because it is stuck in `libxml2`) are terminated and replaced
+    :param int maxtasksperchild: the number of files each worker migrates before it is replaced by a fresh worker
+    :param bool verbose: verbose output
+    :param bool profile: include a per-stage `profile` report in each result
+    :param str cache_dir: reuse the outputs of identical migrations stored in this directory (see
+        :py:mod:`sfftk_migrate.cache`); the workers share the cache
+    :param int cache_size: the maximum size of the cache in bytes [default: no limit]
+    :param bool incremental: reuse meshes converted by earlier migrations; requires `cache_dir`
+    :param dict parser_options: options for parsing documents; see :py:mod:`sfftk_migrate.parsing`
+    :param dict mesh_encoding: the types used to encode meshes e.g. `dict(triangles_mode='auto')`
+    :param bool compact_meshes: drop unreferenced mesh vertices and weld duplicate vertices
+    :param str compress: the compression of the outputs; one of :py:data:`sfftk_migrate.compression.COMPRESSIONS`
+        [default: the compression of each input]
+    :return: one result dictionary per input file, in the same order as `infiles`; see :py:func:`migrate_file`
+    :rtype: list
+    """
+    options = dict(parser_options or dict(), cache_dir=cache_dir, cache_size=cache_size, incremental=incremental,
+                   mesh_encoding=mesh_encoding, compact_meshes=compact_meshes, compress=compress)
+    jobs = [
+        (infile, get_batch_output_name(infile, target_version, outdir=outdir, root=root, compress=compress),
+         target_version,
+         param_dict if param_dict is not None else dict(), timeout, verbose, profile, options)
+        for infile in infiles
+    ]
+    if workers == 0:
+        return list(map(migrate_file, jobs))
+    return _run_jobs(jobs, workers or os.cpu_count() or 1, target_version, timeout, maxtasksperchild)
+
+
+def _work(connection, target_version):
+    """The loop of a worker process: migrate the jobs received on `connection` until it receives `None`"""
+    _init_worker(target_version)
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        connection.send(migrate_file(job))
+
+
+class _Worker(object):
+    """A worker process which the parent can terminate if a migration overruns its timeout"""
+
+    def __init__(self, target_version):
+        self.connection, connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_work, args=(connection, target_version), daemon=True)
+        self.process.start()
+        connection.close()
+        self.tasks = 0
+        self.index = self.deadline = None
+
+    def submit(self, index, job, timeout):
+        self.index = index
+        # the worker times itself out first; the parent only steps in when it cannot e.g. during a long libxml2 call
+        self.deadline = time.monotonic() + timeout + TIMEOUT_GRACE if timeout else None
+        self.connection.send(job)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(TIMEOUT_GRACE)
+        self.terminate()
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+def _run_jobs(jobs, workers, target_version, timeout, maxtasksperchild):
+    """Run `jobs` on `workers` worker processes enforcing `timeout` from the parent
+
+    A worker whose migration runs past its deadline is terminated and replaced, as are workers which exit unexpectedly
+    and workers which have migrated `maxtasksperchild` files.
+
+    :return: the results in the same order as `jobs`
+    :rtype: list
+    """
+    results = [None] * len(jobs)
+    pending = list(reversed(list(enumerate(jobs))))
+    idle = list()
+    busy = dict()
+    try:
+        while pending or busy:
+            while pending and len(idle) + len(busy) < workers:
+                idle.append(_Worker(target_version))
+            while pending and idle:
+                worker = idle.pop()
+                index, job = pending.pop()
+                worker.submit(index, job, timeout)
+                busy[worker.connection] = worker
+            deadlines = [worker.deadline for worker in busy.values() if worker.deadline is not None]
+            wait = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            for connection in multiprocessing.connection.wait(list(busy), timeout=wait):
+                worker = busy.pop(connection)
+                job = jobs[worker.index]
+                try:
+                    results[worker.index] = connection.recv()
+                except EOFError:
+                    worker.terminate()
+                    results[worker.index] = dict(infile=job[0], outfile=job[1], status=os.EX_SOFTWARE,
+                                                 error="the worker exited unexpectedly", skipped=False)
+                    continue
+                worker.tasks += 1
+                if maxtasksperchild is not None and worker.tasks >= maxtasksperchild:
+                    worker.stop()
+                else:
+                    idle.append(worker)
+            now = time.monotonic()
+            for connection, worker in list(busy.items()):
+                if worker.deadline is not None and now >= worker.deadline:
+                    del busy[connection]
+                    worker.terminate()
+                    job = jobs[worker.index]
+                    results[worker.index] = dict(infile=job[0], outfile=job[1], status=os.EX_TEMPFAIL,
+                                                 error="timed out after {} seconds".format(timeout), skipped=False)
+    finally:
+        for worker in idle:
+            worker.stop()
+        for worker in busy.values():
+            worker.terminate()
+    return results
+
+
+def summarise(results):
+    """Print per-file statuses and a summary of `results`
+
+    :param list results: results from :py:func:`migrate_batch`
+    :return: `os.EX_OK` if every file was migrated else the status of the first failure
+    :rtype: int
+    """
+    failures = [result for result in results if result['status'] != os.EX_OK]
+    skipped = [result for result in results if result.get('skipped')]
+    for result in results:
+        if result.get('skipped'):
+            _print("[{status}] {infile}: already at the target version".format(**result))
+        elif result['status'] == os.EX_OK:
+            _print("[{status}] {infile} -> {outfile}".format(**result))
+        else:
+            _print("[{status}] {infile}: {error}".format(**result))
+    _print("migrated {total} files: {succeeded} succeeded, {skipped} skipped, {failed} failed".format(
+        total=len(results),
+        succeeded=len(results) - len(failures) - len(skipped),
+        skipped=len(skipped),
+        failed=len(failures),
+    ))
+    if failures:
+        return failures[0]['status']
+    return os.EX_OK
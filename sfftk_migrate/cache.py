@@ -0,0 +1,279 @@
+"""
+cache
+=====
+
+The `cache` module provides a content-addressed, on-disk cache of migration outputs.
+
+An output is stored under a key which is a hash of everything that determines it: the bytes of the input file, the
+stylesheet (with every stylesheet it includes or imports) and module of each hop of the migration path, the target
+version, the engine, the XSL params and the version of `sfftk-migrate`. Re-running a migration whose key is in the
+cache copies (or hardlinks) the stored output instead of migrating again.
+
+Entries are written to a temporary file which is then renamed so that many processes may share a cache. The cache
+may be bounded in size: the least recently used entries are evicted first (using an entry is recorded by updating its
+modification time).
+
+.. code-block:: python
+
+    from sfftk_migrate.cache import ResultCache, parse_size
+
+    cache = ResultCache('~/.cache/sff-migrate', max_bytes=parse_size('10G'))
+    cache.info()
+    cache.prune(max_bytes=parse_size('1G'))
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from . import SFFTK_MIGRATIONS_VERSION
+from .core import get_stylesheet_dependencies
+
+# change this if the layout of the cache or the way keys are computed changes
+CACHE_VERSION = '2'
+SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+CHUNK_SIZE = 2 ** 20
+# the directory of a result cache in which its payload cache is kept
+PAYLOAD_DIRECTORY = 'meshes'
+
+
+def parse_size(size):
+    """Convert a size such as '500M' or '10G' to bytes
+
+    :param str size: an integer optionally followed by one of K, M, G or T (powers of 1024)
+    :return: the number of bytes
+    :rtype: int
+    """
+    _size = str(size).strip().upper().rstrip('B')
+    unit = _size[-1:] if _size[-1:] in SIZE_UNITS else ''
+    try:
+        value = float(_size[:len(_size) - len(unit)])
+        assert value >= 0
+    except (ValueError, AssertionError):
+        raise ValueError("invalid size: '{}'".format(size))
+    return int(value * SIZE_UNITS[unit])
+
+
+def _update_file(hasher, fn):
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+
+def get_key(infile, hops, target_version, params=None, engine='tree', options=None):
+    """The cache key of a migration
+
+    :param str infile: the name of the input file
+    :param list hops: a list of `(source, target, stylesheet, module)` tuples for the migration path; `stylesheet` may
+        be `None`; the stylesheets it includes or imports are part of the key
+    :param str target_version: a valid version string
+    :param dict params: the XSL params by name
+    :param str engine: the migration engine
+    :param dict options: any other options which change the output (e.g. the encoding of meshes) by name
+    :return: a hex digest
+    :rtype: str
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([
+        CACHE_VERSION, SFFTK_MIGRATIONS_VERSION, target_version, engine, sorted((params or dict()).items()),
+        [[source, target] for source, target, _, _ in hops], sorted((options or dict()).items()),
+    ]).encode('utf-8'))
+    for _, _, stylesheet, module in hops:
+        stylesheets = get_stylesheet_dependencies(stylesheet) if stylesheet is not None else [None]
+        for fn in stylesheets + [getattr(module, '__file__', None)]:
+            hasher.update(b'\0')
+            if fn is not None and os.path.exists(fn):
+                _update_file(hasher, fn)
+    hasher.update(b'\0')
+    _update_file(hasher, infile)
+    return hasher.hexdigest()
+
+
+class ResultCache(object):
+    """A content-addressed cache of migration outputs in `directory`
+
+    :param str directory: the cache directory; created if it does not exist
+    :param int max_bytes: evict the least recently used entries when the cache grows past this size [default: no
+        limit]
+    :param bool link: hardlink cached outputs into place instead of copying them; linked outputs share storage with
+        the cache and should not be modified in place [default: False]
+    """
+
+    def __init__(self, directory, max_bytes=None, link=False):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+        self.link = link
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, outfile):
+        """Put the output stored under `key` at `outfile`
+
+        :param str key: the cache key (see :py:func:`get_key`)
+        :param str outfile: the name of the output file
+        :return: whether there was an entry for `key`
+        :rtype: bool
+        """
+        path = self._path(key)
+        name = os.path.join(
+            os.path.dirname(os.path.abspath(outfile)), '.{}.{}.tmp'.format(os.path.basename(outfile), uuid.uuid4().hex),
+        )
+        try:
+            if self.link:
+                try:
+                    os.link(path, name)
+                except FileNotFoundError:
+                    # a missing entry is a miss; see below
+                    raise
+                except OSError:
+                    # e.g. the cache is on a different file system
+                    shutil.copyfile(path, name)
+            else:
+                shutil.copyfile(path, name)
+            os.replace(name, outfile)
+        except FileNotFoundError:
+            # there is no entry or it was evicted by another process
+            if os.path.exists(name):
+                os.remove(name)
+            return False
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def put(self, key, outfile):
+        """Store `outfile` under `key` then evict entries if the cache is too big
+
+        :param str key: the cache key (see :py:func:`get_key`)
+        :param str outfile: the name of the output file
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        name = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            shutil.copyfile(outfile, name)
+            os.replace(name, path)
+        finally:
+            if os.path.exists(name):
+                os.remove(name)
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def entries(self, payloads=False):
+        """The entries in the cache, least recently used first
+
+        :param bool payloads: include the entries of the payload cache kept in this cache (see
+            :py:class:`PayloadCache`) [default: False]
+        :return: a list of dictionaries with keys `key`, `path`, `size` and `last_used` (a timestamp)
+        :rtype: list
+        """
+        entries = list()
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            if not payloads and dirpath == self.directory and PAYLOAD_DIRECTORY in dirnames:
+                dirnames.remove(PAYLOAD_DIRECTORY)
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append(dict(key=filename, path=os.path.join(dirpath, filename), size=stat.st_size,
+                                    last_used=stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def info(self):
+        """Cache statistics
+
+        :return: a dictionary with `directory`, `entries`, `payloads` (the number of entries of the payload cache),
+            `bytes` (the size of both) and `max_bytes`
+        :rtype: dict
+        """
+        entries = self.entries(payloads=True)
+        payload_directory = os.path.join(self.directory, PAYLOAD_DIRECTORY) + os.sep
+        payloads = sum(1 for entry in entries if entry['path'].startswith(payload_directory))
+        return dict(directory=self.directory, entries=len(entries) - payloads, payloads=payloads,
+                    bytes=sum(entry['size'] for entry in entries), max_bytes=self.max_bytes)
+
+    def prune(self, max_bytes=None, max_age=None):
+        """Evict the least recently used entries until the cache is no bigger than `max_bytes`
+
+        Entries of the payload cache kept in this cache are evicted along with the outputs.
+
+        :param int max_bytes: the size to shrink the cache to; 0 empties the cache [default: no limit]
+        :param float max_age: also evict entries not used for this many seconds [default: no limit]
+        :return: the evicted entries
+        :rtype: list
+        """
+        entries = self.entries(payloads=True)
+        total = sum(entry['size'] for entry in entries)
+        now = time.time()
+        evicted = list()
+        for entry in entries:
+            if (max_bytes is None or total <= max_bytes) and (max_age is None or now - entry['last_used'] <= max_age):
+                continue
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total -= entry['size']
+            evicted.append(entry)
+        return evicted
+
+
+class PayloadCache(ResultCache):
+    """A content-addressed cache of encoded mesh payloads used to migrate incrementally
+
+    Payloads are tuples of base64-encoded vertices, the number of vertices, base64-encoded normals, the number of
+    normals, base64-encoded triangles, the number of triangles and the type of the triangles (see
+    :py:func:`sfftk_migrate.migrations.migrate_v0_7_0_dev0_to_v0_8_0_dev1.encode_mesh`). Payload caches are kept in
+    the `meshes` directory of a result cache so that they are pruned along with it but are not counted among its
+    entries.
+
+    :param str directory: the directory of the result cache
+    """
+
+    def __init__(self, directory):
+        super(PayloadCache, self).__init__(os.path.join(directory, PAYLOAD_DIRECTORY))
+
+    def get_payload(self, key):
+        """The payload stored under `key` or `None`"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header, vertices, normals, triangles = f.read().split(b'\n')
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, evicted or (should it ever happen) corrupt entries are misses
+            return None
+        try:
+            num_vertices, num_normals, num_triangles, triangles_mode = header.decode('ascii').split()
+            return (
+                vertices, int(num_vertices), normals, int(num_normals), triangles, int(num_triangles), triangles_mode,
+            )
+        except ValueError:
+            # a corrupt header is a miss too
+            return None
+
+    def put_payload(self, key, payload):
+        """Store `payload` under `key`; the cache is not pruned"""
+        vertices, num_vertices, normals, num_normals, triangles, num_triangles, triangles_mode = payload
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        name = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            with open(name, 'wb') as f:
+                f.write(b'\n'.join([
+                    "{} {} {} {}".format(num_vertices, num_normals, num_triangles, triangles_mode).encode('ascii'),
+                    vertices, normals, triangles,
+                ]))
+            os.replace(name, path)
+        finally:
+            if os.path.exists(name):
+                os.remove(name)
@@ -0,0 +1,206 @@
+"""
+compression
+===========
+
+The `compression` module lets migrations read and write compressed files (`.sff.gz`, `.sff.bz2` and `.sff.xz`)
+without decompressing them to disk.
+
+Inputs are recognised by their leading bytes so that compressed files are read correctly whatever they are called;
+they are streamed through the decompressor by every reader. Outputs are compressed if their name has one of the
+extensions in :py:data:`EXTENSIONS` or a compression is chosen explicitly (`--compress`); temporary files written
+while migrating are compressed in the same way.
+
+The compression modules of the standard library are only imported when they are needed.
+"""
+import contextlib
+import os
+import struct
+
+# compressions by name and their file name extensions
+EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+# the leading bytes of compressed files
+MAGIC = {'gzip': b'\x1f\x8b', 'bz2': b'BZh', 'xz': b'\xfd7zXZ\x00'}
+# the choices for `--compress`; 'none' writes plain XML whatever the name of the output
+COMPRESSIONS = ['none'] + sorted(EXTENSIONS)
+
+
+def get_compression(fn):
+    """The compression of the file `fn` judged by its leading bytes
+
+    :param str fn: the name of a file
+    :return: one of the keys of :py:data:`EXTENSIONS` or `None` for uncompressed (or empty) files
+    :rtype: str
+    """
+    with open(fn, 'rb') as f:
+        head = f.read(max(map(len, MAGIC.values())))
+    for compression, magic in MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def get_compression_by_name(fn):
+    """The compression implied by the extension of the file name `fn` or `None`"""
+    for compression, extension in EXTENSIONS.items():
+        if fn.endswith(extension):
+            return compression
+    return None
+
+
+def split_compression_extension(fn):
+    """Split the compression extension, if any, from the file name `fn`
+
+    :return: the name without the compression extension and the extension (an empty string if there is none)
+    :rtype: tuple
+    """
+    compression = get_compression_by_name(fn)
+    if compression is None:
+        return fn, ''
+    return fn[:-len(EXTENSIONS[compression])], EXTENSIONS[compression]
+
+
+def get_output_compression(args):
+    """The compression of the output of a migration
+
+    :param args: argument namespace; `args.compress` is one of :py:data:`COMPRESSIONS` or `None`, in which case the
+        compression is implied by the extension of `args.outfile`
+    :type args: `argparse.Namespace`
+    :return: one of the keys of :py:data:`EXTENSIONS` or `None`
+    :rtype: str
+    """
+    compress = getattr(args, 'compress', None)
+    if compress is None:
+        return get_compression_by_name(args.outfile)
+    try:
+        assert compress in COMPRESSIONS
+    except AssertionError:
+        raise ValueError("invalid compression: {}".format(compress))
+    return None if compress == 'none' else compress
+
+
+def _open(fn, mode, compression):
+    if compression == 'gzip':
+        import gzip
+        # the default level of the gzip command is much faster than the maximum and compresses nearly as well
+        return gzip.open(fn, mode, compresslevel=6)
+    if compression == 'bz2':
+        import bz2
+        return bz2.open(fn, mode)
+    if compression == 'xz':
+        import lzma
+        return lzma.open(fn, mode)
+    try:
+        assert compression is None
+    except AssertionError:
+        raise ValueError("invalid compression: {}".format(compression))
+    return open(fn, mode)
+
+
+def open_input(fn):
+    """Open the file `fn` for reading bytes, decompressing it on the fly if it is compressed"""
+    return _open(fn, 'rb', get_compression(fn))
+
+
+def open_output(fn, compression=None):
+    """Open the file `fn` for writing bytes, compressing them on the fly with `compression`
+
+    :param str fn: the name of the file
+    :param str compression: one of the keys of :py:data:`EXTENSIONS` or `None` for no compression
+    """
+    return _open(fn, 'wb', compression)
+
+
+@contextlib.contextmanager
+def input_source(fn):
+    """A source for `lxml` to parse `fn` from: the name itself for uncompressed files (which `libxml2` reads
+    directly) or a decompressing file object
+    """
+    if not isinstance(fn, str) or get_compression(fn) is None:
+        yield fn
+        return
+    with open_input(fn) as f:
+        yield f
+
+
+def get_size(fn, chunk_size=2 ** 20, count=None):
+    """The decompressed size of the file `fn`
+
+    Compressed files are decompressed in a single streaming pass.
+
+    :param str fn: the name of the file
+    :param int chunk_size: the number of bytes to decompress at a time
+    :param bytes count: also count the occurrences of these bytes
+    :return: the size in bytes or, with `count`, a tuple of the size and the number of occurrences
+    """
+    if get_compression(fn) is None and count is None:
+        return os.path.getsize(fn)
+    size = occurrences = 0
+    with open_input(fn) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            size += len(chunk)
+            if count is not None:
+                occurrences += chunk.count(count)
+    if count is None:
+        return size
+    return size, occurrences
+
+
+def _decompressor(compression):
+    if compression == 'gzip':
+        import zlib
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if compression == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+    if compression == 'xz':
+        import lzma
+        return lzma.LZMADecompressor()
+    raise ValueError("invalid compression: {}".format(compression))
+
+
+def sample_size(fn, head_size, chunk_size=2 ** 16):
+    """The decompressed size of the file `fn` estimated from about `head_size` bytes at its start
+
+    Files which decompress to no more than `head_size` bytes are measured exactly. Otherwise the size is extrapolated
+    from the compression ratio of the start of the file; the size of gzip files is then corrected using their trailer
+    (which records it modulo 2 ** 32).
+
+    :param str fn: the name of the file
+    :param int head_size: the number of decompressed bytes to sample
+    :param int chunk_size: the number of compressed bytes to read at a time
+    :return: the estimated size in bytes and (up to `head_size`) decompressed bytes from the start of the file
+    :rtype: tuple
+    """
+    compression = get_compression(fn)
+    if compression is None:
+        with open(fn, 'rb') as f:
+            return os.path.getsize(fn), f.read(head_size)
+    compressed_size = os.path.getsize(fn)
+    head = bytearray()
+    consumed = produced = 0
+    decompressor = _decompressor(compression)
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            consumed += len(chunk)
+            data = decompressor.decompress(chunk)
+            # concatenated streams
+            while decompressor.eof and decompressor.unused_data:
+                unused_data = decompressor.unused_data
+                decompressor = _decompressor(compression)
+                data += decompressor.decompress(unused_data)
+            produced += len(data)
+            head += data[:head_size - len(head)]
+            if produced >= head_size:
+                break
+    if consumed >= compressed_size:
+        return produced, bytes(head)
+    size = compressed_size * produced // consumed
+    if compression == 'gzip':
+        with open(fn, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            (isize,) = struct.unpack('<I', f.read(4))
+        # the multiple of 2 ** 32 which brings the trailer closest to the extrapolated size
+        isize += max(0, round((size - isize) / 2 ** 32)) * 2 ** 32
+        if isize > produced:
+            size = isize
+    return max(size, produced), bytes(head)
@@ -3,21 +3,29 @@ core
 ====
 
 The `core` module defines core functions required to perform the migration.
+
+`lxml` is imported by the functions which parse documents rather than by the module so that commands which only
+print information (e.g. `sff-migrate -V`) start quickly.
 """
 
 import importlib
 import os
 
-from lxml import etree
-
 from . import VERSION_LIST, XSL, MIGRATIONS_PACKAGE, STYLESHEETS_DIR
+from .compression import EXTENSIONS, input_source, split_compression_extension
+from .registry import REGISTRY
+from .timing import stage, is_profiling
 from .utils import _print
 
+XSL_NAMESPACE = 'http://www.w3.org/1999/XSL/Transform'
+
 
 def get_stylesheet(source, target, prefix="migrate"):
     """Provides the stylesheet used to perform a migration from the specified `source` to `target` versions.
 
-    The name of the stylesheet is constructed using the template `{prefix}_v{source}_to_v{target}.xsl`
+    The name of the stylesheet is constructed using the template `{prefix}_v{source}_to_v{target}.xsl`. Bundled
+    stylesheets are looked up in the migration registry (see :py:mod:`sfftk_migrate.registry`) so the stylesheets
+    directory is only listed once.
 
     :param str source: a valid version string
     :param str target: a valid version string
@@ -25,6 +33,10 @@ def get_stylesheet(source, target, prefix="migrate"):
     :return: the name of the stylesheet file
     :raises: OSError
     """
+    if prefix == REGISTRY.prefix:
+        stylesheet = REGISTRY.get_stylesheet(source, target)
+        if stylesheet is not None:
+            return stylesheet
     stylesheet = os.path.join(STYLESHEETS_DIR,
                               "{prefix}_v{source}_to_v{target}.xsl".format(prefix=prefix, source=source, target=target))
     try:
@@ -34,14 +46,50 @@ def get_stylesheet(source, target, prefix="migrate"):
     return stylesheet
 
 
+def get_stylesheet_dependencies(stylesheet, stylesheet_doc=None):
+    """Lists the stylesheet and every stylesheet it includes or imports, directly or indirectly.
+
+    Includes and imports whose files do not exist are left out (`lxml` reports them when the stylesheet is compiled).
+
+    :param str stylesheet: the name of an XSL file
+    :param stylesheet_doc: the stylesheet already parsed, if it has been
+    :type stylesheet_doc: `lxml.etree._ElementTree`
+    :return: the absolute names of the files, starting with `stylesheet`
+    :rtype: list
+    """
+    from lxml import etree
+    dependencies = list()
+    pending = [(os.path.abspath(stylesheet), stylesheet_doc)]
+    while pending:
+        path, doc = pending.pop(0)
+        if path in dependencies:
+            continue
+        dependencies.append(path)
+        if doc is None:
+            try:
+                doc = etree.parse(path)
+            except (OSError, etree.XMLSyntaxError):
+                continue
+        for href in doc.xpath('/xsl:stylesheet/xsl:include/@href|/xsl:stylesheet/xsl:import/@href',
+                              namespaces={'xsl': XSL_NAMESPACE}):
+            dependency = os.path.join(os.path.dirname(path), href)
+            if os.path.exists(dependency):
+                pending.append((os.path.abspath(dependency), None))
+    return dependencies
+
+
 def get_module(source, target, prefix="migrate"):
     """Provides the module that effects the migration for `source` and `target` versions.
 
+    Modules of migrations in the migration registry are imported once, when first requested.
+
     :param str source: a valid version string
     :param str target: a valid version string
     :param str prefix: the file name prefix [default: 'migrate']
     :return: the module implementing the migration
     """
+    if prefix == REGISTRY.prefix and REGISTRY.get_migration(source, target) is not None:
+        return REGISTRY.get_module(source, target)
     module_name = "{package}.{prefix}_v{source}_to_v{target}".format(
         package=MIGRATIONS_PACKAGE,
         prefix=prefix,
@@ -52,37 +100,53 @@ def get_module(source, target, prefix="migrate"):
     return module
 
 
-def get_output_name(input, target, prefix="tmp_"):
+def get_output_name(input, target, prefix="tmp_", compression=None):
     """Provides a meaningful output name given the input file name
 
+    Compression extensions are kept with the extension before them e.g. 'file.sff.gz' becomes
+    'file_v<target>.sff.gz'.
+
     :param str input: the full path to the input file
     :param str target: a valid version string
+    :param str compression: the compression of the output; one of
+        :py:data:`sfftk_migrate.compression.COMPRESSIONS` or `None` to keep that of the input
     :return: the full path to the output file
     :rtype: str
     """
     dirname = os.path.dirname(input)
-    basename = os.path.basename(input)
-    _input = basename.split('.')
-    root = '.'.join(_input[:-1])
-    ext = _input[-1]
-    output = os.path.join(dirname, '{prefix}{root}_v{target}.{ext}'.format(
+    basename, compression_ext = split_compression_extension(os.path.basename(input))
+    if compression is not None:
+        compression_ext = '' if compression == 'none' else EXTENSIONS[compression]
+    if compression_ext and '.' not in basename:
+        root, ext = basename, ''
+    else:
+        _input = basename.split('.')
+        root = '.'.join(_input[:-1])
+        ext = '.' + _input[-1]
+    output = os.path.join(dirname, '{prefix}{root}_v{target}{ext}{compression_ext}'.format(
         prefix=prefix,
         root=root,
         target=target,
         ext=ext,
+        compression_ext=compression_ext,
     ))
     return output
 
 
-def get_migration_path(source, target, version_list=VERSION_LIST):
-    """Given the source, target versions and VERSION_LIST determine the migration path,
-    which is a subset of the `VERSION_LIST`
+def get_migration_path(source, target, version_list=None):
+    """Given the source and target versions determine the migration path
+
+    By default the path is the cheapest one through the graph of available migrations, which may include shortcuts
+    that skip versions (see :py:mod:`sfftk_migrate.registry`). If a `version_list` is given the path is instead a
+    walk over consecutive versions in the list.
 
     :param str source: a valid version string
     :param str target: a valid version string
     :param list version_list: a list of ordered versions from oldest to latest
     :return: a list of tuples of valid version strings
     """
+    if version_list is None:
+        return REGISTRY.get_path(source, target)
     try:
         start = version_list.index(source)
     except ValueError:
@@ -97,17 +161,77 @@ def get_migration_path(source, target, version_list=VERSION_LIST):
     return migration_path
 
 
-def get_source_version(fn, path="/segmentation/version"):
-    """Provides the version of the specified document
+def get_source_version(fn, path="/segmentation/version", stream=True):
+    """Provides the version of the specified document, which may be compressed
+
+    By default the document is read incrementally and parsing stops as soon as the element at `path` has been read;
+    because the version is near the top of EMDB-SFF files this avoids reading the rest of the file. Paths which are
+    not simple sequences of tags (e.g. with predicates) or which are not found while streaming fall back to parsing
+    the full document.
 
     :param str fn: filename as a string
     :param str path: the XPath description to the version string
+    :param bool stream: whether to try reading only the beginning of the file [default: True]
     :return: version
     :rtype: str
     """
-    source_tree = etree.parse(fn)
-    source_version = source_tree.xpath("{path}/text()".format(path=path))[0]
-    return source_version
+    with stage('get_source_version'):
+        if stream:
+            source_version = _sniff_text(fn, path)
+            if source_version is not None:
+                return source_version
+        source_tree = parse_document(fn)
+        source_version = source_tree.xpath("{path}/text()".format(path=path))[0]
+        return source_version
+
+
+def parse_document(fn):
+    """Parse an XML document
+
+    The document is parsed with the shared parser options (see :py:mod:`sfftk_migrate.parsing`) once its expected
+    memory footprint has been checked. When profiling, the number of bytes read, the expected footprint and the
+    elements parsed are recorded against the `parse` stage.
+
+    :param str fn: filename as a string
+    :return: the parsed document
+    :rtype: `lxml.etree._ElementTree`
+    :raises: :py:class:`sfftk_migrate.parsing.DocumentTooLarge` if the document is not expected to fit in memory
+    """
+    from .parsing import check_footprint, parse_file
+    with stage('parse') as _stage:
+        if isinstance(fn, str):
+            _stage.count(expected_bytes=check_footprint(fn))
+        tree = parse_file(fn)
+        if is_profiling():
+            _stage.count(elements=sum(1 for _ in tree.iter()))
+            if isinstance(fn, str):
+                _stage.count(bytes_read=os.path.getsize(fn))
+    return tree
+
+
+def _sniff_text(fn, path):
+    """Read the text of the first element at the absolute tag path `path`, stopping as soon as it has been read
+
+    :param str fn: filename as a string
+    :param str path: an absolute path consisting only of tags e.g. '/segmentation/version'
+    :return: the text or `None` if the path is not simple or the element was not found/has no text
+    """
+    if not path.startswith('/') or path.startswith('//') or any(c in path for c in '[]@*()|:'):
+        return None
+    from .parsing import iterparse
+    tags = path.strip('/').split('/')
+    stack = list()
+    with input_source(fn) as source:
+        for event, element in iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(element.tag)
+                continue
+            if stack == tags:
+                return element.text
+            stack.pop()
+            # we don't need anything that precedes the element we want
+            element.clear()
+    return None
 
 
 def list_versions():
@@ -1,13 +1,19 @@
 import argparse
+import json
 import os
 import shlex
 import sys
+import time
 
-from . import VERSION_LIST, SFFTK_MIGRATIONS_VERSION
+from . import VERSION_LIST, SFFTK_MIGRATIONS_VERSION, ENGINES, ENDIANNESS, MODE
+from .compression import COMPRESSIONS
 from .core import get_output_name, get_source_version, list_versions
-from .migrate import do_migration
+from .timing import aggregate, format_report, profiling
 from .utils import _print
 
+# `batch`, `migrate` and `serve` (and with them `lxml` and `multiprocessing`) are only imported when files are migrated
+# so that informational commands such as `sff-migrate -V` start quickly
+
 
 def parse_args(args, use_shlex=True):
     """Perform argument parsing as well as
@@ -33,6 +39,37 @@ def parse_args(args, use_shlex=True):
     parser.add_argument('-o', '--outfile', required=False, help='outfile file [default: <infile>_<target>.xml]')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output [default: False]')
     parser.add_argument('-V', '--version', default=False, action='store_true', help='print the version')
+    parser.add_argument('--engine', default='tree', choices=ENGINES,
+                        help="'tree' migrates the whole document in memory; 'streaming' reads and writes one segment "
+                             "at a time to bound memory use; 'native' migrates in memory without XSLT where a "
+                             "migration supports it [default: tree]")
+    parser.add_argument('--mesh-workers', type=int, default=None,
+                        help='convert meshes in parallel using this many worker processes [default: serial]')
+    _add_mesh_arguments(parser)
+    parser.add_argument('--cache', dest='cache_dir',
+                        help='reuse outputs of identical earlier migrations stored in this directory '
+                             '[default: no cache]')
+    parser.add_argument('--cache-size', help='evict the least recently used outputs when the cache is bigger than this '
+                                             'e.g. 10G [default: no limit]')
+    parser.add_argument('--cache-link', default=False, action='store_true',
+                        help='hardlink cached outputs instead of copying them [default: False]')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='also keep converted meshes in the cache and reuse them when the rest of a file has to be '
+                             'migrated again; requires --cache [default: False]')
+    parser.add_argument('--no-passthrough', dest='passthrough', default=True, action='store_false',
+                        help='parse lattice data instead of copying it directly from the input to the output '
+                             '[default: False]')
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+                        help="compress the output; 'none' writes plain XML [default: implied by the extension of the "
+                             "outfile, which by default has the compression of the infile]")
+    _add_parser_arguments(parser)
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='report the time spent in each stage of the migration [default: False]')
+    parser.add_argument('--profile-format', default='text', choices=['text', 'json'],
+                        help='the format of the profile report [default: text]')
+    parser.add_argument('--profile-templates', default=False, action='store_true',
+                        help='add call counts and times for each XSL template to the profile; implies --profile '
+                             '[default: False]')
     parser.add_argument(
         '-l', '--list-versions',
         default=False,
@@ -58,11 +95,314 @@ def parse_args(args, use_shlex=True):
             return os.EX_USAGE
         else:
             if args.outfile is None:
-                args.outfile = get_output_name(args.infile, args.target_version, prefix="")
+                args.outfile = get_output_name(args.infile, args.target_version, prefix="", compression=args.compress)
+            if os.EX_USAGE in [_parse_cache_size(args), _parse_memory_limit(args), _parse_mesh_encoding(args)]:
+                return os.EX_USAGE
             return args
 
 
+def _parse_cache_size(args):
+    """Convert `args.cache_size` to bytes; the `cache` module is only imported if a size is given"""
+    if args.incremental and args.cache_dir is None:
+        _print("--incremental requires --cache")
+        return os.EX_USAGE
+    if args.cache_size is None:
+        return os.EX_OK
+    from .cache import parse_size
+    try:
+        args.cache_size = parse_size(args.cache_size)
+    except ValueError as e:
+        _print(str(e))
+        return os.EX_USAGE
+    return os.EX_OK
+
+
+def _add_parser_arguments(parser):
+    """Add the arguments which set parser options (see :py:mod:`sfftk_migrate.parsing`) to `parser`"""
+    parser.add_argument('--no-huge-tree', dest='huge_tree', default=None, action='store_const', const=False,
+                        help="keep libxml2's limits on the size of text nodes and depth of documents [default: False]")
+    parser.add_argument('--remove-blank-text', default=None, action='store_const', const=True,
+                        help='drop whitespace between elements while parsing to save memory; the output is re-indented '
+                             '[default: False]')
+    parser.add_argument('--mmap', dest='use_mmap', default=None, action='store_const', const=True,
+                        help='parse documents from a memory map of the input [default: False]')
+    parser.add_argument('--memory-limit',
+                        help='refuse to parse documents expected to need more memory than this e.g. 8G [default: the '
+                             'memory available]')
+
+
+def _parse_memory_limit(args):
+    """Convert `args.memory_limit` to bytes"""
+    if args.memory_limit is None:
+        return os.EX_OK
+    from .cache import parse_size
+    try:
+        args.memory_limit = parse_size(args.memory_limit)
+    except ValueError as e:
+        _print(str(e))
+        return os.EX_USAGE
+    return os.EX_OK
+
+
+def _add_mesh_arguments(parser):
+    """Add the arguments which set how meshes are encoded (see :py:func:`_parse_mesh_encoding`) to `parser`"""
+    parser.add_argument('--compact-meshes', default=False, action='store_true',
+                        help='drop mesh vertices which no triangle refers to and weld duplicate vertices [default: '
+                             'False]')
+    parser.add_argument('--mesh-encoding', metavar='ENCODING',
+                        help="the types used to encode meshes as comma-separated NAME=VALUE pairs where NAME is "
+                             "'vertices' (float32 or float64), 'triangles' (an integer type or 'auto' for the "
+                             "narrowest unsigned type for each mesh) or 'endianness' (little or big); 'auto' is short "
+                             "for 'triangles=auto' [default: vertices=float32,triangles=uint32,endianness=little]")
+
+
+def _parse_mesh_encoding(args):
+    """Convert `args.mesh_encoding` to a dictionary of `vertices_mode`, `triangles_mode` and `endianness`"""
+    if args.mesh_encoding is None:
+        return os.EX_OK
+    choices = dict(
+        vertices=[mode for mode in MODE if mode.startswith('float')],
+        triangles=[mode for mode in MODE if not mode.startswith('float')] + ['auto'],
+        endianness=list(ENDIANNESS),
+    )
+    encoding = dict()
+    for item in args.mesh_encoding.split(','):
+        name, sep, value = item.strip().partition('=')
+        if not sep and name == 'auto':
+            name, value = 'triangles', 'auto'
+        elif value not in choices.get(name, []):
+            _print("invalid mesh encoding '{}'; should be {} or 'auto'".format(item, ", ".join(
+                "{}={}".format(_name, "|".join(_choices)) for _name, _choices in choices.items())))
+            return os.EX_USAGE
+        encoding[name if name == 'endianness' else '{}_mode'.format(name)] = value
+    args.mesh_encoding = encoding
+    return os.EX_OK
+
+
+def parse_batch_args(args, use_shlex=True):
+    """Parse arguments for the `batch` subcommand
+
+    :param args: commands with options
+    :type args: list or str
+    :param bool use_shlex: use shell lexing on the input (string) [default: True]
+    :return: an argument namespace
+    :rtype: `argparse.Namespace`
+    """
+    if use_shlex:
+        _args = shlex.split(args)
+    else:
+        _args = args
+
+    parser = argparse.ArgumentParser(
+        prog='sff-migrate batch',
+        description='Upgrade many EMDB-SFF files to more recent schema using a pool of worker processes',
+    )
+    parser.add_argument('paths', nargs='*', help='input XML files, directories or glob patterns')
+    parser.add_argument('-m', '--manifest', help='a file listing one input file per line')
+    parser.add_argument('--pattern', default='*.sff',
+                        help='the pattern of files to migrate in directories [default: *.sff]')
+    parser.add_argument('-t', '--target-version', default=VERSION_LIST[-1],
+                        help='the target version to migrate to [default: {}]'.format(VERSION_LIST[-1]))
+    parser.add_argument('-d', '--outdir',
+                        help='output directory; the layout of input directories is mirrored [default: next to inputs]')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes; 0 migrates in this process [default: number of CPUs]')
+    parser.add_argument('--timeout', type=float, default=None, help='maximum number of seconds per file')
+    parser.add_argument('--max-files-per-worker', type=int, default=None,
+                        help='replace each worker with a fresh one after this many files [default: never]')
+    parser.add_argument('-p', '--param', action='append', default=list(), metavar='NAME=VALUE',
+                        help='an XSL param value; may be repeated')
+    parser.add_argument('-r', '--report', help='write per-file results to this JSON file')
+    _add_mesh_arguments(parser)
+    parser.add_argument('--cache', dest='cache_dir',
+                        help='reuse outputs of identical earlier migrations stored in this directory '
+                             '[default: no cache]')
+    parser.add_argument('--cache-size', help='evict the least recently used outputs when the cache is bigger than this '
+                                             'e.g. 10G [default: no limit]')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='also keep converted meshes in the cache and reuse them when the rest of a file has to be '
+                             'migrated again; requires --cache [default: False]')
+    parser.add_argument('--compress', choices=COMPRESSIONS,
+                        help="compress the outputs; 'none' writes plain XML [default: the compression of each input]")
+    _add_parser_arguments(parser)
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='report the time spent in each stage summed over all files [default: False]')
+    parser.add_argument('--profile-format', default='text', choices=['text', 'json'],
+                        help='the format of the profile report [default: text]')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output [default: False]')
+
+    args = parser.parse_args(_args)
+    if not args.paths and args.manifest is None:
+        parser.print_help()
+        return os.EX_USAGE
+    param_dict = dict()
+    for param in args.param:
+        name, sep, value = param.partition('=')
+        if not sep:
+            _print("invalid param '{}'; should be of the form NAME=VALUE".format(param))
+            return os.EX_USAGE
+        param_dict[name] = value
+    args.param_dict = param_dict
+    if os.EX_USAGE in [_parse_cache_size(args), _parse_memory_limit(args), _parse_mesh_encoding(args)]:
+        return os.EX_USAGE
+    return args
+
+
+def batch_main(argv):
+    """Entry point for `sff-migrate batch`"""
+    from .batch import collect_files, migrate_batch, summarise
+    args = parse_batch_args(argv, use_shlex=False)
+    if args == os.EX_USAGE:
+        return args
+    infiles = collect_files(args.paths, pattern=args.pattern, manifest=args.manifest)
+    # mirror the layout of a single input directory
+    root = args.paths[0] if len(args.paths) == 1 and os.path.isdir(args.paths[0]) else None
+    results = migrate_batch(
+        infiles, args.target_version, outdir=args.outdir, root=root, param_dict=args.param_dict,
+        workers=args.workers, timeout=args.timeout, maxtasksperchild=args.max_files_per_worker, verbose=args.verbose,
+        profile=args.profile, cache_dir=args.cache_dir, cache_size=args.cache_size, incremental=args.incremental,
+        parser_options=dict(huge_tree=args.huge_tree, remove_blank_text=args.remove_blank_text,
+                            use_mmap=args.use_mmap, memory_limit=args.memory_limit),
+        mesh_encoding=args.mesh_encoding, compact_meshes=args.compact_meshes, compress=args.compress,
+    )
+    if args.profile:
+        _print(format_report(
+            aggregate([result['profile'] for result in results if result.get('profile') is not None]),
+            format=args.profile_format,
+        ))
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+    return summarise(results)
+
+
+def parse_cache_args(args, use_shlex=True):
+    """Parse arguments for the `cache` subcommand
+
+    :param args: commands with options
+    :type args: list or str
+    :param bool use_shlex: use shell lexing on the input (string) [default: True]
+    :return: an argument namespace
+    :rtype: `argparse.Namespace`
+    """
+    if use_shlex:
+        _args = shlex.split(args)
+    else:
+        _args = args
+
+    parser = argparse.ArgumentParser(
+        prog='sff-migrate cache',
+        description='Inspect or prune a cache of migration outputs',
+    )
+    parser.add_argument('action', choices=['info', 'list', 'prune', 'clear'],
+                        help="'info' summarises the cache; 'list' lists entries, least recently used first; 'prune' "
+                             "evicts entries to satisfy --max-size and --max-age; 'clear' evicts all entries")
+    parser.add_argument('-c', '--cache', dest='cache_dir', required=True, help='the cache directory')
+    parser.add_argument('--max-size', default=None,
+                        help="the size to prune the cache to e.g. 10G [default: no limit]")
+    parser.add_argument('--max-age', type=float, default=None,
+                        help='also prune entries not used for this many days [default: no limit]')
+
+    args = parser.parse_args(_args)
+    from .cache import parse_size
+    try:
+        if args.max_size is not None:
+            args.max_size = parse_size(args.max_size)
+    except ValueError as e:
+        _print(str(e))
+        return os.EX_USAGE
+    if args.action == 'prune' and args.max_size is None and args.max_age is None:
+        _print("prune needs --max-size or --max-age; use 'clear' to evict all entries")
+        return os.EX_USAGE
+    return args
+
+
+def cache_main(argv):
+    """Entry point for `sff-migrate cache`"""
+    from .cache import ResultCache
+    args = parse_cache_args(argv, use_shlex=False)
+    if args == os.EX_USAGE:
+        return args
+    cache = ResultCache(args.cache_dir)
+    if args.action == 'info':
+        info = cache.info()
+        _print("{directory}: {entries} entries, {payloads} mesh payloads, {bytes} bytes".format(**info))
+    elif args.action == 'list':
+        for entry in cache.entries():
+            _print("{key} {size:>12} {last_used}".format(
+                key=entry['key'], size=entry['size'],
+                last_used=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used'])),
+            ))
+    else:
+        if args.action == 'clear':
+            evicted = cache.prune(max_bytes=0)
+        else:
+            evicted = cache.prune(
+                max_bytes=args.max_size, max_age=args.max_age * 86400 if args.max_age is not None else None,
+            )
+        _print("evicted {} entries ({} bytes)".format(len(evicted), sum(entry['size'] for entry in evicted)))
+    return os.EX_OK
+
+
+def parse_serve_args(args, use_shlex=True):
+    """Parse arguments for the `serve` subcommand
+
+    :param args: commands with options
+    :type args: list or str
+    :param bool use_shlex: use shell lexing on the input (string) [default: True]
+    :return: an argument namespace
+    :rtype: `argparse.Namespace`
+    """
+    if use_shlex:
+        _args = shlex.split(args)
+    else:
+        _args = args
+
+    parser = argparse.ArgumentParser(
+        prog='sff-migrate serve',
+        description='Run a migration daemon which accepts jobs over HTTP on a UNIX socket or a localhost port',
+    )
+    parser.add_argument('-S', '--socket', help='listen on this UNIX socket [default: listen on --host and --port]')
+    parser.add_argument('--host', default='127.0.0.1', help='the host to listen on [default: 127.0.0.1]')
+    parser.add_argument('--port', type=int, default=8765, help='the port to listen on [default: 8765]')
+    parser.add_argument('-j', '--workers', type=int, default=4, help='number of concurrent migrations [default: 4]')
+    parser.add_argument('-q', '--queue-size', type=int, default=16,
+                        help='number of jobs which may wait to run; further jobs are refused [default: 16]')
+    parser.add_argument('-t', '--target-version', default=VERSION_LIST[-1],
+                        help='the default target version [default: {}]'.format(VERSION_LIST[-1]))
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='verbose output [default: False]')
+
+    args = parser.parse_args(_args)
+    if args.workers < 1 or args.queue_size < 1:
+        _print("--workers and --queue-size should be at least 1")
+        return os.EX_USAGE
+    return args
+
+
+def serve_main(argv):
+    """Entry point for `sff-migrate serve`"""
+    from .serve import MigrationServer
+    args = parse_serve_args(argv, use_shlex=False)
+    if args == os.EX_USAGE:
+        return args
+    server = MigrationServer(
+        socket_path=args.socket, host=args.host, port=args.port, workers=args.workers, queue_size=args.queue_size,
+        target_version=args.target_version, verbose=args.verbose,
+    )
+    server.start()
+    _print("sff-migrate serving on {}".format(server.address))
+    server.serve_forever()
+    return os.EX_OK
+
+
 def main():
+    # the subcommands take precedence over input files of the same name, which can be migrated as e.g. `./batch`
+    if sys.argv[1:2] == ['batch']:
+        return batch_main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ['cache']:
+        return cache_main(sys.argv[2:])
     args = parse_args(sys.argv[1:], use_shlex=False)  # no shlex for list of args
     if args == os.EX_USAGE:
         return args
@@ -84,9 +424,15 @@ def main():
         ))
         status = os.EX_OK
     else:
+        from .migrate import do_migration
         if args.verbose:
             _print("migrating {} to {}...".format(args.infile, args.outfile))
-        status = do_migration(args)
+        if args.profile or args.profile_templates:
+            with profiling(templates=args.profile_templates) as profiler:
+                status = do_migration(args)
+            _print(format_report(profiler.report(), format=args.profile_format))
+        else:
+            status = do_migration(args)
     return status
 
 
@@ -4,29 +4,146 @@ migrate
 
 This module implements top-level functions that effect a migration.
 """
+import contextlib
+import itertools
 import os
-import shutil
+import threading
+import uuid
 import warnings
+from collections import OrderedDict
 
 from lxml import etree
 
-from . import VERSION_LIST
-from .core import get_source_version, get_migration_path, get_module, get_stylesheet, get_output_name
+from . import ENGINES
+from .cache import ResultCache, PayloadCache, get_key
+from .compression import get_output_compression, input_source, open_output
+from .core import get_source_version, get_migration_path, get_module, get_stylesheet, get_output_name, \
+    get_stylesheet_dependencies, parse_document
+from .parsing import DocumentTooLarge, iterparse, parser_options
+from .passthrough import Passthrough, PassthroughError
+from .rules import RuleSet, apply_rules
+from .timing import stage, is_profiling, get_profiler
 from .utils import _check, _print
 
 
-def get_params(param_list, value_list=None):
+# 'tree' migrates whole documents in memory; 'streaming' and 'native' use a module's `migrate_stream` or
+# `migrate_native`, respectively, where there is one, or its declarative `RULES`
+ENGINE_FUNCTIONS = {'streaming': 'migrate_stream', 'native': 'migrate_native'}
+# libxslt records template times in units of 1/XSLT_TIMESTAMP_TICS_PER_SEC seconds
+XSLT_TIMESTAMP_TICS_PER_SEC = 100000
+
+
+class StylesheetCache(object):
+    """A bounded, thread-safe, least-recently-used cache of compiled XSL transformers
+
+    Transformers are keyed by the absolute path of the stylesheet. Each entry records the modification time and size
+    of the stylesheet and of every stylesheet it includes or imports; the entry is recompiled whenever any of these
+    change.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._transforms = OrderedDict()  # path -> (signature, transform)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(paths):
+        signature = list()
+        for path in paths:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    @staticmethod
+    def _compile(path):
+        """Compile the stylesheet and list the files it depends on"""
+        stylesheet_doc = etree.parse(path)  # ElementTree
+        return etree.XSLT(stylesheet_doc), get_stylesheet_dependencies(path, stylesheet_doc)  # transformer
+
+    def get(self, stylesheet):
+        """Provide the compiled transformer for `stylesheet`, compiling it if necessary
+
+        :param str stylesheet: the name of an XSL file
+        :return: a transformer
+        :rtype: `lxml.etree.XSLT`
+        """
+        path = os.path.abspath(stylesheet)
+        with self._lock:
+            if path in self._transforms:
+                (signature, transform) = self._transforms[path]
+                try:
+                    current = self._signature(dependency for dependency, _, _ in signature)
+                except OSError:
+                    current = None
+                if current == signature:
+                    self._transforms.move_to_end(path)
+                    self.hits += 1
+                    return transform
+                del self._transforms[path]
+            self.misses += 1
+        # compile outside the lock; a concurrent miss on the same path simply compiles twice
+        transform, dependencies = self._compile(path)
+        signature = self._signature(dependencies)
+        with self._lock:
+            self._transforms[path] = (signature, transform)
+            self._transforms.move_to_end(path)
+            while len(self._transforms) > self.maxsize:
+                self._transforms.popitem(last=False)
+        return transform
+
+    def preload(self, stylesheets):
+        """Compile and cache each of `stylesheets`
+
+        :param list stylesheets: names of XSL files
+        """
+        for stylesheet in stylesheets:
+            self.get(stylesheet)
+
+    def invalidate(self, stylesheet=None):
+        """Drop `stylesheet` from the cache; drop everything if no stylesheet is specified
+
+        :param str stylesheet: the name of an XSL file
+        """
+        with self._lock:
+            if stylesheet is None:
+                self._transforms.clear()
+            else:
+                self._transforms.pop(os.path.abspath(stylesheet), None)
+
+    def info(self):
+        """Cache statistics
+
+        :return: a dictionary with `hits`, `misses`, `size` and `maxsize`
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._transforms), maxsize=self.maxsize)
+
+
+STYLESHEET_CACHE = StylesheetCache()
+
+
+def get_params(param_list, value_list=None, param_dict=None):
     """Collect additional params to be used for XSL params
 
     :param list param_list: a list of params; usually specified in the migration module with `PARAM_LIST` constant
     :param list value_list: a list of values to be used when constructing the params dictionary; if this is not
         provided then the user will be prompted to enter a value for each param
+    :param dict param_dict: a dictionary of param names to values; if this is provided then the user is never
+        prompted and a missing param raises a `ValueError`
     :return: a dictionary of params to be use in the XSL
     :rtype: dict
     """
     params = dict()
     for i, param in enumerate(param_list):
-        if value_list:
+        if param_dict is not None:
+            try:
+                param_value = param_dict[param]
+            except KeyError:
+                raise ValueError("no value provided for param '{}'".format(param))
+        elif value_list:
             try:
                 assert len(param_list) == len(value_list)
             except AssertionError:
@@ -41,56 +158,306 @@ def get_params(param_list, value_list=None):
 def migrate_by_stylesheet(original, stylesheet, verbose=False, **kwargs):
     """Migrate `original` according to `stylesheet`
 
-    :param str original: the name of an XML file
+    :param str original: the name of an XML file, which may be compressed
     :param str stylesheet: the name of an XSL file
     :return: the transformed XML document
     :rtype: bytes
     """
     _check(original, str, TypeError)
     _check(stylesheet, str, TypeError)
-    original_doc = etree.parse(original)  # ElementTree
-    original_elements = set([original_doc.getpath(element) for element in original_doc.iter()])
-    # _print('original_doc:', original_elements)
-    stylesheet_doc = etree.parse(stylesheet)  # ElementTree
-    transform = etree.XSLT(stylesheet_doc)  # transformer
-    _kwargs = dict()
-    for kw in kwargs:
-        _kwargs[kw] = etree.XSLT.strparam(kwargs[kw])
-    migrated = transform(original_doc, **_kwargs)  # XSLTResultTree (like ElementTree)
-    migrated_elements = set([migrated.getpath(element) for element in migrated.iter()])
-    # _print('migrated_doc:', migrated_elements)
-    dropped_fields = original_elements.difference(migrated_elements)
-    # _print('difference:', dropped_fields)
-    if dropped_fields and len(original_elements) > len(migrated_elements) and verbose:
-        warnings.warn(
-            UserWarning('the migration has resulted in the following fields being dropped: {dropped_fields} '
-                        '+ {num_others} others'.format(
-                dropped_fields=', '.join(list(dropped_fields)[:10]),
-                num_others=len(dropped_fields) - 10,
-            )),
+    with stage('migrate_by_stylesheet'):
+        original_doc = parse_document(original)  # ElementTree
+        migrated = transform_by_stylesheet(original_doc, stylesheet, verbose=verbose, **kwargs)
+        with stage('serialize') as _stage:
+            migrated_bytes = etree.tostring(migrated, pretty_print=True, xml_declaration=True)
+            _stage.count(bytes_written=len(migrated_bytes))
+    return migrated_bytes
+
+
+def transform_by_stylesheet(original_doc, stylesheet, verbose=False, profile_templates=None, **kwargs):
+    """Transform an already parsed document according to `stylesheet`
+
+    Unlike :py:func:`migrate_by_stylesheet` this neither parses nor serialises the document so that callers which
+    already hold the source tree can work on the result tree in place.
+
+    :param original_doc: the source document
+    :type original_doc: `lxml.etree._ElementTree`
+    :param str stylesheet: the name of an XSL file
+    :param bool verbose: warn about fields dropped by the migration; see :py:func:`get_dropped_fields`
+    :param bool profile_templates: run the transform with template profiling on; the profile is then available from
+        :py:func:`get_template_profile`; by default templates are profiled if the active profiler (see
+        :py:func:`sfftk_migrate.timing.profiling`) asks for it, in which case the profile is added to its report
+    :return: the transformed document
+    :rtype: `lxml.etree._XSLTResultTree`
+    """
+    _check(stylesheet, str, TypeError)
+    profiler = get_profiler()
+    if profile_templates is None:
+        profile_templates = profiler is not None and profiler.profile_templates
+    with stage('transform_by_stylesheet'):
+        with stage('compile'):
+            transform = STYLESHEET_CACHE.get(stylesheet)  # transformer
+        _kwargs = dict()
+        for kw in kwargs:
+            _kwargs[kw] = etree.XSLT.strparam(kwargs[kw])
+        with stage('xslt') as _stage:
+            migrated = transform(original_doc, profile_run=profile_templates, **_kwargs)  # XSLTResultTree
+            if is_profiling():
+                _stage.count(elements=sum(1 for _ in migrated.iter()))
+        if profile_templates and profiler is not None and profiler.profile_templates:
+            profiler.add_templates(stylesheet, get_template_profile(migrated))
+    # the dropped-field analysis walks both documents so we only do it when asked to
+    if verbose:
+        with stage('dropped_fields'):
+            dropped_fields = get_dropped_fields(original_doc, migrated)
+        if dropped_fields:
+            warnings.warn(
+                UserWarning('the migration has resulted in the following fields being dropped: {dropped_fields} '
+                            '+ {num_others} others'.format(
+                    dropped_fields=', '.join('{} ({})'.format(path, count) for path, count in
+                                             list(dropped_fields.items())[:10]),
+                    num_others=max(len(dropped_fields) - 10, 0),
+                )),
+            )
+    return migrated
+
+
+def _transform_fragment(transform, path, fragment, kwargs):
+    """Transform `fragment` as though it were a child of the element at `path` (a list of tags from the root)
+
+    Stylesheets match on absolute paths so the fragment is transformed within a skeleton of its ancestors.
+
+    :return: the transformed counterpart of the innermost ancestor or `None` if the stylesheet dropped it
+    """
+    wrapper = etree.Element(path[0])
+    parent = wrapper
+    for tag in path[1:]:
+        parent = etree.SubElement(parent, tag)
+    parent.append(fragment)
+    migrated = transform(etree.ElementTree(wrapper), **kwargs).getroot()
+    for _ in path[1:]:
+        if migrated is None:
+            break
+        migrated = next(migrated.iterchildren(tag=etree.Element), None)
+    return migrated
 
+
+def stream_by_stylesheet(infile, outfile, stylesheet, lists=(), migrate_item=None, encoding='UTF-8', compression=None,
+                         **kwargs):
+    """Migrate `infile` to `outfile` according to `stylesheet` in bounded memory
+
+    The source is read incrementally and every child of the root element is transformed and written out as soon as it
+    is complete, after which it is discarded. The items of the lists named in `lists` (e.g. the segments of the
+    `segmentList`) are transformed and written one at a time so that memory is bounded by the largest item rather than
+    by the whole list. The stylesheet must transform list items independently of their siblings. Compressed sources
+    are decompressed as they are read.
+
+    :param str infile: the name of the source file
+    :param str outfile: the name of the output file
+    :param str stylesheet: the name of an XSL file
+    :param lists: the tags of children of the root element whose items are streamed
+    :param migrate_item: a callable which is passed each source list item and its transformed counterpart to finish
+        the migration of the item in place e.g. to convert meshes
+    :param str encoding: the output encoding [default: 'UTF-8']
+    :param str compression: the compression of the output (see :py:mod:`sfftk_migrate.compression`) [default: None]
+    :return: the name of the output file
+    :rtype: str
+    """
+    _check(infile, str, TypeError)
+    _check(stylesheet, str, TypeError)
+    transform = STYLESHEET_CACHE.get(stylesheet)
+    _kwargs = dict((kw, etree.XSLT.strparam(value)) for kw, value in kwargs.items())
+    with stage('stream_by_stylesheet') as _stage:
+        with input_source(infile) as source, open_output(outfile, compression) as f:
+            events = iterparse(source, events=('start', 'end'))
+            _, root = next(events)
+            with etree.xmlfile(f, encoding=encoding) as xf:
+                xf.write_declaration()
+                with xf.element(root.tag, dict(root.attrib), nsmap=root.nsmap):
+                    # the tail of a child is only complete at the start of its next sibling so it is written out then
+                    pending = None
+                    for event, element in events:
+                        if event == 'start':
+                            if element.getparent() is not root:
+                                continue
+                            if pending is None:
+                                xf.write(root.text or '')
+                            else:
+                                _write_fragment(xf, transform, root, pending, lists, _kwargs)
+                                pending = None
+                            if element.tag in lists:
+                                _stream_list(xf, events, transform, root, element, migrate_item, _kwargs, _stage)
+                                pending = element
+                        elif element is root:
+                            if pending is not None:
+                                _write_fragment(xf, transform, root, pending, lists, _kwargs)
+                        elif element.getparent() is root:
+                            pending = element
+            # a final newline as for documents written whole
+            f.write(b'\n')
+    return outfile
+
+
+def _write_fragment(xf, transform, root, element, lists, kwargs):
+    """Write out the transformed child `element` of `root` including its tail; streamed lists only need their tail"""
+    if element.tag in lists:
+        xf.write(element.tail or '')
+        root.remove(element)
+    else:
+        # the element (and its tail) is moved out of the source tree and into the fragment
+        migrated_root = _transform_fragment(transform, [root.tag], element, kwargs)
+        xf.write(migrated_root.text or '', *migrated_root)
+
+
+def _stream_list(xf, events, transform, root, list_element, migrate_item, kwargs, _stage):
+    """Transform and write out the items of `list_element` one at a time, consuming events up to the end of the list"""
+    # an empty list tells us what the list becomes and the text that closes it
+    probe = etree.Element(list_element.tag, dict(list_element.attrib))
+    migrated_root = _transform_fragment(transform, [root.tag], probe, kwargs)
+    migrated_list = next(migrated_root.iterchildren(tag=etree.Element), None)
+    if migrated_list is None:
+        context = contextlib.ExitStack()
+    else:
+        context = xf.element(migrated_list.tag, dict(migrated_list.attrib))
+    with context:
+        for event, element in events:
+            if event != 'end':
+                continue
+            if element is list_element:
+                if migrated_list is not None:
+                    xf.write(migrated_list.text or '')
+                return
+            if element.getparent() is not list_element:
+                continue
+            container = _transform_fragment(transform, [root.tag, list_element.tag], element, kwargs)
+            if migrated_list is not None and container is not None:
+                for migrated in container.iterchildren(tag=etree.Element):
+                    if migrate_item is not None:
+                        migrate_item(element, migrated)
+                    migrated.tail = None
+                    xf.write(container.text or '', migrated)
+            _stage.count(items=1)
+
+
+def get_template_profile(migrated):
+    """Per-template call counts and times for a transform run with `profile_templates=True`
+
+    :param migrated: the result of :py:func:`transform_by_stylesheet`
+    :type migrated: `lxml.etree._XSLTResultTree`
+    :return: a list of dictionaries with keys `match`, `name`, `mode`, `calls`, `seconds` (cumulative) and
+        `average_seconds` ordered from the most to the least expensive template
+    :rtype: list
+    """
+    if migrated.xslt_profile is None:
+        raise ValueError("the transform was not run with template profiling")
+    templates = list()
+    # the profile document is built by libxslt outside lxml's name dictionary so tag lookups with iter() fail
+    for template in migrated.xslt_profile.getroot():
+        if template.tag != 'template':
+            continue
+        templates.append(OrderedDict([
+            ('match', template.get('match', '')),
+            ('name', template.get('name', '')),
+            ('mode', template.get('mode', '')),
+            ('calls', int(template.get('calls'))),
+            ('seconds', int(template.get('time')) / XSLT_TIMESTAMP_TICS_PER_SEC),
+            ('average_seconds', int(template.get('average')) / XSLT_TIMESTAMP_TICS_PER_SEC),
+        ]))
+    return sorted(templates, key=lambda template: template['seconds'], reverse=True)
+
+
+def count_tag_paths(doc):
+    """Count the elements in `doc` by tag path
+
+    The tag path of an element is the sequence of tags from the root to the element without positional predicates
+    e.g. all `<v>` elements in all meshes share the path `/segmentation/segmentList/segment/meshList/mesh/vertexList/v`.
+
+    :param doc: an XML document
+    :type doc: `lxml.etree._ElementTree`
+    :return: a dictionary of tag paths to element counts in document order
+    :rtype: `collections.OrderedDict`
+    """
+    counts = OrderedDict()
+    root = doc.getroot()
+    stack = [(root, '/' + root.tag)]
+    while stack:
+        element, path = stack.pop()
+        counts[path] = counts.get(path, 0) + 1
+        # push in reverse so that children are visited in document order
+        stack.extend(
+            (child, path + '/' + child.tag) for child in reversed(element) if isinstance(child.tag, str)
         )
-    return etree.tostring(migrated, pretty_print=True, xml_declaration=True)
+    return counts
+
+
+def get_dropped_fields(original_doc, migrated_doc):
+    """Report the fields (elements) present in `original_doc` which are missing from `migrated_doc`
+
+    Both documents are walked exactly once and summarised by tag path so that the report is compact even for
+    documents with millions of elements. Renamed elements are reported as dropped.
+
+    :param original_doc: the source document
+    :type original_doc: `lxml.etree._ElementTree`
+    :param migrated_doc: the migrated document
+    :type migrated_doc: `lxml.etree._ElementTree`
+    :return: a dictionary of tag paths to the number of elements dropped at each path
+    :rtype: `collections.OrderedDict`
+    """
+    original_counts = count_tag_paths(original_doc)
+    migrated_counts = count_tag_paths(migrated_doc)
+    dropped_fields = OrderedDict()
+    if sum(original_counts.values()) <= sum(migrated_counts.values()):
+        return dropped_fields
+    for path, count in original_counts.items():
+        dropped = count - migrated_counts.get(path, 0)
+        if dropped > 0:
+            dropped_fields[path] = dropped
+    return dropped_fields
 
 
-def do_migration(args, value_list=None, version_list=VERSION_LIST):
+def do_migration(args, value_list=None, version_list=None, param_dict=None):
     """Top-level function to effect a migration given `args`
 
-    Effect the requested migration according to the `version_list`. Passes all `kwargs` on to the
-    actual `migrate` function. `kwargs` should be a dictionary with string values.
+    Effect the requested migration along the migration path (see :py:func:`sfftk_migrate.core.get_migration_path`).
+    Passes all `kwargs` on to the actual `migrate` function. `kwargs` should be a dictionary with string values.
 
     :param args: argument namespace
     :type args: `argparse.Namespace`
     :param list value_list: a list of values to be used for XSL params
-    :param list version_list: the ordered sequence of versions (oldest to latest) to be considered
-    :return: status using `os` exit codes
+    :param list version_list: the ordered sequence of versions (oldest to latest) to be considered; by default the
+        cheapest path through the registered migrations is used (see :py:mod:`sfftk_migrate.registry`)
+    :param dict param_dict: XSL param values by name; use this to avoid prompting for params
+    :return: status using `os` exit codes; `os.EX_UNAVAILABLE` if the document is not expected to fit in memory
     :rtype: int
     """
+    with stage('do_migration'), parser_options(**_get_parser_options(args)):
+        try:
+            return _do_migration(args, value_list=value_list, version_list=version_list, param_dict=param_dict)
+        except DocumentTooLarge as dtl:
+            _print(str(dtl))
+            return os.EX_UNAVAILABLE
+
+
+def _get_parser_options(args):
+    """The parser options set on `args` (see :py:mod:`sfftk_migrate.parsing`); unset options are `None`"""
+    return dict(
+        huge_tree=getattr(args, 'huge_tree', None),
+        remove_blank_text=getattr(args, 'remove_blank_text', None),
+        use_mmap=getattr(args, 'use_mmap', None),
+        memory_limit=getattr(args, 'memory_limit', None),
+    )
+
+
+def _do_migration(args, value_list=None, version_list=None, param_dict=None):
     try:
         source_version = get_source_version(args.infile)
     except OSError:
         _print("Unable to read {}; please ensure it exists".format(args.infile))
         return os.EX_IOERR
+    if source_version == args.target_version:
+        # the version is sniffed from the start of the file so we never parse the whole of an up-to-date file
+        _print("{} is already at version {}".format(args.infile, source_version))
+        return os.EX_OK
     migration_path = get_migration_path(source_version, args.target_version, version_list=version_list)
     if not migration_path:
         _print("Empty migration path for version {}".format(source_version))
@@ -99,28 +466,299 @@ def do_migration(args, value_list=None, version_list=VERSION_LIST):
         _print("migration path: ")
         for _path in migration_path:
             _print("* {} ---> {}".format(*_path))
-    infile = args.infile
-    outfile = None
-    for source, target in migration_path:
-        if args.verbose:
-            _print("preparing to migrate v{source} to v{target}...".format(
-                source=source,
-                target=target,
-            ))
-        module = get_module(source, target)
-        if 'PARAM_LIST' in dir(module):
-            params = get_params(module.PARAM_LIST, value_list=value_list)
+    engine = getattr(args, 'engine', 'tree')
+    try:
+        assert engine in ENGINES
+    except AssertionError:
+        raise ValueError("invalid engine: {}".format(engine))
+    # fail before migrating if the compression is invalid
+    get_output_compression(args)
+    with stage('load_modules'):
+        modules = [get_module(source, target) for source, target in migration_path]
+    cache = _get_cache(args)
+    if cache is not None:
+        # the params are part of the key so they are collected once, up front
+        param_dict = _get_path_params(modules, value_list=value_list, param_dict=param_dict)
+        with stage('cache_lookup') as _stage:
+            key = get_key(args.infile, [(source, target, _find_stylesheet(source, target), module) for
+                                        (source, target), module in zip(migration_path, modules)],
+                          args.target_version, params=param_dict, engine=engine, options=_get_output_options(args))
+            hit = cache.get(key, args.outfile)
+            _stage.count(hits=int(hit))
+        if hit:
+            if args.verbose:
+                _print("using the cached output for {}".format(args.infile))
+            return os.EX_OK
+    passthrough = _get_passthrough(args, modules, engine)
+    if passthrough is not None:
+        # a migration which has to be repeated without pass-through should not prompt for params again
+        param_dict = _get_path_params(modules, value_list=value_list, param_dict=param_dict)
+        try:
+            _migrate_path(args, migration_path, modules, engine, passthrough, value_list=value_list,
+                          param_dict=param_dict)
+        except PassthroughError as pe:
+            if args.verbose:
+                _print("{}; migrating without pass-through...".format(pe))
+            passthrough = None
+    if passthrough is None:
+        _migrate_path(args, migration_path, modules, engine, None, value_list=value_list, param_dict=param_dict)
+    if cache is not None:
+        with stage('cache_store'):
+            cache.put(key, args.outfile)
+    return os.EX_OK
+
+
+def _migrate_path(args, migration_path, modules, engine, passthrough, value_list=None, param_dict=None):
+    """Migrate `args.infile` along `migration_path` and write the result to `args.outfile`
+
+    :raises: :py:class:`sfftk_migrate.passthrough.PassthroughError` if `passthrough` payloads could not be written
+    """
+    # `current` is either the name of a file or, for modules that implement `migrate_tree`, an in-memory tree
+    current = args.infile if passthrough is None else passthrough.parse()
+    temporary_files = list()
+    try:
+        hop = 0
+        # consecutive hops which are migrated by rules are fused into a single pass
+        for uses_rules, hops in itertools.groupby(zip(migration_path, modules),
+                                                  key=lambda hop: _uses_rules(hop[1], engine)):
+            hops = list(hops)
+            if uses_rules:
+                hop += len(hops)
+                versions = [source for (source, _), _ in hops] + [hops[-1][0][1]]
+                with stage('hop ' + '->'.join('v{}'.format(version) for version in versions)):
+                    current = _migrate_rules(args, hops, current, hop == len(migration_path), temporary_files,
+                                             value_list=value_list, param_dict=param_dict)
+                continue
+            for (source, target), module in hops:
+                hop += 1
+                with stage('hop v{}->v{}'.format(source, target)):
+                    current = _migrate_hop(args, source, target, module, engine, current, hop == len(migration_path),
+                                           temporary_files, value_list=value_list, param_dict=param_dict)
+        if passthrough is not None:
+            if args.verbose:
+                _print("writing output with {} pass-through payload(s) to {}...".format(
+                    len(passthrough.ranges), args.outfile))
+            passthrough.write(current, args.outfile, compression=get_output_compression(args))
+        elif isinstance(current, str):
+            os.replace(current, args.outfile)
         else:
-            params = dict()  # empty dictionary
-        stylesheet = get_stylesheet(source, target)
+            if args.verbose:
+                _print("writing output to {}...".format(args.outfile))
+            write_tree(current, args.outfile, compression=get_output_compression(args))
+    finally:
+        for temporary_file in temporary_files:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+
+def _get_passthrough(args, modules, engine):
+    """The payloads of `args.infile` to pass through to the output or `None`
+
+    Payloads are passed through when every module on the migration path lists the elements whose text it copies
+    verbatim in `PASSTHROUGH`. The streaming engine, which bounds memory use by itself, reads the input directly, as
+    do migrations of compressed inputs.
+    """
+    if not getattr(args, 'passthrough', True) or engine == 'streaming':
+        return None
+    if not modules or not all(hasattr(module, 'PASSTHROUGH') and not _uses_rules(module, engine) for module in modules):
+        return None
+    try:
+        return Passthrough.scan(args.infile, modules[0].PASSTHROUGH)
+    except PassthroughError as pe:
+        if args.verbose:
+            _print("{}; migrating without pass-through...".format(pe))
+        return None
+
+
+def _get_output_options(args):
+    """Options on `args` other than the params and engine which change the output of a migration"""
+    options = dict()
+    if getattr(args, 'remove_blank_text', None):
+        options['remove_blank_text'] = True
+    if getattr(args, 'mesh_encoding', None):
+        options['mesh_encoding'] = sorted(args.mesh_encoding.items())
+    if getattr(args, 'compact_meshes', False):
+        options['compact_meshes'] = True
+    if get_output_compression(args) is not None:
+        options['compression'] = get_output_compression(args)
+    return options
+
+
+def _get_cache(args):
+    """The result cache named by `args.cache_dir` (see :py:mod:`sfftk_migrate.cache`) or `None`"""
+    cache_dir = getattr(args, 'cache_dir', None)
+    if cache_dir is None:
+        return None
+    return ResultCache(cache_dir, max_bytes=getattr(args, 'cache_size', None), link=getattr(args, 'cache_link', False))
+
+
+def get_payload_cache(args):
+    """The cache of encoded mesh payloads used when `args.incremental` is set or `None`
+
+    The payloads are kept in the result cache named by `args.cache_dir`; see
+    :py:class:`sfftk_migrate.cache.PayloadCache`.
+    """
+    cache_dir = getattr(args, 'cache_dir', None)
+    if cache_dir is None or not getattr(args, 'incremental', False):
+        return None
+    return PayloadCache(cache_dir)
+
+
+def _find_stylesheet(source, target):
+    """The stylesheet of a hop or `None` for hops without one"""
+    try:
+        return get_stylesheet(source, target)
+    except OSError:
+        return None
+
+
+def _get_path_params(modules, value_list=None, param_dict=None):
+    """The values of the params of all `modules` as a single dictionary; see :py:func:`get_params`"""
+    params = dict()
+    for module in modules:
+        params.update(_get_module_params(module, value_list=value_list, param_dict=param_dict))
+    return params
+
+
+def _uses_rules(module, engine):
+    """Whether `module` is migrated using its declarative `RULES`
+
+    Rules are always used by modules that have no other means of migration; modules that also have a stylesheet-based
+    migration use the rules with any engine other than the default.
+    """
+    if not hasattr(module, 'RULES'):
+        return False
+    return engine != 'tree' or not (hasattr(module, 'migrate_tree') or hasattr(module, 'migrate'))
+
+
+def _get_module_params(module, value_list=None, param_dict=None):
+    """The values of the params used by `module`; see :py:func:`get_params`"""
+    if 'PARAM_LIST' in dir(module):
+        return get_params(module.PARAM_LIST, value_list=value_list, param_dict=param_dict)
+    if hasattr(module, 'RULES'):
+        return get_params(RuleSet(module.RULES).params, value_list=value_list, param_dict=param_dict)
+    return dict()  # empty dictionary
+
+
+def _as_file(args, current, source, temporary_files):
+    """Write `current` to a temporary file if it is a tree; files are passed through
+
+    Temporary files are compressed like the output so that compressed migrations write no uncompressed files.
+    """
+    if isinstance(current, str):
+        return current
+    infile = _temporary_name(get_output_name(args.infile, source))
+    temporary_files.append(infile)
+    write_tree(current, infile, compression=get_output_compression(args))
+    return infile
+
+
+def _get_hop_outfile(args, current, target, last, temporary_files):
+    """The name of the file to write the output of a file-based hop to"""
+    # the last hop writes next to the final output so that it can be renamed into place; temporary names are unique so
+    # that concurrent migrations of the same file do not clash
+    if last:
+        outfile = _temporary_name(args.outfile)
+    else:
+        outfile = _temporary_name(get_output_name(current, target))
+    temporary_files.append(outfile)
+    return outfile
+
+
+def _migrate_rules(args, hops, current, last, temporary_files, value_list=None, param_dict=None):
+    """Perform consecutive hops that are migrated by rules in a single streaming pass
+
+    :return: the name of the (temporary) output file
+    """
+    (source, _), _ = hops[0]
+    (_, target), _ = hops[-1]
+    if args.verbose:
+        _print("applying the rules for {} in a single pass...".format(
+            ", ".join("v{} to v{}".format(*path) for path, _ in hops)))
+    rule_sets = [RuleSet(module.RULES) for _, module in hops]
+    params_list = [_get_module_params(module, value_list=value_list, param_dict=param_dict) for _, module in hops]
+    current = _as_file(args, current, source, temporary_files)
+    outfile = _get_hop_outfile(args, current, target, last, temporary_files)
+    with stage('migrate') as _stage:
+        apply_rules(current, outfile, rule_sets, params_list=params_list, compression=get_output_compression(args))
+        if is_profiling():
+            _stage.count(bytes_written=os.path.getsize(outfile))
+    return outfile
+
+
+def _migrate_hop(args, source, target, module, engine, current, last, temporary_files, value_list=None,
+                 param_dict=None):
+    """Perform a single hop of a migration
+
+    :return: the migrated document as either a tree or the name of a (temporary) file
+    """
+    if args.verbose:
+        _print("preparing to migrate v{source} to v{target}...".format(
+            source=source,
+            target=target,
+        ))
+    params = _get_module_params(module, value_list=value_list, param_dict=param_dict)
+    stylesheet = get_stylesheet(source, target)
+    if args.verbose:
+        _print("using stylesheet {}...".format(stylesheet))
+    if engine in ENGINE_FUNCTIONS and not hasattr(module, ENGINE_FUNCTIONS[engine]):
         if args.verbose:
-            _print("using stylesheet {}...".format(stylesheet))
-        outfile = get_output_name(infile, target)
+            _print("no {} migration for v{} to v{}; using the default engine".format(engine, source, target))
+        engine = 'tree'
+    streaming = engine == 'streaming'
+    if engine == 'native' or (hasattr(module, 'migrate_tree') and not streaming):
+        if isinstance(current, str):
+            current = parse_document(current)
         if args.verbose:
-            _print("migrating to {}".format(outfile))
-        infile = module.migrate(infile, outfile, stylesheet, args, **params)
-    # only copy if the last file is not the same as the expected final output
-    if args.outfile != outfile:
-        shutil.copy(outfile, args.outfile)
-        os.remove(outfile)
-    return os.EX_OK
+            _print("migrating in memory")
+        with stage('migrate'):
+            if engine == 'native':
+                return module.migrate_native(current, args, **params)
+            return module.migrate_tree(current, stylesheet, args, **params)
+    # modules which only implement the file-based `migrate` need a file to read
+    current = _as_file(args, current, source, temporary_files)
+    outfile = _get_hop_outfile(args, current, target, last, temporary_files)
+    if args.verbose:
+        _print("migrating to {}".format(outfile))
+    with stage('migrate') as _stage:
+        if streaming:
+            outfile = module.migrate_stream(current, outfile, stylesheet, args, **params)
+        else:
+            outfile = module.migrate(current, outfile, stylesheet, args, **params)
+        if is_profiling():
+            _stage.count(bytes_written=os.path.getsize(outfile))
+    return outfile
+
+
+def _temporary_name(outfile):
+    """A unique temporary file name in the same directory as `outfile` so that it can be atomically renamed"""
+    return os.path.join(
+        os.path.dirname(os.path.abspath(outfile)),
+        '.{}.{}.tmp'.format(os.path.basename(outfile), uuid.uuid4().hex),
+    )
+
+
+def write_tree(tree, outfile, encoding='utf-8', compression=None):
+    """Atomically write `tree` to `outfile`
+
+    The document is written to a temporary file in the same directory which is then renamed to `outfile` so that
+    readers never see a partially written file.
+
+    :param tree: the document to write
+    :type tree: `lxml.etree._ElementTree`
+    :param str outfile: the name of the output file
+    :param str encoding: the output encoding [default: 'utf-8']
+    :param str compression: the compression of the output (see :py:mod:`sfftk_migrate.compression`) [default: None]
+    """
+    name = _temporary_name(outfile)
+    try:
+        with stage('write') as _stage:
+            with open_output(name, compression) as f:
+                tree.write(f, xml_declaration=True, encoding=encoding, pretty_print=True)
+            if is_profiling():
+                _stage.count(bytes_written=os.path.getsize(name))
+        os.replace(name, outfile)
+    except Exception:
+        if os.path.exists(name):
+            os.remove(name)
+        raise
@@ -0,0 +1,15 @@
+"""
+migrations
+==========
+
+Each module in this package named `migrate_v{source}_to_v{target}` (dots replaced by underscores) migrates
+documents from `source` to `target`; see :py:mod:`sfftk_migrate.registry`. A migration may skip versions.
+
+`COSTS` holds the relative cost of migrations keyed by `(source, target)`; migrations which are not listed cost
+`1.0`. When several paths lead to the target the cheapest is used so a shortcut should be given a cost lower than
+the sum of the costs of the hops it replaces.
+"""
+
+COSTS = {
+    ('0.7.0.dev0', '0.8.0.dev1'): 1.0,
+}
@@ -1,51 +1,289 @@
 import base64
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
 import struct
+import sys
+from copy import deepcopy
 
 from lxml import etree
 
 from .. import ENDIANNESS, MODE
-from ..migrate import migrate_by_stylesheet
+from ..compression import get_output_compression, open_output
+from ..core import parse_document
+from ..migrate import transform_by_stylesheet, stream_by_stylesheet, get_payload_cache
+from ..timing import stage, is_profiling
 from ..utils import _print
 
+try:
+    import numpy
+except ImportError:  # numpy is optional; we fall back to the pure-Python mesh engine
+    numpy = None
 
-def migrate_mesh(mesh, vertices_mode="float32", triangles_mode="uint32", endianness="little"):
-    """Given a mesh from the v0.7.0.dev0 we convert it to a mesh in v0.8.0.dev1"""
+MESH_ENGINES = ["auto", "numpy", "python"]
+# change this whenever the encoding of meshes changes so that cached payloads are not reused
+MESH_PAYLOAD_VERSION = '2'
+TRIANGLES_MODES = ["int8", "uint8", "int16", "uint16", "int32", "uint32", "int64", "uint64"]
+# the candidates for triangles_mode="auto", narrowest first
+AUTO_TRIANGLES_MODES = ["uint8", "uint16", "uint32", "uint64"]
+VERTICES_MODES = ["float32", "float64"]
+# the largest finite values of the vertices modes
+FLOAT_MAX = {"float32": 3.4028234663852886e+38, "float64": sys.float_info.max}
+# the encoding of meshes unless overridden by `args.mesh_encoding` (see :py:func:`get_mesh_encoding`)
+DEFAULT_MESH_ENCODING = dict(vertices_mode="float32", triangles_mode="uint32", endianness="little")
+# every engine copies the (base64-encoded) data of lattices verbatim; see :py:mod:`sfftk_migrate.passthrough`
+PASSTHROUGH = ['/segmentation/latticeList/lattice/data']
+
+
+def migrate_mesh(mesh, vertices_mode="float32", triangles_mode="uint32", endianness="little", engine="auto",
+                 compact=False):
+    """Given a mesh from the v0.7.0.dev0 we convert it to a mesh in v0.8.0.dev1
+
+    :param mesh: a `mesh` element from a v0.7.0.dev0 document
+    :param str vertices_mode: the type used to encode vertices and normals [default: 'float32']
+    :param str triangles_mode: the type used to encode triangles; 'auto' uses the narrowest unsigned type which can
+        represent the largest vertex index of the mesh [default: 'uint32']
+    :param str endianness: the endianness of the encoded data [default: 'little']
+    :param str engine: one of 'auto', 'numpy' or 'python'; 'auto' uses numpy if it is installed [default: 'auto']
+    :param bool compact: drop vertices which no triangle refers to and weld vertices whose encoded surface and normal
+        coordinates are identical [default: False]
+    :return: a tuple of `vertices`, `normals` and `triangles` elements
+    """
+    payload = encode_mesh(mesh, vertices_mode=vertices_mode, triangles_mode=triangles_mode, endianness=endianness,
+                          engine=engine, compact=compact)
+    return _mesh_elements(payload, vertices_mode, triangles_mode, endianness)
+
+
+def get_mesh_encoding(args):
+    """The encoding of meshes for a migration: :py:data:`DEFAULT_MESH_ENCODING` updated with `args.mesh_encoding`
+
+    :param args: argument namespace; `args.mesh_encoding` is an optional dictionary with any of `vertices_mode`,
+        `triangles_mode` and `endianness`
+    :type args: `argparse.Namespace`
+    :return: keyword arguments for :py:func:`encode_mesh`
+    :rtype: dict
+    """
+    return dict(DEFAULT_MESH_ENCODING, **(getattr(args, 'mesh_encoding', None) or dict()))
+
+
+def get_triangles_mode(max_index):
+    """The narrowest unsigned type which can represent the vertex index `max_index`
+
+    :param int max_index: the largest vertex index of a mesh
+    :return: one of :py:data:`AUTO_TRIANGLES_MODES`
+    :rtype: str
+    """
+    for triangles_mode in AUTO_TRIANGLES_MODES:
+        if max_index < 2 ** (8 * struct.calcsize(MODE[triangles_mode])):
+            return triangles_mode
+    raise ValueError("vertex index too large to encode: {}".format(max_index))
+
+
+def encode_mesh(mesh, vertices_mode="float32", triangles_mode="uint32", endianness="little", engine="auto",
+                compact=False):
+    """Encode the geometry of a v0.7.0.dev0 mesh
+
+    The arguments are the same as for :py:func:`migrate_mesh`.
+
+    :return: `None` if the mesh has no geometry otherwise a payload tuple of base64-encoded vertices, the number of
+        vertices, base64-encoded normals, the number of normals, base64-encoded triangles, the number of triangles and
+        the type used to encode the triangles (which is only different from `triangles_mode` when it is 'auto')
+    :rtype: tuple
+    """
+    _check_encoding(vertices_mode, triangles_mode, endianness, engine)
+    try:
+        vertex_list = next(mesh.iter("vertexList"))
+    except StopIteration:
+        # no geometry
+        return None
+    vertices, polygons = _get_geometry(mesh, vertex_list)
+    return _encode_geometry(vertices, polygons, vertices_mode, triangles_mode, endianness, engine, compact=compact)
+
+
+def _check_encoding(vertices_mode, triangles_mode, endianness, engine):
+    """Raise a `ValueError` for an invalid encoding or engine"""
     # assertions
     try:
         assert endianness in ["little", "big"]
     except AssertionError:
         raise ValueError("invalid endianness: {}".format(endianness))
     try:
-        assert triangles_mode in ["int8", "uint8", "int16", "uint16", "int32", "uint32", "int64", "uint64"]
+        assert triangles_mode in TRIANGLES_MODES + ["auto"]
     except AssertionError:
         raise ValueError("invalid triangles mode: {}".format(triangles_mode))
     try:
-        assert vertices_mode in ["float32", "float64"]
+        assert vertices_mode in VERTICES_MODES
     except AssertionError:
         raise ValueError("invalid vertices mode: {}".format(vertices_mode))
-
-    surface_vertex_dict = dict()  # dictionary to remap vertex ids
-    surface_vertices = list()
-    normal_vertices = list()
     try:
-        vertex_list = next(mesh.iter("vertexList"))
-    except StopIteration:
+        assert engine in MESH_ENGINES
+    except AssertionError:
+        raise ValueError("invalid mesh engine: {}".format(engine))
+    if engine == "numpy" and numpy is None:
+        raise ValueError("the 'numpy' mesh engine requires numpy to be installed")
+
+
+def _get_geometry(mesh, vertex_list):
+    """The text of the vertices and polygons of `mesh`
+
+    :return: a list of tuples of the designation, the vertex id and the coordinates of each vertex and a list of tuples
+        of the vertex indices of each polygon
+    :rtype: tuple
+    """
+    vertices = [
+        (vertex.get("designation"), vertex.get("vID"),
+         tuple(coordinate.text for coordinate in vertex.iterchildren(tag=etree.Element)))
+        for vertex in vertex_list.iter("v")
+    ]
+    triangle_list = next(mesh.iter("polygonList"))
+    polygons = [tuple(index.text for index in polygon.iterchildren(tag=etree.Element))
+                for polygon in triangle_list.iter("P")]
+    return vertices, polygons
+
+
+def _encode_geometry(vertices, polygons, vertices_mode, triangles_mode, endianness, engine, compact=False):
+    """Encode the geometry returned by :py:func:`_get_geometry` using `engine`"""
+    if engine == "python" or numpy is None:
+        return _encode_mesh_python(vertices, polygons, vertices_mode, triangles_mode, endianness, compact=compact)
+    return _encode_mesh_numpy(vertices, polygons, vertices_mode, triangles_mode, endianness, compact=compact)
+
+
+def get_mesh_key(mesh, vertices_mode="float32", triangles_mode="uint32", endianness="little", compact=False):
+    """A hash of everything that determines the payload of `mesh`; used to reuse payloads between runs
+
+    The arguments are the same as for :py:func:`encode_mesh` except for the engine: all engines give the same payload.
+
+    :return: a hex digest
+    :rtype: str
+    """
+    hasher = hashlib.sha256(
+        json.dumps([MESH_PAYLOAD_VERSION, vertices_mode, triangles_mode, endianness, compact]).encode())
+    hasher.update(etree.tostring(mesh, with_tail=False))
+    return hasher.hexdigest()
+
+
+def _mesh_elements(payload, vertices_mode="float32", triangles_mode="uint32", endianness="little"):
+    """Build the `vertices`, `normals` and `triangles` elements from a payload (see :py:func:`encode_mesh`)"""
+    if triangles_mode == "auto":
+        # the narrowest type for meshes without geometry
+        triangles_mode = AUTO_TRIANGLES_MODES[0]
+    if payload is None:
         # no geometry
         return (
             etree.Element("vertices", num_vertices="0", mode=vertices_mode, endianness=endianness, data=""),
             etree.Element("normals", num_normals="0", mode=vertices_mode, endianness=endianness, data=""),
             etree.Element("triangles", num_triangles="0", mode=triangles_mode, endianness=endianness, data="")
         )
-    i = 0
-    for vertex in vertex_list.iter("v"):
-        designation = vertex.get("designation")
-        x, y, z = vertex.xpath("*")
+    (base64_surface_vertices, num_vertices, base64_normal_vertices, num_normals, base64_triangles, num_triangles,
+     triangles_mode) = payload
+    surface_vertices_element = etree.Element("vertices", num_vertices=str(num_vertices),
+                                             mode=vertices_mode,
+                                             endianness=endianness, data=base64_surface_vertices)
+    surface_vertices_element.tail = "\n\t\t\t\t\t"
+    normal_vertices_element = etree.Element("normals", num_normals=str(num_normals), mode=vertices_mode,
+                                            endianness=endianness, data=base64_normal_vertices)
+    normal_vertices_element.tail = "\n\t\t\t\t\t"
+    triangles_element = etree.Element("triangles", num_triangles=str(num_triangles), mode=triangles_mode,
+                                      endianness=endianness, data=base64_triangles)
+    triangles_element.tail = "\n\t\t\t\t"
+    return surface_vertices_element, normal_vertices_element, triangles_element
+
+
+def _encode_mesh_geometry(job):
+    """Worker function: encode the geometry of a mesh
+
+    Workers receive the text of the vertices and polygons (see :py:func:`_get_geometry`) rather than `lxml` elements,
+    which cannot be shared between processes, and return the payload.
+
+    :param tuple job: the vertices, the polygons and the keyword arguments to :py:func:`_encode_geometry`
+    :return: the payload
+    """
+    vertices, polygons, kwargs = job
+    return _encode_geometry(vertices, polygons, **kwargs)
+
+
+def migrate_meshes(meshes, vertices_mode="float32", triangles_mode="uint32", endianness="little", engine="auto",
+                   workers=None, executor="process", compact=False):
+    """Convert several meshes, optionally in parallel
+
+    The text of the vertices and polygons of each mesh is sent to a worker which returns the encoded payload; the
+    elements are then built in this process. Results are in the same order as `meshes` and are identical to
+    converting each mesh with :py:func:`migrate_mesh`.
+
+    :param list meshes: `mesh` elements from a v0.7.0.dev0 document
+    :param int workers: the number of workers; with `None`, 0 or 1 meshes are converted serially in this process
+    :param str executor: either 'process' or 'thread' [default: 'process']
+    :return: a list of tuples of `vertices`, `normals` and `triangles` elements
+    :rtype: list
+    """
+    payloads = encode_meshes(meshes, vertices_mode=vertices_mode, triangles_mode=triangles_mode,
+                             endianness=endianness, engine=engine, workers=workers, executor=executor, compact=compact)
+    return [_mesh_elements(payload, vertices_mode, triangles_mode, endianness) for payload in payloads]
+
+
+def encode_meshes(meshes, vertices_mode="float32", triangles_mode="uint32", endianness="little", engine="auto",
+                  workers=None, executor="process", compact=False):
+    """Encode several meshes, optionally in parallel
+
+    The arguments are the same as for :py:func:`migrate_meshes`.
+
+    :return: a list of payloads (see :py:func:`encode_mesh`)
+    :rtype: list
+    """
+    kwargs = dict(vertices_mode=vertices_mode, triangles_mode=triangles_mode, endianness=endianness, engine=engine,
+                  compact=compact)
+    if not workers or workers <= 1 or len(meshes) <= 1:
+        return [encode_mesh(mesh, **kwargs) for mesh in meshes]
+    _check_encoding(vertices_mode, triangles_mode, endianness, engine)
+    try:
+        assert executor in ["process", "thread"]
+    except AssertionError:
+        raise ValueError("invalid executor: {}".format(executor))
+    if executor == "process":
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    # meshes are extracted as they are submitted and only a few more than there are workers are pending at a time
+    payloads = list()
+    pending = collections.deque()
+    with pool:
+        for mesh in meshes:
+            try:
+                vertex_list = next(mesh.iter("vertexList"))
+            except StopIteration:
+                pending.append(None)
+            else:
+                vertices, polygons = _get_geometry(mesh, vertex_list)
+                pending.append(pool.submit(_encode_mesh_geometry, (vertices, polygons, kwargs)))
+            while len(pending) > 2 * workers:
+                future = pending.popleft()
+                payloads.append(future.result() if future is not None else None)
+        while pending:
+            future = pending.popleft()
+            payloads.append(future.result() if future is not None else None)
+    return payloads
+
+
+def _encode_mesh_python(vertices, polygons, vertices_mode, triangles_mode, endianness, compact=False):
+    """Pure-Python mesh conversion; used when numpy is not available"""
+    surface_vertex_dict = dict()  # dictionary to remap vertex ids
+    surface_vertices = list()
+    normal_vertices = list()
+    for designation, vertex_id, coordinates in vertices:
+        try:
+            assert len(coordinates) == 3
+        except AssertionError:
+            raise ValueError("invalid vertex: should have exactly 3 coordinates")
+        x, y, z = coordinates
         # 'surface' vertex by default
         if designation is None or designation == "surface":
-            surface_vertex_dict[int(vertex.get("vID"))] = len(surface_vertices) // 3  # len = index
-            surface_vertices += [float(x.text), float(y.text), float(z.text)]
+            surface_vertex_dict[int(vertex_id)] = len(surface_vertices) // 3  # len = index
+            surface_vertices += [float(x), float(y), float(z)]
         else:
-            normal_vertices += [float(x.text), float(y.text), float(z.text)]
+            normal_vertices += [float(x), float(y), float(z)]
     # _print(surface_vertex_dict)
     # sanity check: normal_vertices should have the same length as surface_vertices list if it exists
     if normal_vertices:
@@ -53,92 +291,586 @@ def migrate_mesh(mesh, vertices_mode="float32", triangles_mode="uint32", endiann
             assert len(surface_vertices) == len(normal_vertices)
         except AssertionError:
             raise ValueError("surface and normal vertice lists are of different length")
-    bin_surface_vertices = struct.pack(
-        "{}{}{}".format(ENDIANNESS[endianness], len(surface_vertices), MODE[vertices_mode]), *surface_vertices)
-    base64_surface_vertices = base64.b64encode(bin_surface_vertices)
-    bin_normal_vertices = struct.pack(
-        "{}{}{}".format(ENDIANNESS[endianness], len(normal_vertices), MODE[vertices_mode]), *normal_vertices)
-    base64_normal_vertices = base64.b64encode(bin_normal_vertices)
-    surface_vertices_element = etree.Element("vertices", num_vertices=str(len(surface_vertices) // 3),
-                                             mode=vertices_mode,
-                                             endianness=endianness, data=base64_surface_vertices)
-    surface_vertices_element.tail = "\n\t\t\t\t\t"
-    normal_vertices_element = etree.Element("normals", num_normals=str(len(normal_vertices) // 3), mode=vertices_mode,
-                                            endianness=endianness, data=base64_normal_vertices)
-    normal_vertices_element.tail = "\n\t\t\t\t\t"
+    # sanity check: the vertices mode should represent every (finite) coordinate
+    finite = [value for value in surface_vertices + normal_vertices if math.isfinite(value)]
+    if finite:
+        _check_range(min(finite), max(finite), vertices_mode, "vertex coordinate")
 
     # work on triangles
     triangles = list()
-    triangle_list = next(mesh.iter("polygonList"))
-    for triangle in triangle_list.iter("P"):
-        vertex_indices = triangle.xpath("*")
+    for vertex_indices in polygons:
         if len(vertex_indices) == 3:  # no normals
             _v1, _v2, _v3 = vertex_indices
-            v1 = int(_v1.text)
-            v2 = int(_v2.text)
-            v3 = int(_v3.text)
+            v1 = int(_v1)
+            v2 = int(_v2)
+            v3 = int(_v3)
         elif len(vertex_indices) == 6:  # s, n, s, n, s, n
             _v1, _n1, _v2, _n2, _v3, _n3 = vertex_indices
             # get the new index
-            v1 = surface_vertex_dict[int(_v1.text)]
-            v2 = surface_vertex_dict[int(_v2.text)]
-            v3 = surface_vertex_dict[int(_v3.text)]
+            v1 = surface_vertex_dict[int(_v1)]
+            v2 = surface_vertex_dict[int(_v2)]
+            v3 = surface_vertex_dict[int(_v3)]
         else:
             raise ValueError("invalid polygon: should have 3 or 6 vertices only")
 
         triangles += [v1, v2, v3]
-    # sanity check: there should be no triangle with a vertex id larger than the length of vertices/normals
+    # sanity check: every triangle should refer to an existing vertex
     try:
-        assert max(triangles) < len(surface_vertices)
+        assert 0 <= min(triangles) and max(triangles) < len(surface_vertices) // 3
     except AssertionError:
         raise ValueError("triangle with non-existent vertex found!")
+    if compact:
+        surface_vertices, normal_vertices, triangles = _compact_python(
+            surface_vertices, normal_vertices, triangles, vertices_mode, endianness)
+    bin_surface_vertices = struct.pack(
+        "{}{}{}".format(ENDIANNESS[endianness], len(surface_vertices), MODE[vertices_mode]), *surface_vertices)
+    base64_surface_vertices = base64.b64encode(bin_surface_vertices)
+    bin_normal_vertices = struct.pack(
+        "{}{}{}".format(ENDIANNESS[endianness], len(normal_vertices), MODE[vertices_mode]), *normal_vertices)
+    base64_normal_vertices = base64.b64encode(bin_normal_vertices)
+    if triangles_mode == "auto":
+        triangles_mode = get_triangles_mode(max(triangles))
+    # sanity check: the triangles mode should represent every index
+    _check_range(min(triangles), max(triangles), triangles_mode, "triangle index")
     bin_triangles = struct.pack("{}{}{}".format(ENDIANNESS[endianness], len(triangles), MODE[triangles_mode]),
                                 *triangles)
     base64_triangles = base64.b64encode(bin_triangles)
-    triangles_element = etree.Element("triangles", num_triangles=str(len(triangles) // 3), mode=triangles_mode,
-                                      endianness=endianness, data=base64_triangles)
-    triangles_element.tail = "\n\t\t\t\t"
+    return (
+        base64_surface_vertices, len(surface_vertices) // 3,
+        base64_normal_vertices, len(normal_vertices) // 3,
+        base64_triangles, len(triangles) // 3, triangles_mode,
+    )
 
-    return surface_vertices_element, normal_vertices_element, triangles_element
 
+def _compact_python(surface_vertices, normal_vertices, triangles, vertices_mode, endianness):
+    """Drop unreferenced vertices and weld vertices whose encoded surface and normal coordinates are identical
 
-def migrate(infile, outfile, stylesheet, args, encoding='utf-8', **kwargs):
+    Vertices are hashed by their encoded bytes so that only vertices which are indistinguishable in the output are
+    welded. The vertices that remain keep the order of their first occurrence.
+
+    :return: the compacted surface vertices, normal vertices and triangles (as flat lists)
+    :rtype: tuple
+    """
+    _format = "{}3{}".format(ENDIANNESS[endianness], MODE[vertices_mode])
+    new_indices = dict()
+    welded = dict()
+    compacted_surface_vertices = list()
+    compacted_normal_vertices = list()
+    for index in sorted(set(triangles)):
+        coordinates = surface_vertices[3 * index:3 * index + 3]
+        key = struct.pack(_format, *coordinates)
+        if normal_vertices:
+            normals = normal_vertices[3 * index:3 * index + 3]
+            key += struct.pack(_format, *normals)
+        if key not in welded:
+            welded[key] = len(compacted_surface_vertices) // 3
+            compacted_surface_vertices += coordinates
+            if normal_vertices:
+                compacted_normal_vertices += normals
+        new_indices[index] = welded[key]
+    return compacted_surface_vertices, compacted_normal_vertices, [new_indices[index] for index in triangles]
+
+
+def _check_range(minimum, maximum, mode, name):
+    """Raise a `ValueError` unless every value from `minimum` to `maximum` can be represented using `mode`"""
+    if mode in FLOAT_MAX:
+        bounds = -FLOAT_MAX[mode], FLOAT_MAX[mode]
+    else:
+        bits = 8 * struct.calcsize(MODE[mode])
+        bounds = (-2 ** (bits - 1), 2 ** (bits - 1) - 1) if mode.startswith("int") else (0, 2 ** bits - 1)
+    try:
+        assert bounds[0] <= minimum and maximum <= bounds[1]
+    except AssertionError:
+        raise ValueError("{} out of range for mode {}: {}".format(
+            name, mode, minimum if minimum < bounds[0] else maximum))
+
+
+def _encode_mesh_numpy(vertices, polygons, vertices_mode, triangles_mode, endianness, compact=False):
+    """Vectorised mesh conversion using numpy
+
+    Coordinates and polygon indices are gathered into typed arrays in a single pass over the vertices; the vertex id
+    remapping and the bounds check are array operations and the base64 encoding reads directly from the array buffer.
+    The output is byte-identical to that of :py:func:`_encode_mesh_python`.
+    """
+    is_surface = numpy.fromiter(
+        (designation in (None, "surface") for designation, _, _ in vertices), dtype=bool, count=len(vertices))
+    # each <v> should have exactly 3 children; a total of 3 per vertex could hide a vertex with 2 next to one with 4
+    sizes = numpy.fromiter((len(vertex_coordinates) for _, _, vertex_coordinates in vertices), dtype=numpy.int64,
+                           count=len(vertices))
+    if numpy.any(sizes != 3):
+        raise ValueError("invalid vertex: should have exactly 3 coordinates")
+    # the coordinates are the children of each <v> in document order
+    coordinates = numpy.fromiter(
+        (float(coordinate) for _, _, vertex_coordinates in vertices for coordinate in vertex_coordinates),
+        dtype=numpy.float64, count=3 * len(vertices),
+    )
+    coordinates = coordinates.reshape(-1, 3)
+    surface_vertices = coordinates[is_surface]
+    normal_vertices = coordinates[~is_surface]
+    # sanity check: normal_vertices should have the same length as surface_vertices list if it exists
+    if normal_vertices.size and normal_vertices.shape != surface_vertices.shape:
+        raise ValueError("surface and normal vertice lists are of different length")
+    surface_vertex_ids = numpy.fromiter(
+        (int(vertex_id) for (_, vertex_id, _), surface in zip(vertices, is_surface) if surface), dtype=numpy.int64,
+        count=len(surface_vertices),
+    )
+    # sanity check: the vertices mode should represent every (finite) coordinate
+    finite = coordinates[numpy.isfinite(coordinates)]
+    if finite.size:
+        _check_range(float(finite.min()), float(finite.max()), vertices_mode, "vertex coordinate")
+    vertices_dtype = numpy.dtype(ENDIANNESS[endianness] + MODE[vertices_mode])
+
+    # work on triangles
+    counts = numpy.fromiter(map(len, polygons), dtype=numpy.int64, count=len(polygons))
+    if numpy.any((counts != 3) & (counts != 6)):
+        raise ValueError("invalid polygon: should have 3 or 6 vertices only")
+    indices = numpy.fromiter(
+        (int(index) for vertex_indices in polygons for index in vertex_indices),
+        dtype=numpy.int64, count=int(counts.sum()),
+    )
+    # for 6-index polygons (s, n, s, n, s, n) we only keep the surface indices
+    starts = numpy.cumsum(counts) - counts
+    steps = counts // 3
+    triangles = indices[starts[:, None] + steps[:, None] * numpy.arange(3)]
+    with_normals = counts == 6
+    if numpy.any(with_normals):
+        # remap vertex ids to indices; as with a dict, the last vertex with a given id wins
+        order = numpy.argsort(surface_vertex_ids, kind="stable")
+        sorted_ids = surface_vertex_ids[order]
+        vertex_ids = triangles[with_normals]
+        positions = numpy.searchsorted(sorted_ids, vertex_ids, side="right") - 1
+        found = (positions >= 0) & (sorted_ids[numpy.clip(positions, 0, None)] == vertex_ids) \
+            if sorted_ids.size else numpy.zeros(vertex_ids.shape, dtype=bool)
+        if not numpy.all(found):
+            raise KeyError(int(vertex_ids[~found][0]))
+        triangles[with_normals] = order[positions]
+    triangles = triangles.ravel()
+    # sanity check: every triangle should refer to an existing vertex
+    if not triangles.size or triangles.min() < 0 or triangles.max() >= len(surface_vertices):
+        raise ValueError("triangle with non-existent vertex found!")
+    if compact:
+        surface_vertices, normal_vertices, triangles = _compact_numpy(
+            surface_vertices, normal_vertices, triangles, vertices_dtype)
+    base64_surface_vertices = base64.b64encode(numpy.ascontiguousarray(surface_vertices, dtype=vertices_dtype))
+    base64_normal_vertices = base64.b64encode(numpy.ascontiguousarray(normal_vertices, dtype=vertices_dtype))
+    if triangles_mode == "auto":
+        triangles_mode = get_triangles_mode(int(triangles.max()))
+    # sanity check: the triangles mode should represent every index
+    _check_range(int(triangles.min()), int(triangles.max()), triangles_mode, "triangle index")
+    triangles_dtype = numpy.dtype(ENDIANNESS[endianness] + MODE[triangles_mode])
+    base64_triangles = base64.b64encode(triangles.astype(triangles_dtype))
+    return (
+        base64_surface_vertices, len(surface_vertices),
+        base64_normal_vertices, len(normal_vertices),
+        base64_triangles, len(triangles) // 3, triangles_mode,
+    )
+
+
+def _compact_numpy(surface_vertices, normal_vertices, triangles, vertices_dtype):
+    """Vectorised :py:func:`_compact_python`
+
+    The encoded coordinates of each referenced vertex are viewed as a single opaque value and welded by sorting
+    (`numpy.unique`); the result is identical to that of :py:func:`_compact_python`.
+    """
+    referenced = numpy.zeros(len(surface_vertices), dtype=bool)
+    referenced[triangles] = True
+    candidates = numpy.flatnonzero(referenced)
+    rows = numpy.ascontiguousarray(surface_vertices[candidates], dtype=vertices_dtype)
+    if normal_vertices.size:
+        rows = numpy.ascontiguousarray(
+            numpy.hstack([rows, numpy.ascontiguousarray(normal_vertices[candidates], dtype=vertices_dtype)]))
+    keys = rows.view(numpy.dtype((numpy.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+    # number the welded vertices in order of their first occurrence
+    order = numpy.argsort(first, kind="stable")
+    ranks = numpy.empty_like(order)
+    ranks[order] = numpy.arange(len(order))
+    new_indices = numpy.zeros(len(surface_vertices), dtype=numpy.int64)
+    new_indices[candidates] = ranks[inverse.ravel()]
+    kept = candidates[first[order]]
+    return (
+        surface_vertices[kept], normal_vertices[kept] if normal_vertices.size else normal_vertices,
+        new_indices[triangles],
+    )
+
+
+def migrate_tree(original, stylesheet, args, **kwargs):
+    """Migrate the parsed v0.7.0.dev0 document `original` to v0.8.0.dev1 in memory
+
+    The stylesheet is applied to the tree and the converted meshes are spliced into the result tree in place.
+
+    :param original: the source document
+    :type original: `lxml.etree._ElementTree`
+    :param str stylesheet: the name of the XSL file
+    :param args: argument namespace
+    :type args: `argparse.Namespace`
+    :return: the migrated document
+    :rtype: `lxml.etree._ElementTree`
+    """
     if args.verbose:
         _print("migrating by stylesheet...")
-    _migrated = migrate_by_stylesheet(infile, stylesheet, verbose=args.verbose, **kwargs)
+    migrated = transform_by_stylesheet(original, stylesheet, verbose=args.verbose, **kwargs)
 
     if args.verbose:
         _print("ad hoc migration by function...")
-    # convert migration to an ElementTree object
-    migrated = etree.ElementTree(etree.XML(_migrated))
-
-    _original = etree.parse(infile)
-
-    segments = _original.xpath('/segmentation/segmentList/segment')
-    # _print(segments)
+    # index the source meshes by (segment id, mesh id)
     segment_meshes = dict()
-    for segment in segments:
-        segment_meshes[int(segment.get("id"))] = dict()
+    for segment in original.xpath('/segmentation/segmentList/segment'):
         for mesh in segment.xpath('meshList/mesh'):
-            _vertices, _normals, _triangles = migrate_mesh(mesh)
-            segment_meshes[int(segment.get("id"))][int(mesh.get("id"))] = _vertices, _normals, _triangles
+            segment_meshes[(int(segment.get("id")), int(mesh.get("id")))] = mesh
 
+    # pair each migrated mesh with its source in document order
+    mesh_pairs = list()
     migrated_segments = migrated.xpath('/segmentation/segment_list/segment')
     for migrated_segment in migrated_segments:
         for migrated_mesh in migrated_segment.xpath('mesh_list/mesh'):
-            _vertices, _normals, _triangles = segment_meshes[int(migrated_segment.get("id"))][
-                int(migrated_mesh.get("id"))]
+            mesh_pairs.append(
+                (migrated_mesh, segment_meshes[(int(migrated_segment.get("id")), int(migrated_mesh.get("id")))]))
+
+    _insert_meshes(mesh_pairs, args)
+    return migrated
+
+
+def _insert_meshes(mesh_pairs, args):
+    """Convert the source mesh of each pair of (migrated mesh, source mesh) and splice it into the migrated mesh
+
+    When migrating incrementally (see :py:func:`sfftk_migrate.migrate.get_payload_cache`) meshes whose payloads were
+    stored by an earlier run are not converted again. With `args.compact_meshes` meshes are compacted (see
+    :py:func:`migrate_mesh`) and the vertices and bytes saved are counted as `removed_vertices` and `removed_bytes`.
+    """
+    payload_cache = get_payload_cache(args)
+    encoding = get_mesh_encoding(args)
+    compact = getattr(args, 'compact_meshes', False)
+    with stage('migrate_mesh') as _stage:
+        meshes = [mesh for _, mesh in mesh_pairs]
+        payloads = dict()
+        if payload_cache is not None:
+            keys = [get_mesh_key(mesh, compact=compact, **encoding) for mesh in meshes]
+            for i, key in enumerate(keys):
+                payload = payload_cache.get_payload(key)
+                if payload is not None:
+                    payloads[i] = payload
+            _stage.count(reused_meshes=len(payloads))
+        missing = set(range(len(meshes))) - set(payloads)
+        removed = removed_bytes = 0
+        mesh_workers = getattr(args, 'mesh_workers', None)
+        if mesh_workers and mesh_workers > 1 and len(missing) > 1:
+            if args.verbose:
+                _print("converting {} meshes using {} workers...".format(len(missing), mesh_workers))
+            missing_meshes = sorted(missing)
+            payloads.update(zip(missing_meshes, encode_meshes([meshes[i] for i in missing_meshes],
+                                                              workers=mesh_workers, compact=compact, **encoding)))
+        for i, (migrated_mesh, mesh) in enumerate(mesh_pairs):
+            if i in payloads:
+                payload = payloads.pop(i)
+            else:
+                # convert each mesh as it is spliced in
+                payload = encode_mesh(mesh, compact=compact, **encoding)
+            if payload_cache is not None and i in missing and payload is not None:
+                payload_cache.put_payload(keys[i], payload)
+            _vertices, _normals, _triangles = _mesh_elements(payload, **encoding)
             migrated_mesh.insert(0, _vertices)
             migrated_mesh.insert(1, _normals)
             migrated_mesh.insert(2, _triangles)
+            _stage.count(meshes=1, vertices=int(_vertices.get("num_vertices")),
+                         triangles=int(_triangles.get("num_triangles")))
+            if compact and payload is not None:
+                _removed, _removed_bytes = _get_removed(mesh, payload, encoding['vertices_mode'])
+                removed += _removed
+                removed_bytes += _removed_bytes
+        if compact:
+            _stage.count(removed_vertices=removed, removed_bytes=removed_bytes)
+            if args.verbose:
+                _print("compacting meshes removed {} vertices ({} bytes)".format(removed, removed_bytes))
+
+
+def _get_removed(mesh, payload, vertices_mode):
+    """The number of vertices and of bytes of vertices and normals removed from `mesh` by compaction"""
+    _, num_vertices, _, num_normals, _, _, _ = payload
+    vertex_list = next(mesh.iter("vertexList"))
+    removed = sum(1 for vertex in vertex_list.iter("v") if vertex.get("designation") in (None, "surface")) - \
+        num_vertices
+    return removed, removed * 3 * struct.calcsize(MODE[vertices_mode]) * (2 if num_normals else 1)
+
+
+PRIMARY_DESCRIPTORS = {
+    'threeDVolume': 'three_d_volume',
+    'meshList': 'mesh_list',
+    'shapePrimitiveList': 'shape_primitive_list',
+}
+SHAPES = {
+    'cone': ['height', ('bottomRadius', 'bottom_radius'), ('transformId', 'transform_id')],
+    'cuboid': ['x', 'y', 'z', ('transformId', 'transform_id')],
+    'cylinder': ['height', 'diameter', ('transformId', 'transform_id')],
+    'ellipsoid': ['x', 'y', 'z', ('transformId', 'transform_id')],
+}
+NEWLINE = "\n"
+TAB = "\t"
+
+
+def _add_text(element, text):
+    """Append `text` to the content of `element` as a text node would be"""
+    # an empty text node would stop the element from being pretty-printed
+    if not text:
+        return
+    if len(element):
+        element[-1].tail = (element[-1].tail or '') + text
+    else:
+        element.text = (element.text or '') + text
+
+
+def _add_copy(element, source):
+    """Append a deep copy of `source` (without its tail) to `element`"""
+    copy = deepcopy(source)
+    copy.tail = None
+    element.append(copy)
+
 
-    migrated_decoded = etree.tostring(migrated, xml_declaration=True, encoding=encoding, pretty_print=True).decode(
-        encoding)
+def _add_copies(element, text, sources):
+    """Append `text` followed by copies of all of `sources` (possibly none) to `element`"""
+    _add_text(element, text)
+    for source in sources:
+        _add_copy(element, source)
 
+
+def _string_value(elements):
+    """The XPath string value of the first of `elements`"""
+    for element in elements:
+        return ''.join(element.itertext())
+    return ''
+
+
+def _add_indented(element, source_elements, indent):
+    """Copy each of `source_elements` into `element` on a new line at `indent` tabs"""
+    for source in source_elements:
+        _add_text(element, NEWLINE + TAB * indent)
+        _add_copy(element, source)
+
+
+def _copy_attributes(element, source, names):
+    for name in names:
+        if name in source.attrib:
+            element.set(name, source.get(name))
+
+
+def _native_ref(parent, ref, copy_id):
+    """The v0.8.0.dev1 version of an external reference"""
+    _ref = etree.SubElement(parent, 'ref')
+    if copy_id and 'id' in ref.attrib:
+        _ref.set('id', ref.get('id'))
+    _ref.set('resource', ref.get('type', ''))
+    _ref.set('url', ref.get('otherType', ''))
+    _ref.set('accession', ref.get('value', ''))
+    _copy_attributes(_ref, ref, ['label', 'description'])
+    return _ref
+
+
+def _native_software(parent, software):
+    software_list = etree.SubElement(parent, 'software_list')
+    _add_text(software_list, NEWLINE + TAB * 2)
+    _software = etree.SubElement(software_list, 'software', id="0")
+    _add_copies(_software, NEWLINE + TAB * 3, software.findall('name'))
+    _add_copies(_software, NEWLINE + TAB * 3, software.findall('version'))
+    _add_text(_software, NEWLINE + TAB * 3)
+    etree.SubElement(_software, 'processing_details').text = _string_value(software.findall('processingDetails')) \
+        or None
+    _add_text(_software, NEWLINE + TAB * 2)
+    _add_text(software_list, NEWLINE + TAB)
+
+
+def _native_transform_list(parent, transform_list):
+    _transform_list = etree.SubElement(parent, 'transform_list')
+    for transformation_matrix in transform_list.findall('transformationMatrix'):
+        _add_text(_transform_list, NEWLINE + TAB * 2)
+        _matrix = etree.SubElement(_transform_list, 'transformation_matrix', id=transformation_matrix.get('id', ''))
+        for tag in ['rows', 'cols', 'data']:
+            _add_copies(_matrix, NEWLINE + TAB * 3, transformation_matrix.findall(tag))
+        _add_text(_matrix, NEWLINE + TAB * 2)
+    _add_text(_transform_list, NEWLINE + TAB)
+
+
+def _native_global_external_references(parent, global_external_references):
+    _references = etree.SubElement(parent, 'global_external_references')
+    for ref in global_external_references.findall('ref'):
+        _add_text(_references, NEWLINE + TAB * 2)
+        _native_ref(_references, ref, copy_id=True)
+    _add_text(_references, NEWLINE + TAB)
+
+
+def _native_shape(parent, shape):
+    _add_text(parent, NEWLINE + TAB * 4)
+    _shape = etree.SubElement(parent, shape.tag, id=shape.get('id', ''))
+    for field in SHAPES[shape.tag]:
+        if isinstance(field, tuple):
+            source_tag, tag = field
+            _add_text(_shape, NEWLINE + TAB * 5)
+            etree.SubElement(_shape, tag).text = _string_value(shape.findall(source_tag)) or None
+        else:
+            _add_copies(_shape, NEWLINE + TAB * 5, shape.findall(field))
+    _add_text(_shape, NEWLINE + TAB * 4)
+
+
+def _native_segment(parent, segment, mesh_pairs):
+    _segment = etree.SubElement(parent, 'segment')
+    _copy_attributes(_segment, segment, ['id'])
+    _segment.set('parent_id', segment.get('parentID', ''))
+    _add_text(_segment, NEWLINE + TAB * 3)
+    annotation = etree.SubElement(_segment, 'biological_annotation')
+    for tag in ['name', 'description']:
+        fields = segment.findall('biologicalAnnotation/' + tag)
+        if len(fields) == 1:
+            _add_indented(annotation, fields, 4)
+            _add_text(annotation, NEWLINE + TAB * 4)
+    refs = segment.findall('biologicalAnnotation/externalReferences/ref')
+    if refs:
+        external_references = etree.SubElement(annotation, 'external_references')
+        for ref in refs:
+            _add_text(external_references, NEWLINE + TAB * 5)
+            # the stylesheet does not carry over the ids of segment references
+            _native_ref(external_references, ref, copy_id=False)
+            _add_text(external_references, NEWLINE + TAB * 4)
+    _add_copies(_segment, NEWLINE + TAB * 3, segment.findall('colour'))
+    _add_text(_segment, NEWLINE + TAB * 3)
+    volumes = segment.findall('threeDVolume')
+    if volumes:
+        volume = etree.SubElement(_segment, 'three_d_volume')
+        _add_text(volume, NEWLINE + TAB * 4)
+        etree.SubElement(volume, 'lattice_id').text = _string_value(segment.findall('threeDVolume/latticeId')) or None
+        _add_copies(volume, NEWLINE + TAB * 4, segment.findall('threeDVolume/value'))
+        _add_text(volume, NEWLINE)
+        transform_ids = segment.findall('threeDVolume/transformId')
+        if transform_ids:
+            _add_text(volume, TAB * 4)
+            etree.SubElement(volume, 'transform_id').text = _string_value(transform_ids) or None
+            _add_text(volume, NEWLINE)
+        _add_text(volume, TAB * 3)
+    if segment.findall('meshList'):
+        mesh_list = etree.SubElement(_segment, 'mesh_list')
+        for mesh in segment.findall('meshList/mesh'):
+            _add_text(mesh_list, NEWLINE + TAB * 4)
+            _mesh = etree.SubElement(mesh_list, 'mesh')
+            _copy_attributes(_mesh, mesh, ['id'])
+            _add_text(_mesh, NEWLINE + TAB * 5)
+            transform_ids = mesh.findall('transformId')
+            if transform_ids:
+                etree.SubElement(_mesh, 'transform_id').text = _string_value(transform_ids) or None
+                _add_text(_mesh, NEWLINE + TAB * 4)
+            mesh_pairs.append((_mesh, mesh))
+        _add_text(mesh_list, NEWLINE + TAB * 3)
+    if segment.findall('shapePrimitiveList'):
+        shape_list = etree.SubElement(_segment, 'shape_primitive_list')
+        for shape in segment.iterfind('shapePrimitiveList/*'):
+            if shape.tag in SHAPES:
+                _native_shape(shape_list, shape)
+        _add_text(shape_list, NEWLINE + TAB * 3)
+    _add_text(_segment, NEWLINE + TAB * 2)
+
+
+def _native_segment_list(parent, segment_list, mesh_pairs):
+    _segment_list = etree.SubElement(parent, 'segment_list')
+    for segment in segment_list.findall('segment'):
+        _add_text(_segment_list, NEWLINE + TAB * 2)
+        _native_segment(_segment_list, segment, mesh_pairs)
+    _add_text(_segment_list, NEWLINE + TAB)
+
+
+def _native_lattice_list(parent, lattice_list):
+    _lattice_list = etree.SubElement(parent, 'lattice_list')
+    _add_indented(_lattice_list, lattice_list.findall('lattice'), 2)
+    _add_text(_lattice_list, NEWLINE + TAB)
+
+
+def migrate_native(original, args, **kwargs):
+    """Migrate the parsed v0.7.0.dev0 document `original` to v0.8.0.dev1 without XSLT
+
+    This is an alternative to :py:func:`migrate_tree` which builds the migrated document in a single traversal of the
+    source, converting meshes along the way, instead of running the stylesheet and then pairing up and converting the
+    meshes in a second pass. The result is identical to that of :py:func:`migrate_tree`, down to the whitespace.
+
+    :param original: the source document
+    :type original: `lxml.etree._ElementTree`
+    :param args: argument namespace
+    :type args: `argparse.Namespace`
+    :return: the migrated document
+    :rtype: `lxml.etree._ElementTree`
+    """
+    if args.verbose:
+        _print("migrating natively...")
+    handlers = {
+        'software': _native_software,
+        'transformList': _native_transform_list,
+        'globalExternalReferences': _native_global_external_references,
+        'latticeList': _native_lattice_list,
+    }
+    root = original.getroot()
+    with stage('migrate_native'):
+        migrated_root = etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap)
+        migrated_root.text = root.text
+        mesh_pairs = list()
+        for child in root:
+            if not isinstance(child.tag, str):  # comments and processing instructions are copied over
+                _add_copy(migrated_root, child)
+            elif child.tag == 'version':
+                etree.SubElement(migrated_root, 'version').text = "0.8.0.dev1"
+            elif child.tag == 'primaryDescriptor':
+                etree.SubElement(migrated_root, 'primary_descriptor').text = PRIMARY_DESCRIPTORS.get(
+                    _string_value([child]))
+            elif child.tag == 'boundingBox':
+                bounding_box = etree.SubElement(migrated_root, 'bounding_box')
+                _copy_attributes(bounding_box, child, ['xmin', 'xmax', 'ymin', 'ymax', 'zmin', 'zmax'])
+            elif child.tag == 'segmentList':
+                _native_segment_list(migrated_root, child, mesh_pairs)
+            elif child.tag in handlers:
+                handlers[child.tag](migrated_root, child)
+            else:
+                _add_copy(migrated_root, child)
+            _add_text(migrated_root, child.tail)
+        _insert_meshes(mesh_pairs, args)
+    return etree.ElementTree(migrated_root)
+
+
+def migrate(infile, outfile, stylesheet, args, encoding='utf-8', **kwargs):
+    """Migrate `infile` from v0.7.0.dev0 to v0.8.0.dev1
+
+    The source is parsed once, migrated in memory using :py:func:`migrate_tree` and the encoded result is written
+    directly to `outfile`.
+    """
+    migrated = migrate_tree(parse_document(infile), stylesheet, args, **kwargs)
     if args.verbose:
         _print("writing output to {}...".format(outfile))
-    with open(outfile, 'w') as f:
-        f.write(migrated_decoded)
+    with stage('write') as _stage:
+        with open_output(outfile, get_output_compression(args)) as f:
+            migrated.write(f, xml_declaration=True, encoding=encoding, pretty_print=True)
+        if is_profiling():
+            _stage.count(bytes_written=os.path.getsize(outfile))
+    if args.verbose:
+        _print("done")
+    return outfile
+
+
+def migrate_stream(infile, outfile, stylesheet, args, encoding='UTF-8', **kwargs):
+    """Migrate `infile` from v0.7.0.dev0 to v0.8.0.dev1 in bounded memory
+
+    Segments and lattices are read, migrated and written out one at a time (see
+    :py:func:`sfftk_migrate.migrate.stream_by_stylesheet`) so that memory is bounded by the largest segment or lattice
+    rather than by the whole document. The meshes of each segment are converted as the segment is written out.
+    """
+    def _migrate_segment(segment, migrated_segment):
+        # lattices have no meshes
+        if segment.tag != 'segment':
+            return
+        meshes = dict((int(mesh.get("id")), mesh) for mesh in segment.xpath('meshList/mesh'))
+        _insert_meshes(
+            [(migrated_mesh, meshes[int(migrated_mesh.get("id"))]) for migrated_mesh in
+             migrated_segment.xpath('mesh_list/mesh')],
+            args,
+        )
+
+    if args.verbose:
+        _print("streaming migration to {}...".format(outfile))
+    stream_by_stylesheet(infile, outfile, stylesheet, lists=('segmentList', 'latticeList'),
+                         migrate_item=_migrate_segment, encoding=encoding, compression=get_output_compression(args),
+                         **kwargs)
     if args.verbose:
         _print("done")
     return outfile
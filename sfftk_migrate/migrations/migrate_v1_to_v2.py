@@ -1,4 +1,6 @@
-from ..migrate import migrate_by_stylesheet
+from ..compression import get_output_compression, open_output
+from ..migrate import migrate_by_stylesheet, transform_by_stylesheet
+from ..rules import add_field, change_value
 from ..utils import _print
 
 # we need a list of params to query the user for
@@ -6,6 +8,18 @@ PARAM_LIST = [
     'segmentation_details',
 ]
 
+# the same migration as the stylesheet; used by the 'streaming' and 'native' engines
+RULES = [
+    change_value('/segmentation/version', value='2'),
+    add_field('segment', 'details', param='segmentation_details'),
+]
+
+
+def migrate_tree(original, stylesheet, args, **params):
+    if args.verbose:
+        _print("migrating by stylesheet...")
+    return transform_by_stylesheet(original, stylesheet, verbose=args.verbose, **params)
+
 
 def migrate(infile, outfile, stylesheet, args, encoding='utf-8', **params):
     if args.verbose:
@@ -13,8 +27,8 @@ def migrate(infile, outfile, stylesheet, args, encoding='utf-8', **params):
     migrated = migrate_by_stylesheet(infile, stylesheet, verbose=args.verbose, **params)  # bytes
     if args.verbose:
         _print("writing output to {}...".format(outfile))
-    with open(outfile, 'w') as f:
-        f.write(migrated.decode(encoding))
+    with open_output(outfile, get_output_compression(args)) as f:
+        f.write(migrated)
     if args.verbose:
         _print("done")
     return outfile
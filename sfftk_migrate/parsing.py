@@ -0,0 +1,202 @@
+"""
+parsing
+=======
+
+The `parsing` module creates the `lxml` parsers used to read EMDB-SFF documents so that every entry point (whole
+documents, sniffing versions, streaming, rules and pass-through) parses with the same options:
+
+* `huge_tree` lifts libxml2's limits on the size of text nodes and the depth of documents, which large lattices and
+  dense meshes exceed [default: True];
+* `remove_blank_text` drops whitespace between elements; this reduces the memory used but the output is
+  re-indented [default: False];
+* `no_network` prevents access to the network while parsing [default: True];
+* `resolve_entities` expands entities declared in a DTD; SFF documents have none so they are not expanded, which
+  keeps `huge_tree` safe from entity expansion attacks [default: False];
+* `use_mmap` parses whole documents from a memory map of the file rather than by reading it [default: False];
+* `memory_limit` is the number of bytes a whole-document parse may use; the footprint of a document is estimated
+  before it is parsed and :py:class:`DocumentTooLarge` is raised if it exceeds the limit [default: the memory
+  available].
+
+Options are set for the process with :py:func:`configure` or for the current thread with :py:func:`parser_options`:
+
+.. code-block:: python
+
+    from sfftk_migrate.core import parse_document
+    from sfftk_migrate.parsing import parser_options
+
+    with parser_options(remove_blank_text=True, memory_limit=2 ** 30):
+        tree = parse_document('file.sff')
+"""
+import contextlib
+import mmap
+import os
+import threading
+
+from lxml import etree
+
+from .compression import get_compression, input_source, sample_size
+
+
+DEFAULT_OPTIONS = dict(huge_tree=True, remove_blank_text=False, no_network=True, resolve_entities=False,
+                       use_mmap=False, memory_limit=None)
+# options which are passed on to lxml
+LXML_OPTIONS = ['huge_tree', 'remove_blank_text', 'no_network', 'resolve_entities']
+# libxml2 allocates a node for each element and for each text node between elements; measured on synthetic files this
+# comes to about 340 bytes per element i.e. 170 bytes for each of its start and end tags
+BYTES_PER_TAG = 170
+SAMPLES = 16
+SAMPLE_SIZE = 2 ** 16
+
+_options = dict(DEFAULT_OPTIONS)
+_local = threading.local()
+
+
+class DocumentTooLarge(MemoryError):
+    """Raised instead of parsing a document which is not expected to fit in memory"""
+
+
+def _validate(options):
+    try:
+        assert set(options).issubset(DEFAULT_OPTIONS)
+    except AssertionError:
+        raise ValueError("invalid parser options: {}".format(", ".join(sorted(set(options) - set(DEFAULT_OPTIONS)))))
+
+
+def configure(**options):
+    """Set parser options for the process; see the module documentation for the options
+
+    :return: the previous options
+    :rtype: dict
+    """
+    _validate(options)
+    previous = dict(_options)
+    _options.update(options)
+    return previous
+
+
+@contextlib.contextmanager
+def parser_options(**options):
+    """Set parser options for the current thread within a `with` block; options set to `None` are left unchanged"""
+    _validate(options)
+    previous = getattr(_local, 'options', dict())
+    _local.options = dict(previous, **{name: value for name, value in options.items() if value is not None})
+    try:
+        yield get_options()
+    finally:
+        _local.options = previous
+
+
+def get_options():
+    """The parser options in effect for the current thread
+
+    :rtype: dict
+    """
+    return dict(_options, **getattr(_local, 'options', dict()))
+
+
+def get_parser(**options):
+    """A new `lxml.etree.XMLParser` using the current options; `options` override them"""
+    _options = dict(get_options(), **options)
+    return etree.XMLParser(**{name: _options[name] for name in LXML_OPTIONS})
+
+
+def iterparse(source, events=('end',), **kwargs):
+    """`lxml.etree.iterparse` using the current options; `kwargs` are passed on"""
+    options = get_options()
+    return etree.iterparse(source, events=events, **dict({name: options[name] for name in LXML_OPTIONS}, **kwargs))
+
+
+def available_memory():
+    """The memory available to this process in bytes or `None` if it cannot be determined
+
+    On Linux this is the smaller of the memory available to the system and the room left under the limit of the
+    process's (v2) control group.
+    """
+    available = list()
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError, IndexError):
+        try:
+            available.append(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+        except (AttributeError, OSError, ValueError):
+            pass
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f, open('/sys/fs/cgroup/memory.current') as g:
+            limit = f.read().strip()
+            if limit != 'max':
+                available.append(int(limit) - int(g.read().strip()))
+    except (OSError, ValueError):
+        pass
+    return min(available) if available else None
+
+
+def estimate_footprint(fn, skip_bytes=0):
+    """Estimate the number of bytes needed to hold the document in `fn` in memory
+
+    The density of tags is measured in samples spread across the file; compressed files cannot be sampled at random
+    so the density is measured in their first `SAMPLES * SAMPLE_SIZE` decompressed bytes (see
+    :py:func:`sfftk_migrate.compression.sample_size`).
+
+    :param str fn: the name of the file
+    :param int skip_bytes: the number of bytes in the file which will not be parsed (e.g. pass-through payloads)
+    :return: the estimated footprint in bytes
+    :rtype: int
+    """
+    if get_compression(fn) is not None:
+        size, head = sample_size(fn, SAMPLES * SAMPLE_SIZE)
+        parsed = max(0, size - skip_bytes)
+        return parsed + (parsed * head.count(b'<') * BYTES_PER_TAG // len(head) if head else 0)
+    size = os.path.getsize(fn)
+    if size == 0:
+        return 0
+    sampled = tags = 0
+    with open(fn, 'rb') as f:
+        for i in range(SAMPLES):
+            f.seek(max(0, size - SAMPLE_SIZE) * i // max(1, SAMPLES - 1))
+            sample = f.read(SAMPLE_SIZE)
+            sampled += len(sample)
+            tags += sample.count(b'<')
+    parsed = max(0, size - skip_bytes)
+    return parsed + parsed * tags * BYTES_PER_TAG // sampled
+
+
+def check_footprint(fn, skip_bytes=0):
+    """Estimate the footprint of the document in `fn` and check it against the memory limit
+
+    :param str fn: the name of the file
+    :param int skip_bytes: the number of bytes in the file which will not be parsed
+    :return: the estimated footprint in bytes
+    :rtype: int
+    :raises: :py:class:`DocumentTooLarge` if the footprint exceeds the limit
+    """
+    footprint = estimate_footprint(fn, skip_bytes=skip_bytes)
+    limit = get_options()['memory_limit']
+    if limit is None:
+        limit = available_memory()
+    if limit is not None and footprint > limit:
+        raise DocumentTooLarge(
+            "parsing {} is expected to need {:.1f}MB but only {:.1f}MB are available; try '--engine streaming'".format(
+                fn, footprint / 2 ** 20, limit / 2 ** 20)
+        )
+    return footprint
+
+
+def parse_file(fn):
+    """Parse the whole of the document in `fn` using the current options; see
+    :py:func:`sfftk_migrate.core.parse_document`, which also checks the footprint of the document
+
+    Compressed files are decompressed as they are parsed; `use_mmap` does not apply to them.
+
+    :param fn: the name of the file or a file object
+    :return: the parsed document
+    :rtype: `lxml.etree._ElementTree`
+    """
+    with input_source(fn) as source:
+        if isinstance(source, str) and get_options()['use_mmap'] and os.path.getsize(source) > 0:
+            with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return etree.fromstring(buffer, get_parser(), base_url=source).getroottree()
+        return etree.parse(source, get_parser())
@@ -0,0 +1,279 @@
+"""
+passthrough
+===========
+
+The `passthrough` module lets large text payloads which a migration copies verbatim (e.g. the base64-encoded data of
+lattices) bypass `lxml` altogether.
+
+Migration modules list the paths of such elements in a `PASSTHROUGH` constant. Before migrating, the byte ranges of
+their text are located in the (memory-mapped) input and the document is parsed with a short, unique placeholder in
+place of each payload. After migrating, the output is serialised and each placeholder is replaced by copying the
+payload directly from the input file to the output file (using `os.sendfile` where available). The payloads are
+therefore never decoded, copied into text nodes, transformed or serialised.
+
+Only payloads consisting of base64 characters and whitespace other than carriage returns (which XML parsers
+normalise) are passed through; anything else is parsed as usual. If the migration does not carry every placeholder to
+the output exactly once a :py:class:`PassthroughError` is raised so that the caller can migrate without pass-through.
+
+Compressed inputs cannot be memory-mapped so their payloads are not passed through; compressed outputs are written
+through the compressor rather than with `os.sendfile`.
+"""
+import io
+import mmap
+import os
+import string
+import uuid
+
+from lxml import etree
+
+from .compression import get_compression, open_input, open_output
+from .parsing import check_footprint, get_parser
+from .timing import stage
+
+# the characters in payloads which may be passed through
+PAYLOAD_BYTES = (string.ascii_letters + string.digits + '+/= \t\n').encode('ascii')
+FEED_SIZE = 2 ** 20
+COPY_SIZE = 2 ** 24
+
+
+class PassthroughError(Exception):
+    """Raised when payloads cannot be passed through to the output"""
+
+
+def _tag_name(buffer, start):
+    """The name of the tag whose '<' is at `start` and the position after it"""
+    end = start + 1
+    while end < len(buffer) and buffer[end:end + 1] not in (b' ', b'\t', b'\n', b'\r', b'/', b'>'):
+        end += 1
+    return buffer[start + 1:end], end
+
+
+def _skip(buffer, pos):
+    """If there is a comment, CDATA section or processing instruction at `pos` return the position after it"""
+    for opening, closing in [(b'<!--', b'-->'), (b'<![CDATA[', b']]>'), (b'<?', b'?>'), (b'<!', b'>')]:
+        if buffer[pos:pos + len(opening)] == opening:
+            end = buffer.find(closing, pos + len(opening))
+            if end < 0:
+                raise PassthroughError("unterminated markup at byte {}".format(pos))
+            return end + len(closing)
+    return None
+
+
+def find_text_ranges(buffer, path):
+    """Locate the text of elements at `path` in the bytes of an XML document
+
+    Only the element named by the second step of the path is searched for (e.g. `latticeList` for
+    '/segmentation/latticeList/lattice/data'); the elements below it are found by scanning its tags. Comments, CDATA
+    sections and processing instructions are skipped. Elements with child elements, comments or references in their
+    text are skipped.
+
+    :param buffer: the document as `bytes` or an `mmap`
+    :param str path: an absolute path of tags
+    :return: a list of `(start, end)` byte offsets
+    :rtype: list
+    :raises: :py:class:`PassthroughError` if the tags below the element are not well-formed
+    """
+    tags = [tag.encode('utf-8') for tag in path.strip('/').split('/')]
+    try:
+        assert len(tags) >= 2
+    except AssertionError:
+        raise ValueError("invalid pass-through path: {}".format(path))
+    ranges = list()
+    pos = 0
+    while True:
+        start = buffer.find(b'<' + tags[1], pos)
+        if start < 0:
+            return ranges
+        # the match may be inside a comment, CDATA section or processing instruction which opens before it
+        markup = [found for found in (buffer.find(b'<!', pos, start), buffer.find(b'<?', pos, start)) if found >= 0]
+        if markup:
+            pos = _skip(buffer, min(markup))
+            continue
+        name, pos = _tag_name(buffer, start)
+        if name != tags[1]:
+            continue
+        stack = list()
+        pos = start
+        while True:
+            pos = buffer.find(b'<', pos)
+            if pos < 0:
+                raise PassthroughError("unterminated <{}> at byte {}".format(tags[1].decode('utf-8'), start))
+            skipped = _skip(buffer, pos)
+            if skipped is not None:
+                pos = skipped
+                continue
+            if buffer[pos + 1:pos + 2] == b'/':
+                name, _ = _tag_name(buffer, pos + 1)
+                if not stack or stack.pop() != name:
+                    raise PassthroughError("unbalanced end tag at byte {}".format(pos))
+                pos = _end_of_tag(buffer, pos)
+                if not stack:
+                    break
+                continue
+            name, pos = _tag_name(buffer, pos)
+            pos = _end_of_tag(buffer, pos)
+            if buffer[pos - 2:pos - 1] == b'/':
+                if not stack:
+                    # an empty list e.g. <latticeList/>
+                    break
+                continue
+            stack.append(name)
+            if stack == tags[1:]:
+                end = buffer.find(b'<', pos)
+                if end < 0:
+                    raise PassthroughError("unterminated <{}> at byte {}".format(name.decode('utf-8'), pos))
+                closing = b'</' + name
+                if buffer[end:end + len(closing)] == closing and \
+                        not buffer[pos:end].translate(None, PAYLOAD_BYTES) and end > pos:
+                    ranges.append((pos, end))
+                pos = end
+
+
+def _end_of_tag(buffer, pos):
+    """The position after the '>' which closes the tag containing `pos`"""
+    end = buffer.find(b'>', pos)
+    if end < 0:
+        raise PassthroughError("unterminated tag at byte {}".format(pos))
+    return end + 1
+
+
+class Passthrough(object):
+    """Payloads of a file which are passed through to the output
+
+    :param str infile: the name of the input file
+    :param list ranges: the `(start, end)` byte offsets of the payloads
+    """
+
+    def __init__(self, infile, ranges):
+        self.infile = infile
+        self.ranges = ranges
+        token = uuid.uuid4().hex
+        self.placeholders = ["sfftk-passthrough-{}-{}".format(token, i) for i in range(len(ranges))]
+
+    @classmethod
+    def scan(cls, infile, paths):
+        """Locate the payloads at `paths` in `infile`
+
+        :param str infile: the name of the input file
+        :param list paths: absolute paths of elements whose text may be passed through
+        :return: a :py:class:`Passthrough` or `None` if there is nothing to pass through or `infile` is compressed
+        """
+        if get_compression(infile) is not None:
+            return None
+        with stage('passthrough_scan') as _stage:
+            with open(infile, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    ranges = sorted(r for path in paths for r in find_text_ranges(buffer, path))
+            if not ranges:
+                return None
+            _stage.count(payloads=len(ranges), payload_bytes=sum(end - start for start, end in ranges))
+        return cls(infile, ranges)
+
+    def parse(self):
+        """Parse the input with placeholders in place of the payloads
+
+        :return: the parsed document
+        :rtype: `lxml.etree._ElementTree`
+        :raises: :py:class:`sfftk_migrate.parsing.DocumentTooLarge` if the document is not expected to fit in memory
+        """
+        with stage('parse') as _stage:
+            _stage.count(expected_bytes=check_footprint(
+                self.infile, skip_bytes=sum(end - start for start, end in self.ranges)))
+            parser = get_parser()
+            with open(self.infile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                pos = 0
+                for (start, end), placeholder in zip(self.ranges + [(len(buffer), len(buffer))],
+                                                     self.placeholders + ['']):
+                    for chunk in range(pos, start, FEED_SIZE):
+                        parser.feed(buffer[chunk:min(chunk + FEED_SIZE, start)])
+                    if placeholder:
+                        parser.feed(placeholder.encode('ascii'))
+                    pos = end
+                _stage.count(bytes_read=len(buffer) - sum(end - start for start, end in self.ranges))
+                try:
+                    return parser.close().getroottree()
+                except etree.XMLSyntaxError as xse:
+                    # e.g. a payload was located inside markup the scan does not understand
+                    raise PassthroughError("unable to parse {} with placeholders: {}".format(self.infile, xse))
+
+    def write(self, current, outfile, encoding='utf-8', compression=None):
+        """Atomically write the migrated document `current` to `outfile` with the payloads in place
+
+        :param current: the migrated document or the name of a (possibly compressed) file containing it
+        :type current: `lxml.etree._ElementTree` or str
+        :param str outfile: the name of the output file
+        :param str encoding: the output encoding when `current` is a document [default: 'utf-8']
+        :param str compression: the compression of the output (see :py:mod:`sfftk_migrate.compression`)
+            [default: None]
+        :raises: :py:class:`PassthroughError` if a placeholder does not appear exactly once in the output
+        """
+        with stage('passthrough_write') as _stage:
+            if isinstance(current, str):
+                with open_input(current) as f:
+                    output = f.read()
+            else:
+                # serialised exactly as by :py:func:`sfftk_migrate.migrate.write_tree`
+                buffer = io.BytesIO()
+                current.write(buffer, xml_declaration=True, encoding=encoding, pretty_print=True)
+                output = buffer.getvalue()
+            positions = list()
+            for placeholder in self.placeholders:
+                placeholder = placeholder.encode('ascii')
+                position = output.find(placeholder)
+                if position < 0 or output.find(placeholder, position + 1) >= 0:
+                    raise PassthroughError("the migration did not copy every pass-through payload exactly once")
+                positions.append((position, position + len(placeholder)))
+            # payloads may have been reordered by the migration
+            order = sorted(range(len(positions)), key=lambda i: positions[i])
+            name = os.path.join(
+                os.path.dirname(os.path.abspath(outfile)),
+                '.{}.{}.tmp'.format(os.path.basename(outfile), uuid.uuid4().hex),
+            )
+            try:
+                with open_output(name, compression) as out, open(self.infile, 'rb') as src:
+                    pos = 0
+                    for i in order:
+                        start, end = positions[i]
+                        out.write(output[pos:start])
+                        _copy_range(src, out, *self.ranges[i], sendfile=compression is None)
+                        pos = end
+                    out.write(output[pos:])
+                _stage.count(bytes_written=os.path.getsize(name))
+                os.replace(name, outfile)
+            finally:
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+def _copy_range(src, out, start, end, sendfile=True):
+    """Copy bytes `start` to `end` of the file `src` to the file `out`; in the kernel if `sendfile` and possible"""
+    out.flush()
+    count = end - start
+    if sendfile and hasattr(os, 'sendfile'):
+        offset = start
+        try:
+            # sendfile writes at the current position of `out` without updating the Python file object
+            out_fd = out.fileno()
+            os.lseek(out_fd, out.tell(), os.SEEK_SET)
+            while count > 0:
+                sent = os.sendfile(out_fd, src.fileno(), offset, min(count, COPY_SIZE))
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        except OSError:
+            # e.g. sendfile does not support these files on this platform; copy whatever it did not
+            pass
+        out.seek(0, os.SEEK_END)
+        if count == 0:
+            return
+        start = offset
+    src.seek(start)
+    while count > 0:
+        chunk = src.read(min(count, COPY_SIZE))
+        if not chunk:
+            raise PassthroughError("the input file changed while migrating")
+        out.write(chunk)
+        count -= len(chunk)
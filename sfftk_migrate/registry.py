@@ -0,0 +1,238 @@
+"""
+registry
+========
+
+The `registry` module models the supported versions as a graph whose edges are migrations.
+
+Migrations are discovered once, on first use, from the modules in the migrations package and the stylesheets in
+the stylesheets directory: a module named `migrate_v{source}_to_v{target}` (with the dots of the versions replaced
+by underscores) is an edge from `source` to `target` and a stylesheet named `migrate_v{source}_to_v{target}.xsl`
+is attached to the edge of the same versions. Modules are only imported when a migration is about to use them.
+
+An edge may skip versions (a "shortcut" e.g. from v0.7.0.dev0 straight to the latest version). Each edge has a
+cost which is taken from the `COSTS` dictionary of the migrations package (`1.0` if absent) and the cheapest path
+is chosen; ties are broken in favour of fewer hops. The paths to a target are computed once for all sources and
+then cached so that batch runs do not plan each file afresh.
+
+.. code-block:: python
+
+    from sfftk_migrate.registry import REGISTRY
+
+    REGISTRY.get_path('0.7.0.dev0', '0.8.0.dev1')  # [('0.7.0.dev0', '0.8.0.dev1')]
+"""
+import heapq
+import importlib
+import os
+import pkgutil
+import re
+import threading
+
+from . import VERSION_LIST, MIGRATIONS_PACKAGE, STYLESHEETS_DIR
+
+DEFAULT_COST = 1.0
+
+
+class Migration(object):
+    """A single edge of the migration graph
+
+    :param str source: a valid version string
+    :param str target: a valid version string
+    :param str module_name: the fully-qualified name of the module implementing the migration
+    :param str stylesheet: the name of the stylesheet file (if any)
+    :param float cost: the relative cost of the migration
+    """
+
+    def __init__(self, source, target, module_name=None, stylesheet=None, cost=DEFAULT_COST):
+        self.source = source
+        self.target = target
+        self.module_name = module_name
+        self.stylesheet = stylesheet
+        self.cost = cost
+        self._module = None
+
+    @property
+    def module(self):
+        """The module implementing the migration; imported on first access"""
+        if self._module is None:
+            self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    def __repr__(self):
+        return "<Migration v{} -> v{} cost={}>".format(self.source, self.target, self.cost)
+
+
+class MigrationRegistry(object):
+    """Discovers migrations and plans the cheapest migration paths
+
+    :param str package: the package containing migration modules [default: `MIGRATIONS_PACKAGE`]
+    :param str stylesheets_dir: the directory containing stylesheets [default: `STYLESHEETS_DIR`]
+    :param str prefix: the name prefix of modules and stylesheets [default: 'migrate']
+    """
+
+    def __init__(self, package=MIGRATIONS_PACKAGE, stylesheets_dir=STYLESHEETS_DIR, prefix='migrate'):
+        self.package = package
+        self.stylesheets_dir = stylesheets_dir
+        self.prefix = prefix
+        self._migrations = None
+        self._stylesheets = None
+        self._plans = dict()
+        self._lock = threading.RLock()
+
+    def _discover(self):
+        """Find all modules and stylesheets; nothing is imported apart from the migrations package"""
+        package = importlib.import_module(self.package)
+        costs = getattr(package, 'COSTS', dict())
+        stylesheet_pattern = re.compile(r'^{}_v(.+)_to_v(.+)\.xsl$'.format(re.escape(self.prefix)))
+        stylesheets = dict()
+        if os.path.isdir(self.stylesheets_dir):
+            for fn in sorted(os.listdir(self.stylesheets_dir)):
+                match = stylesheet_pattern.match(fn)
+                if match:
+                    stylesheets[match.groups()] = os.path.join(self.stylesheets_dir, fn)
+        # module names lose the dots in versions so we map them back using the versions we know of
+        versions = set(VERSION_LIST)
+        for source, target in stylesheets:
+            versions.update([source, target])
+        for source, target in costs:
+            versions.update([source, target])
+        known = dict((version.replace('.', '_'), version) for version in versions)
+        module_pattern = re.compile(r'^{}_v(.+?)_to_v(.+)$'.format(re.escape(self.prefix)))
+        migrations = dict()
+        for module_info in pkgutil.iter_modules(package.__path__):
+            match = module_pattern.match(module_info.name)
+            if not match:
+                continue
+            source, target = (known.get(version, version) for version in match.groups())
+            migrations[(source, target)] = Migration(
+                source, target,
+                module_name="{}.{}".format(self.package, module_info.name),
+                stylesheet=stylesheets.get((source, target)),
+                cost=costs.get((source, target), DEFAULT_COST),
+            )
+        self._stylesheets = stylesheets
+        self._migrations = migrations
+
+    @property
+    def migrations(self):
+        """All migrations as a dictionary keyed by `(source, target)`"""
+        with self._lock:
+            if self._migrations is None:
+                self._discover()
+            return self._migrations
+
+    @property
+    def versions(self):
+        """All versions which are the source or target of some migration"""
+        versions = set(VERSION_LIST)
+        for source, target in self.migrations:
+            versions.update([source, target])
+        return versions
+
+    def register(self, source, target, module_name=None, stylesheet=None, cost=DEFAULT_COST):
+        """Add (or replace) a migration; cached plans are discarded
+
+        :param str source: a valid version string
+        :param str target: a valid version string
+        :param str module_name: the fully-qualified name of the module implementing the migration
+        :param str stylesheet: the name of the stylesheet file
+        :param float cost: the relative cost of the migration [default: 1.0]
+        :return: the migration
+        :rtype: :py:class:`Migration`
+        """
+        try:
+            assert cost > 0
+        except AssertionError:
+            raise ValueError("invalid cost {} for migration v{} -> v{}".format(cost, source, target))
+        migration = Migration(source, target, module_name=module_name, stylesheet=stylesheet, cost=cost)
+        with self._lock:
+            self.migrations[(source, target)] = migration
+            if stylesheet is not None:
+                self._stylesheets[(source, target)] = stylesheet
+            self._plans.clear()
+        return migration
+
+    def clear(self):
+        """Forget all migrations and plans; they are discovered again on next use"""
+        with self._lock:
+            self._migrations = None
+            self._stylesheets = None
+            self._plans.clear()
+
+    def get_migration(self, source, target):
+        """The migration from `source` to `target` or `None`"""
+        return self.migrations.get((source, target))
+
+    def get_module(self, source, target):
+        """The module implementing the migration from `source` to `target`
+
+        :raises: ImportError if there is no such migration
+        """
+        migration = self.get_migration(source, target)
+        if migration is None or migration.module_name is None:
+            raise ImportError("no migration module from v{} to v{}".format(source, target))
+        return migration.module
+
+    def get_stylesheet(self, source, target):
+        """The name of the stylesheet for the migration from `source` to `target` or `None`"""
+        with self._lock:
+            if self._stylesheets is None:
+                self._discover()
+            return self._stylesheets.get((source, target))
+
+    def plans(self, target):
+        """The cheapest paths from every version which can be migrated to `target`
+
+        Computed once per target by searching the graph backwards from `target`.
+
+        :param str target: a valid version string
+        :return: a dictionary of migration paths (lists of `(source, target)` tuples) keyed by source version
+        :rtype: dict
+        """
+        with self._lock:
+            if target not in self._plans:
+                self._plans[target] = self._plan(target)
+            return self._plans[target]
+
+    def _plan(self, target):
+        incoming = dict()
+        for (source, _target), migration in self.migrations.items():
+            if migration.module_name is not None:
+                incoming.setdefault(_target, list()).append(migration)
+        # Dijkstra's algorithm on the reversed graph: (cost, hops) with the path from each version to `target`
+        best = {target: (0.0, 0)}
+        paths = {target: list()}
+        queue = [(0.0, 0, target)]
+        while queue:
+            cost, hops, version = heapq.heappop(queue)
+            if (cost, hops) > best[version]:
+                continue
+            for migration in sorted(incoming.get(version, list()), key=lambda m: m.source):
+                candidate = (cost + migration.cost, hops + 1)
+                if migration.source not in best or candidate < best[migration.source]:
+                    best[migration.source] = candidate
+                    paths[migration.source] = [(migration.source, version)] + paths[version]
+                    heapq.heappush(queue, candidate + (migration.source,))
+        return paths
+
+    def get_path(self, source, target):
+        """The cheapest migration path from `source` to `target`
+
+        :param str source: a valid version string
+        :param str target: a valid version string
+        :return: a list of `(source, target)` tuples; empty if `target` cannot be reached from `source`
+        :rtype: list
+        :raises: ValueError if either version is unknown
+        """
+        versions = self.versions
+        try:
+            assert source in versions
+        except AssertionError:
+            raise ValueError("invalid migration start: '{}' is not a known version".format(source))
+        try:
+            assert target in versions
+        except AssertionError:
+            raise ValueError("invalid migration end: '{}' is not a known version".format(target))
+        return list(self.plans(target).get(source, list()))
+
+
+REGISTRY = MigrationRegistry()
@@ -0,0 +1,370 @@
+"""
+rules
+=====
+
+The `rules` module provides declarative migration rules as an alternative to XSL stylesheets.
+
+A migration module declares its changes as a list of rules in a module-level `RULES` variable:
+
+.. code-block:: python
+
+    from ..rules import add_field, change_value
+
+    PARAM_LIST = ['segmentation_details']
+
+    RULES = [
+        change_value('/segmentation/version', value='2'),
+        add_field('segment', 'details', param='segmentation_details'),
+    ]
+
+Rules are compiled into a :py:class:`RuleSet` and applied in a single streaming pass over the document (see
+:py:func:`apply_rules`). Several rule sets, one per hop of a migration path, may be applied in the same pass: each
+element is passed through the rule sets one after another as it is read so that a chain of hops costs a single
+traversal and no intermediate files.
+
+Paths select elements in the way XSL match patterns do: `/segmentation/name` only matches the `name` child of the
+root, `segment/name` matches any `name` whose parent is a `segment` and `*` matches any element. A step may have
+attribute predicates e.g. `segment[@id=1]/name`.
+
+Value rules (:py:func:`change_value` and :py:func:`change_value_list`) replace the content of an element with text so
+they are meant for simple (text-only) fields; the value they are passed is the text content of the source element.
+"""
+import re
+from collections import OrderedDict
+
+from lxml import etree
+
+from .compression import input_source, open_output
+from .parsing import iterparse
+from .timing import stage
+
+ADD_FIELD = 'add_field'
+DROP_FIELD = 'drop_field'
+RENAME_FIELD = 'rename_field'
+ADD_ATTRIBUTE = 'add_attribute'
+DROP_ATTRIBUTE = 'drop_attribute'
+RENAME_ATTRIBUTE = 'rename_attribute'
+CHANGE_VALUE = 'change_value'
+CHANGE_VALUE_LIST = 'change_value_list'
+OPERATIONS = [
+    ADD_FIELD, DROP_FIELD, RENAME_FIELD, ADD_ATTRIBUTE, DROP_ATTRIBUTE, RENAME_ATTRIBUTE, CHANGE_VALUE,
+    CHANGE_VALUE_LIST,
+]
+
+_STEP = re.compile(r"^(?P<tag>[\w.\-:]+|\*)(?P<predicates>(?:\[@[\w.\-:]+=(?:\"[^\"]*\"|'[^']*'|[^\]'\"]*)\])*)$")
+_PREDICATE = re.compile(r"\[@(?P<name>[\w.\-:]+)=(?:\"(?P<double>[^\"]*)\"|'(?P<single>[^']*)'|(?P<bare>[^\]'\"]*))\]")
+
+
+def _compile_path(path):
+    """Compile a path into a flag stating whether it is absolute and a list of steps of tag and predicates"""
+    absolute = path.startswith('/')
+    steps = list()
+    for step in (path[1:] if absolute else path).split('/'):
+        match = _STEP.match(step)
+        if match is None:
+            raise ValueError("invalid path: {}".format(path))
+        predicates = [
+            (predicate.group('name'), next(value for value in predicate.group('double', 'single', 'bare') if
+                                           value is not None))
+            for predicate in _PREDICATE.finditer(match.group('predicates'))
+        ]
+        steps.append((match.group('tag'), predicates))
+    return absolute, steps
+
+
+class Rule(object):
+    """A single migration operation on the elements selected by `path`; use the module functions to create rules"""
+
+    def __init__(self, operation, path, **options):
+        try:
+            assert operation in OPERATIONS
+        except AssertionError:
+            raise ValueError("invalid operation: {}".format(operation))
+        self.operation = operation
+        self.path = path
+        self.options = options
+        self._absolute, self._steps = _compile_path(path)
+
+    def __repr__(self):
+        return "{}({!r}, {})".format(
+            self.operation, self.path, ", ".join("{}={!r}".format(key, value) for key, value in self.options.items())
+        )
+
+    @property
+    def param(self):
+        """The name of the XSL-style param that provides the value of this rule, if any"""
+        return self.options.get('param')
+
+    def matches(self, stack):
+        """Whether this rule applies to the last element of `stack`, a list of `(tag, attrib)` from the root"""
+        if len(stack) < len(self._steps) or (self._absolute and len(stack) != len(self._steps)):
+            return False
+        for (tag, predicates), (element_tag, attrib) in zip(reversed(self._steps), reversed(stack)):
+            if tag != '*' and tag != element_tag:
+                return False
+            for name, value in predicates:
+                if attrib.get(name) != value:
+                    return False
+        return True
+
+    def get_value(self, params):
+        """The value of this rule either as given or from `params`"""
+        if self.param is None:
+            return self.options.get('value')
+        try:
+            return params[self.param]
+        except KeyError:
+            raise ValueError("no value provided for param '{}'".format(self.param))
+
+
+def _check_value(value, param):
+    if value is None and param is None:
+        raise ValueError("either a value or a param is required")
+    if value is not None and param is not None:
+        raise ValueError("only one of value or param may be set")
+
+
+def add_field(path, tag, value=None, param=None, text="\n"):
+    """Add a field with the given value after each element selected by `path`
+
+    :param str path: the path of the elements the new field follows
+    :param str tag: the tag of the new field
+    :param str value: the value of the new field
+    :param str param: the name of the param which provides the value of the new field (instead of `value`)
+    :param str text: the text (whitespace) written between the element and the new field [default: newline]
+    :return: a rule
+    :rtype: :py:class:`Rule`
+    """
+    _check_value(value, param)
+    return Rule(ADD_FIELD, path, tag=tag, value=value, param=param, text=text)
+
+
+def drop_field(path):
+    """Drop the elements selected by `path` together with their content"""
+    return Rule(DROP_FIELD, path)
+
+
+def rename_field(path, tag):
+    """Rename the elements selected by `path` to `tag` keeping their attributes and content"""
+    return Rule(RENAME_FIELD, path, tag=tag)
+
+
+def add_attribute(path, name, value=None, param=None):
+    """Set the attribute `name` on the elements selected by `path` to either `value` or the value of `param`"""
+    _check_value(value, param)
+    return Rule(ADD_ATTRIBUTE, path, name=name, value=value, param=param)
+
+
+def drop_attribute(path, name):
+    """Drop the attribute `name` from the elements selected by `path`"""
+    return Rule(DROP_ATTRIBUTE, path, name=name)
+
+
+def rename_attribute(path, name, new_name):
+    """Rename the attribute `name` of the elements selected by `path` to `new_name` keeping its position"""
+    return Rule(RENAME_ATTRIBUTE, path, name=name, new_name=new_name)
+
+
+def change_value(path, value=None, param=None):
+    """Replace the value of the elements selected by `path` with either `value` or the value of `param`"""
+    _check_value(value, param)
+    return Rule(CHANGE_VALUE, path, value=value, param=param)
+
+
+def change_value_list(path, function):
+    """Change the value of each element selected by `path` using `function`
+
+    :param str path: the path of the elements to change e.g. `segment/name` changes the names of all segments
+    :param function: either a callable which is passed the current value and returns the new value or a format
+        string in which `{}` stands for the current value e.g. `'This is {}'`
+    :return: a rule
+    :rtype: :py:class:`Rule`
+    """
+    if isinstance(function, str):
+        function = function.format
+    try:
+        assert callable(function)
+    except AssertionError:
+        raise ValueError("function should be callable or a format string")
+    return Rule(CHANGE_VALUE_LIST, path, function=function)
+
+
+class RuleSet(object):
+    """The rules of a single migration
+
+    :param list rules: a list of :py:class:`Rule` objects; every rule is checked against every element of the source
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        for rule in self.rules:
+            if not isinstance(rule, Rule):
+                raise TypeError("invalid rule: {!r}".format(rule))
+
+    @property
+    def params(self):
+        """The names of the params used by the rules in the order in which they are first used"""
+        params = list()
+        for rule in self.rules:
+            if rule.param is not None and rule.param not in params:
+                params.append(rule.param)
+        return params
+
+
+class _Pass(object):
+    """A single streaming pass which applies several rule sets in sequence"""
+
+    def __init__(self, rule_sets, params_list):
+        self.rule_sets = rule_sets
+        self.params_list = params_list
+        # the ancestors of the current element as seen by each rule set i.e. in the output of the previous rule set
+        self.stacks = [list() for _ in rule_sets]
+        self.elements = 0
+
+    def resolve(self, tag, attrib, start=0):
+        """Pass an element through the rule sets from `start` onwards
+
+        :return: a tuple of the resulting tag and attributes (`None` if the element is dropped), the element as seen
+            by each rule set, the value rules which apply to it and the fields to add after it
+        """
+        nodes = list()
+        value_rules = list()
+        additions = list()
+        for index in range(start, len(self.rule_sets)):
+            nodes.append((tag, attrib))
+            path = self.stacks[index] + [(tag, attrib)]
+            new_tag, new_attrib = tag, OrderedDict(attrib)
+            params = self.params_list[index]
+            for rule in self.rule_sets[index].rules:
+                if not rule.matches(path):
+                    continue
+                operation, options = rule.operation, rule.options
+                if operation == DROP_FIELD:
+                    return None, nodes, value_rules, additions
+                elif operation == RENAME_FIELD:
+                    new_tag = options['tag']
+                elif operation == ADD_ATTRIBUTE:
+                    new_attrib[options['name']] = rule.get_value(params)
+                elif operation == DROP_ATTRIBUTE:
+                    new_attrib.pop(options['name'], None)
+                elif operation == RENAME_ATTRIBUTE:
+                    if options['name'] in new_attrib:
+                        new_attrib = OrderedDict(
+                            (options['new_name'] if name == options['name'] else name, value) for name, value in
+                            new_attrib.items()
+                        )
+                elif operation in [CHANGE_VALUE, CHANGE_VALUE_LIST]:
+                    value_rules.append((index, rule))
+                elif operation == ADD_FIELD:
+                    additions.append((index, rule))
+            tag, attrib = new_tag, new_attrib
+        return (tag, attrib), nodes, value_rules, additions
+
+    def stream(self, xf, events, element):
+        """Write out the migrated `element` consuming events up to its end; called at its start event"""
+        self.elements += 1
+        result, nodes, value_rules, additions = self.resolve(element.tag, OrderedDict(element.attrib))
+        if result is None or value_rules:
+            # the content of the element is either dropped or replaced
+            depth = 1
+            for event, _element in events:
+                if event == 'start':
+                    depth += 1
+                elif event == 'end':
+                    depth -= 1
+                    if depth == 0:
+                        break
+        if result is not None:
+            tag, attrib = result
+            if value_rules:
+                value = ''.join(element.itertext())
+                value = self.apply_values(value, value_rules)
+                with xf.element(tag, attrib):
+                    xf.write(value or '')
+            else:
+                for stack, node in zip(self.stacks, nodes):
+                    stack.append(node)
+                with xf.element(tag, attrib):
+                    self.stream_content(xf, events, element)
+                for stack in self.stacks[:len(nodes)]:
+                    stack.pop()
+        self.write_additions(xf, additions)
+
+    def stream_content(self, xf, events, element):
+        """Write out the text and children of `element` consuming events up to its end"""
+        previous = None
+        for event, child in events:
+            if event == 'end':
+                break
+            # text is complete by the time the next node starts
+            if previous is None:
+                xf.write(element.text or '')
+            else:
+                xf.write(previous.tail or '')
+                element.remove(previous)
+            if event == 'start':
+                self.stream(xf, events, child)
+            elif event == 'comment':
+                xf.write(etree.Comment(child.text))
+            elif event == 'pi':
+                xf.write(etree.ProcessingInstruction(child.target, child.text))
+            previous = child
+        xf.write((element.text if previous is None else previous.tail) or '')
+
+    def apply_values(self, value, value_rules):
+        for index, rule in value_rules:
+            if rule.operation == CHANGE_VALUE:
+                value = rule.get_value(self.params_list[index])
+            else:
+                value = rule.options['function'](value)
+        return value
+
+    def write_additions(self, xf, additions):
+        """Write out the fields added by `additions`; each is passed through the rule sets after the one adding it"""
+        # a field added by a later rule set goes immediately after the element i.e. before those added earlier
+        for index, rule in sorted(additions, key=lambda addition: -addition[0]):
+            xf.write(rule.options['text'] or '')
+            result, nodes, value_rules, _additions = self.resolve(rule.options['tag'], OrderedDict(), start=index + 1)
+            if result is not None:
+                tag, attrib = result
+                value = self.apply_values(rule.get_value(self.params_list[index]), value_rules)
+                with xf.element(tag, attrib):
+                    xf.write(value or '')
+            self.write_additions(xf, _additions)
+
+
+def apply_rules(infile, outfile, rule_sets, params_list=None, encoding='UTF-8', compression=None):
+    """Apply one or more rule sets in a single streaming pass
+
+    The rule sets are applied in order, as though each were applied to the output of the previous one. Compressed
+    sources are decompressed as they are read.
+
+    :param str infile: the name of the source file
+    :param str outfile: the name of the output file
+    :param list rule_sets: a list of :py:class:`RuleSet` objects or lists of rules
+    :param list params_list: a dictionary of param values for each rule set
+    :param str encoding: the output encoding [default: 'UTF-8']
+    :param str compression: the compression of the output (see :py:mod:`sfftk_migrate.compression`) [default: None]
+    :return: the name of the output file
+    :rtype: str
+    """
+    rule_sets = [rule_set if isinstance(rule_set, RuleSet) else RuleSet(rule_set) for rule_set in rule_sets]
+    if params_list is None:
+        params_list = [dict() for _ in rule_sets]
+    try:
+        assert len(params_list) == len(rule_sets)
+    except AssertionError:
+        raise ValueError("incompatible lengths for rule_sets and params_list; they should be equal")
+    _pass = _Pass(rule_sets, params_list)
+    with stage('apply_rules') as _stage:
+        with input_source(infile) as source, open_output(outfile, compression) as f:
+            events = iterparse(source, events=('start', 'end', 'comment', 'pi'))
+            with etree.xmlfile(f, encoding=encoding) as xf:
+                xf.write_declaration()
+                for event, element in events:
+                    # only the root element is streamed; top-level comments and processing instructions are dropped
+                    if event == 'start':
+                        _pass.stream(xf, events, element)
+            f.write(b'\n')
+        _stage.count(elements=_pass.elements, rule_sets=len(rule_sets))
+    return outfile
@@ -0,0 +1,487 @@
+"""
+serve
+=====
+
+The `serve` module runs a long-lived migration daemon which accepts jobs over HTTP on a local UNIX socket or a
+localhost TCP port.
+
+The daemon compiles the bundled stylesheets, imports the migration modules and plans the migration paths once when it
+starts so that each job only pays for the migration itself. Jobs are run on a pool of threads (`lxml` releases the
+GIL while parsing, transforming and serialising) fed by a bounded queue: when the queue is full new jobs are refused
+with `503 Service Unavailable` and a `Retry-After` header so that clients back off. Room in the queue is checked
+before the body of a request is read; the bodies of refused requests are discarded as they arrive. Connections beyond
+the number of requests the daemon handles at once (`max_handlers`) are refused without being read at all. A flood of
+uploads is therefore never buffered in memory or on disk.
+
+Endpoints:
+
+* `POST /migrate` with a JSON body `{"infile": ..., "outfile": ..., "target_version": ..., "params": {...}}`
+  migrates a file; only `infile` is required. The response is a JSON object with the `infile`, `outfile`, `status`
+  (an `os` exit code), `error`, `skipped` and `seconds` of the job. Files which are already at the target version
+  are `skipped`: nothing is written and the `outfile` is the `infile`.
+
+* `POST /migrate` with an XML body (any content type other than `application/json`) migrates the document in the
+  body; the target version and XSL params are given in the query string
+  (`/migrate?target_version=0.8.0.dev1&segmentation_details=...`). The response body is the migrated document or,
+  if it is already at the target version, the document itself.
+
+* `GET /health` reports whether the daemon is accepting jobs; `GET /metrics` reports job counters, the queue length
+  and stylesheet cache statistics as JSON.
+
+* `POST /shutdown` shuts the daemon down gracefully, as do `SIGTERM` and `SIGINT`: no new jobs are accepted, queued
+  and running jobs are completed and then the daemon exits.
+
+.. code-block:: bash
+
+    ~$ sff-migrate serve --socket /tmp/sff-migrate.sock &
+    ~$ curl --unix-socket /tmp/sff-migrate.sock -d '{"infile": "emd_1547.sff"}' http://localhost/migrate
+"""
+import http.server
+import json
+import os
+import queue
+import shutil
+import signal
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlparse, parse_qsl
+
+from . import VERSION_LIST, STYLESHEETS_DIR
+from .batch import migrate_file
+from .core import get_output_name
+from .migrate import STYLESHEET_CACHE
+from .registry import REGISTRY
+from .utils import _print
+
+
+# requests handled on top of those for jobs so that health checks and metrics are answered when the queue is full
+HANDLER_SLACK = 4
+DISCARD_SIZE = 2 ** 16
+BUSY_BODY = json.dumps(dict(error="too many connections")).encode('utf-8')
+BUSY_RESPONSE = (
+    "HTTP/1.0 503 Service Unavailable\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+    "Retry-After: 1\r\nConnection: close\r\n\r\n".format(len(BUSY_BODY)).encode('ascii') + BUSY_BODY
+)
+
+
+class ServerBusy(Exception):
+    """Raised when a job is submitted to a daemon whose queue is full or which is shutting down"""
+
+
+class Job(object):
+    """A migration job; :py:meth:`wait` blocks until it has been run
+
+    :param str infile: the name of the file to migrate
+    :param str outfile: the name of the output file
+    :param str target_version: a valid version string
+    :param dict param_dict: XSL param values by name
+    """
+
+    def __init__(self, infile, outfile, target_version, param_dict):
+        self.id = uuid.uuid4().hex
+        self.infile = infile
+        self.outfile = outfile
+        self.target_version = target_version
+        self.param_dict = param_dict
+        self.result = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the job to be run
+
+        :param float timeout: the maximum number of seconds to wait
+        :return: the result (see :py:func:`sfftk_migrate.batch.migrate_file`) or `None` if the wait timed out
+        :rtype: dict
+        """
+        self._done.wait(timeout)
+        return self.result
+
+
+class MigrationServer(object):
+    """A pool of warm migration threads fed by a bounded queue and served over HTTP
+
+    :param str socket_path: listen on this UNIX socket; otherwise `host` and `port` are used
+    :param str host: the host to listen on [default: '127.0.0.1']
+    :param int port: the TCP port to listen on; 0 picks a free port [default: 8765]
+    :param int workers: the number of concurrent migrations [default: 4]
+    :param int queue_size: the maximum number of jobs waiting to run [default: 16]
+    :param str target_version: the default target version [default: the latest version]
+    :param bool verbose: verbose output
+    :param int max_handlers: the maximum number of requests handled at once; further connections are refused
+        [default: `workers + queue_size + HANDLER_SLACK`]
+    """
+
+    def __init__(self, socket_path=None, host='127.0.0.1', port=8765, workers=4, queue_size=16,
+                 target_version=VERSION_LIST[-1], verbose=False, max_handlers=None):
+        try:
+            assert workers >= 1
+        except AssertionError:
+            raise ValueError("workers should be at least 1")
+        try:
+            assert queue_size >= 1
+        except AssertionError:
+            raise ValueError("queue_size should be at least 1")
+        if max_handlers is None:
+            max_handlers = workers + queue_size + HANDLER_SLACK
+        try:
+            assert max_handlers >= 1
+        except AssertionError:
+            raise ValueError("max_handlers should be at least 1")
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.queue_size = queue_size
+        self.target_version = target_version
+        self.verbose = verbose
+        self.max_handlers = max_handlers
+        self.stopping = False
+        self.tmpdir = None
+        self.httpd = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = list()
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._counters = dict(submitted=0, rejected=0, completed=0, failed=0, running=0, seconds=0.0)
+        self._started = None
+
+    @property
+    def address(self):
+        """The address the daemon listens on: the socket path or a `(host, port)` tuple"""
+        if self.httpd is None:
+            return None
+        return self.httpd.server_address
+
+    def warm_up(self):
+        """Compile the bundled stylesheets, import the migration modules and plan the paths to the target version"""
+        STYLESHEET_CACHE.preload(
+            os.path.join(STYLESHEETS_DIR, stylesheet) for stylesheet in sorted(os.listdir(STYLESHEETS_DIR)) if
+            stylesheet.startswith('migrate_') and stylesheet.endswith('.xsl')
+        )
+        for migration_path in REGISTRY.plans(self.target_version).values():
+            for source, target in migration_path:
+                REGISTRY.get_module(source, target)
+
+    def start(self):
+        """Warm up, start the worker threads and bind the server; requests are handled by :py:meth:`serve_forever`"""
+        self.warm_up()
+        self.tmpdir = tempfile.mkdtemp(prefix='sff-migrate-serve-')
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.httpd = _UnixHTTPServer(self.socket_path, _Handler)
+        else:
+            self.httpd = _TCPHTTPServer((self.host, self.port), _Handler)
+        self.httpd.migration_server = self
+        self.httpd.handler_slots = threading.BoundedSemaphore(self.max_handlers)
+        self._started = time.time()
+        return self
+
+    def serve_forever(self):
+        """Handle requests until :py:meth:`shutdown` is called then complete all jobs and clean up
+
+        When called on the main thread `SIGTERM` and `SIGINT` shut the daemon down gracefully.
+        """
+        if threading.current_thread() is threading.main_thread():
+            for signum in [signal.SIGTERM, signal.SIGINT]:
+                signal.signal(signum, lambda signum, frame: self.shutdown())
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """Stop accepting jobs and stop serving; safe to call from any thread, including signal handlers"""
+        with self._lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        if self.verbose:
+            _print("shutting down...")
+        # `shutdown` blocks until `serve_forever` returns so it must not run on the thread serving requests
+        threading.Thread(target=self.httpd.shutdown, daemon=True).start()
+
+    def close(self):
+        """Complete queued and running jobs, stop the workers and release the socket"""
+        self.stopping = True
+        # queued jobs are run before the workers see the sentinels
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+        self.httpd.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def submit(self, infile, outfile=None, target_version=None, param_dict=None):
+        """Queue a job
+
+        :param str infile: the name of the file to migrate
+        :param str outfile: the name of the output file [default: <infile>_<target>.<ext>]
+        :param str target_version: a valid version string [default: the daemon's target version]
+        :param dict param_dict: XSL param values by name
+        :return: the job
+        :rtype: :py:class:`Job`
+        :raises: :py:class:`ServerBusy` if the queue is full or the daemon is shutting down
+        """
+        if target_version is None:
+            target_version = self.target_version
+        if outfile is None:
+            outfile = get_output_name(infile, target_version, prefix="")
+        job = Job(infile, outfile, target_version, param_dict if param_dict is not None else dict())
+        with self._lock:
+            if self.stopping:
+                self._counters['rejected'] += 1
+                raise ServerBusy("shutting down")
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._counters['rejected'] += 1
+                raise ServerBusy("queue is full ({} jobs)".format(self.queue_size))
+            self._counters['submitted'] += 1
+        return job
+
+    def reserve(self):
+        """Reserve room in the queue for a job whose request has not been read yet; see :py:meth:`release`
+
+        :raises: :py:class:`ServerBusy` if the queue (including other reservations) is full or the daemon is shutting
+            down
+        """
+        with self._lock:
+            if self.stopping:
+                self._counters['rejected'] += 1
+                raise ServerBusy("shutting down")
+            if self._queue.qsize() + self._reserved >= self.queue_size:
+                self._counters['rejected'] += 1
+                raise ServerBusy("queue is full ({} jobs)".format(self.queue_size))
+            self._reserved += 1
+
+    def release(self):
+        """Release a reservation made with :py:meth:`reserve` once its job has been submitted (or refused)"""
+        with self._lock:
+            self._reserved -= 1
+
+    def _refuse(self):
+        """Count a connection refused because too many requests are being handled"""
+        with self._lock:
+            self._counters['rejected'] += 1
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._counters['running'] += 1
+            start = time.perf_counter()
+            try:
+                result = migrate_file((job.infile, job.outfile, job.target_version, job.param_dict, None,
+                                       self.verbose))
+            finally:
+                seconds = time.perf_counter() - start
+                with self._lock:
+                    self._counters['running'] -= 1
+                    self._counters['seconds'] += seconds
+            result['seconds'] = seconds
+            with self._lock:
+                self._counters['completed' if result['status'] == os.EX_OK else 'failed'] += 1
+            job.result = result
+            job._done.set()
+
+    def health(self):
+        """The health of the daemon
+
+        :return: a dictionary with `status` ('ok' or 'stopping'), `queued` and `running`
+        :rtype: dict
+        """
+        with self._lock:
+            running = self._counters['running']
+        return dict(status='stopping' if self.stopping else 'ok', queued=self._queue.qsize(), running=running)
+
+    def metrics(self):
+        """Job counters, queue and stylesheet cache statistics
+
+        :rtype: dict
+        """
+        with self._lock:
+            metrics = dict(self._counters)
+        metrics.update(
+            queued=self._queue.qsize(),
+            queue_size=self.queue_size,
+            workers=self.workers,
+            uptime_seconds=time.time() - self._started if self._started is not None else 0.0,
+            stylesheet_cache=STYLESHEET_CACHE.info(),
+        )
+        return metrics
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = 'sff-migrate'
+    # whether this request holds a reservation in the queue
+    reserved = False
+
+    @property
+    def migration_server(self):
+        return self.server.migration_server
+
+    def log_message(self, format, *args):
+        if self.migration_server.verbose:
+            _print("{} {}".format(self.command, format % args))
+
+    def _send(self, code, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            health = self.migration_server.health()
+            self._send(200 if health['status'] == 'ok' else 503, health)
+        elif path == '/metrics':
+            self._send(200, self.migration_server.metrics())
+        else:
+            self._send(404, dict(error="not found: {}".format(path)))
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _discard_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, DISCARD_SIZE))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == '/shutdown':
+            self._read_body()
+            self._send(202, dict(status='stopping'))
+            self.migration_server.shutdown()
+        elif url.path == '/migrate':
+            try:
+                self.migration_server.reserve()
+                self.reserved = True
+            except ServerBusy as e:
+                self._send(503, dict(error=str(e)), headers={'Retry-After': '1'})
+                # the body is discarded as it arrives rather than buffered; the client expects to send all of it
+                self._discard_body()
+                return
+            try:
+                body = self._read_body()
+                if self.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json':
+                    self._migrate_file(body)
+                else:
+                    self._migrate_document(body, dict(parse_qsl(url.query)))
+            finally:
+                self._release()
+        else:
+            self._read_body()
+            self._send(404, dict(error="not found: {}".format(url.path)))
+
+    def _release(self):
+        if self.reserved:
+            self.migration_server.release()
+            self.reserved = False
+
+    def _submit(self, *args, **kwargs):
+        try:
+            return self.migration_server.submit(*args, **kwargs)
+        except ServerBusy as e:
+            self._send(503, dict(error=str(e)), headers={'Retry-After': '1'})
+        finally:
+            # the job is in the queue (or was refused) so it no longer needs the reservation
+            self._release()
+
+    def _migrate_file(self, body):
+        try:
+            request = json.loads(body.decode('utf-8'))
+            assert isinstance(request, dict) and 'infile' in request
+        except (ValueError, AssertionError):
+            self._send(400, dict(error="the body should be a JSON object with at least an 'infile'"))
+            return
+        job = self._submit(request['infile'], outfile=request.get('outfile'),
+                           target_version=request.get('target_version'), param_dict=request.get('params'))
+        if job is not None:
+            result = job.wait()
+            if result.get('skipped'):
+                result = dict(result, outfile=job.infile)
+            self._send(200 if result['status'] == os.EX_OK else 500, result)
+
+    def _migrate_document(self, body, query):
+        target_version = query.pop('target_version', None)
+        name = uuid.uuid4().hex
+        infile = os.path.join(self.migration_server.tmpdir, '{}.sff'.format(name))
+        outfile = os.path.join(self.migration_server.tmpdir, '{}_out.sff'.format(name))
+        with open(infile, 'wb') as f:
+            f.write(body)
+        try:
+            job = self._submit(infile, outfile=outfile, target_version=target_version, param_dict=query)
+            if job is None:
+                return
+            result = job.wait()
+            if result['status'] != os.EX_OK:
+                self._send(500, result)
+                return
+            if not os.path.exists(outfile):
+                # the document is already at the target version
+                self._send(200, body, content_type='application/xml')
+                return
+            with open(outfile, 'rb') as f:
+                self._send(200, f.read(), content_type='application/xml')
+        finally:
+            for fn in [infile, outfile]:
+                if os.path.exists(fn):
+                    os.remove(fn)
+
+
+class _BoundedThreadingMixIn(socketserver.ThreadingMixIn):
+    """Handle each request on a thread of its own but refuse connections once `handler_slots` are taken"""
+
+    def process_request(self, request, client_address):
+        if not self.handler_slots.acquire(blocking=False):
+            self.migration_server._refuse()
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super(_BoundedThreadingMixIn, self).process_request(request, client_address)
+        except Exception:
+            self.handler_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(_BoundedThreadingMixIn, self).process_request_thread(request, client_address)
+        finally:
+            self.handler_slots.release()
+
+
+class _TCPHTTPServer(_BoundedThreadingMixIn, http.server.HTTPServer):
+    allow_reuse_address = True
+
+
+class _UnixHTTPServer(_BoundedThreadingMixIn, socketserver.UnixStreamServer):
+    pass
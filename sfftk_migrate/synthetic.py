@@ -0,0 +1,147 @@
+"""
+synthetic
+=========
+
+The `synthetic` module generates synthetic EMDB-SFF v0.7.0.dev0 documents of arbitrary size for testing and
+benchmarking.
+
+Documents are written incrementally so that very large files can be generated in constant memory.
+"""
+import base64
+import random
+import zlib
+
+from lxml import etree
+
+SHAPES = ['cone', 'cuboid', 'cylinder', 'ellipsoid']
+
+
+def _element(xf, tag, text=None, **attrib):
+    """Write a simple element with optional text"""
+    with xf.element(tag, **attrib):
+        if text is not None:
+            xf.write(str(text))
+
+
+def _write_mesh(xf, mesh_id, num_vertices, normals, rng):
+    """Write a v0.7.0.dev0 mesh with `num_vertices` surface vertices and about twice as many triangles"""
+    with xf.element('mesh', id=str(mesh_id)):
+        num_listed = 2 * num_vertices if normals else num_vertices
+        with xf.element('vertexList', numVertices=str(num_listed)):
+            for i in range(num_vertices):
+                if normals:
+                    # surface and normal vertices alternate so that vID 2i is a surface and 2i + 1 its normal
+                    designations = [(2 * i, 'surface'), (2 * i + 1, 'normal')]
+                else:
+                    designations = [(i, None)]
+                for vertex_id, designation in designations:
+                    attrib = dict(vID=str(vertex_id))
+                    if designation is not None:
+                        attrib['designation'] = designation
+                    with xf.element('v', **attrib):
+                        for axis in 'xyz':
+                            _element(xf, axis, repr(rng.uniform(0, 100)))
+        num_polygons = 2 * num_vertices
+        with xf.element('polygonList', numPolygons=str(num_polygons)):
+            for polygon_id in range(num_polygons):
+                with xf.element('P', PID=str(polygon_id)):
+                    for vertex_index in rng.sample(range(num_vertices), 3):
+                        if normals:
+                            _element(xf, 'v', 2 * vertex_index)
+                            _element(xf, 'v', 2 * vertex_index + 1)
+                        else:
+                            _element(xf, 'v', vertex_index)
+
+
+def _write_shape(xf, shape_id, transform_id, rng):
+    """Write a shape primitive of a random kind"""
+    kind = SHAPES[shape_id % len(SHAPES)]
+    with xf.element(kind, id=str(shape_id)):
+        if kind == 'cone':
+            _element(xf, 'height', rng.uniform(1, 10))
+            _element(xf, 'bottomRadius', rng.uniform(1, 10))
+        elif kind == 'cylinder':
+            _element(xf, 'height', rng.uniform(1, 10))
+            _element(xf, 'diameter', rng.uniform(1, 10))
+        else:
+            for axis in 'xyz':
+                _element(xf, axis, rng.uniform(1, 10))
+        _element(xf, 'transformId', transform_id)
+
+
+def generate(outfile, segments=10, vertices=1000, normals=True, shapes=0, transforms=1, lattice_size=0, seed=0):
+    """Generate a synthetic v0.7.0.dev0 document
+
+    :param outfile: the name of the output file or a writable binary file object
+    :param int segments: the number of segments
+    :param int vertices: the number of surface vertices in each segment's mesh; with 0 segments have no mesh
+    :param bool normals: whether meshes have normals [default: True]
+    :param int shapes: the number of shape primitives per segment
+    :param int transforms: the number of transforms
+    :param int lattice_size: the number of (uncompressed) bytes in the lattice; with 0 there is no lattice
+    :param int seed: the random seed
+    :return: a dictionary describing the document
+    :rtype: dict
+    """
+    if 0 < vertices < 3:
+        raise ValueError("meshes need at least 3 vertices")
+    rng = random.Random(seed)
+    with etree.xmlfile(outfile, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element('segmentation'):
+            _element(xf, 'version', '0.7.0.dev0')
+            _element(xf, 'name', 'Synthetic Segmentation')
+            with xf.element('software'):
+                _element(xf, 'name', 'sfftk-migrate')
+                _element(xf, 'version', 'synthetic')
+                _element(xf, 'processingDetails', 'Generated for benchmarking')
+            if transforms:
+                with xf.element('transformList'):
+                    for transform_id in range(transforms):
+                        with xf.element('transformationMatrix', id=str(transform_id)):
+                            _element(xf, 'rows', 3)
+                            _element(xf, 'cols', 4)
+                            _element(xf, 'data', ' '.join(str(float(i)) for i in range(12)))
+            _element(xf, 'primaryDescriptor', 'meshList' if vertices else 'threeDVolume')
+            _element(xf, 'boundingBox', xmax="100.0", ymax="100.0", zmax="100.0")
+            with xf.element('segmentList'):
+                shape_id = 0
+                for segment_id in range(1, segments + 1):
+                    with xf.element('segment', id=str(segment_id), parentID="0"):
+                        with xf.element('biologicalAnnotation'):
+                            _element(xf, 'name', 'segment {}'.format(segment_id))
+                            _element(xf, 'description', 'a synthetic segment')
+                            _element(xf, 'numberOfInstances', 1)
+                        with xf.element('colour'):
+                            for channel in ['red', 'green', 'blue']:
+                                _element(xf, channel, rng.random())
+                        if shapes:
+                            with xf.element('shapePrimitiveList'):
+                                for _ in range(shapes):
+                                    _write_shape(xf, shape_id, shape_id % max(transforms, 1), rng)
+                                    shape_id += 1
+                        if vertices:
+                            with xf.element('meshList'):
+                                _write_mesh(xf, 0, vertices, normals, rng)
+                        if lattice_size:
+                            with xf.element('threeDVolume'):
+                                _element(xf, 'latticeId', 0)
+                                _element(xf, 'value', float(segment_id))
+            if lattice_size:
+                # a cube of uint8 voxels
+                side = max(int(round(lattice_size ** (1 / 3))), 1)
+                data = bytes(rng.randrange(segments + 1) for _ in range(side ** 3))
+                with xf.element('latticeList'):
+                    with xf.element('lattice', id="0"):
+                        _element(xf, 'mode', 'uint8')
+                        _element(xf, 'endianness', 'little')
+                        for tag, value in [('size', side), ('start', 0)]:
+                            with xf.element(tag):
+                                for dimension in ['cols', 'rows', 'sections']:
+                                    _element(xf, dimension, value)
+                        _element(xf, 'data', base64.b64encode(zlib.compress(data)).decode('ASCII'))
+            _element(xf, 'details', 'synthetic')
+    return dict(
+        segments=segments, vertices=vertices, normals=normals, shapes=shapes, transforms=transforms,
+        lattice_size=lattice_size, num_vertices=segments * vertices, num_triangles=segments * 2 * vertices,
+    )
@@ -1,16 +1,44 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import base64
+import http.client
 import inspect
+import json
+import multiprocessing
 import os
+import shutil
+import socket
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import types
 import unittest
+import unittest.mock
 
 from lxml import etree
 
-from . import XSL, XML, VERSION_LIST
-from .core import get_module, get_stylesheet, get_source_version, get_migration_path, list_versions
-from .main import parse_args
-from .migrate import migrate_by_stylesheet, do_migration, get_params
+from . import XSL, XML, VERSION_LIST, MODE, ENGINES, STYLESHEETS_DIR
+from .cache import PayloadCache, ResultCache, parse_size
+from .compression import EXTENSIONS, get_compression, get_size, open_input, open_output
+from .core import get_module, get_stylesheet, get_source_version, get_migration_path, list_versions, parse_document, \
+    get_output_name
+from . import aio
+from .batch import MigrationTimeout, collect_files, migrate_batch, migrate_file, summarise
+from .main import cache_main, parse_args, parse_batch_args, parse_cache_args, parse_serve_args
+from .parsing import DocumentTooLarge, SAMPLES, SAMPLE_SIZE, configure, estimate_footprint, get_options, get_parser, \
+    parser_options
+from .passthrough import Passthrough, PassthroughError, _copy_range, find_text_ranges
+from .registry import MigrationRegistry
+from .serve import MigrationServer, ServerBusy
+from .rules import add_field, drop_field, rename_field, add_attribute, drop_attribute, rename_attribute, \
+    change_value, change_value_list, apply_rules, RuleSet
+from .synthetic import generate
+from .timing import aggregate, format_report, profiling, stage
+from .migrate import migrate_by_stylesheet, do_migration, get_params, transform_by_stylesheet, StylesheetCache, \
+    STYLESHEET_CACHE, count_tag_paths, get_dropped_fields, get_template_profile
 from .utils import _print, _check, _decode_data
 
 replace_list = [
@@ -67,6 +95,55 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(IOError):
             migrate_by_stylesheet('file.xml', 'file.xsl')
 
+    def test_transform_by_stylesheet(self):
+        """Test that we can transform an already parsed document"""
+        original = etree.parse(os.path.join(XML, 'original.xml'))
+        stylesheet = os.path.join(XSL, 'original_to_change_field_rename_field.xsl')
+        migrated = transform_by_stylesheet(original, stylesheet)
+        self.assertIsInstance(migrated, etree._ElementTree)
+        reference = etree.parse(os.path.join(XML, 'change_field_rename_field.xml'))
+        self.assertTrue(compare_elements(reference.getroot(), migrated.getroot()))
+        with self.assertRaises(TypeError):
+            transform_by_stylesheet(original, 1)
+
+    def test_stylesheet_cache(self):
+        """Test that compiled stylesheets are cached and invalidated"""
+        cache = StylesheetCache(maxsize=2)
+        stylesheet = get_stylesheet("1", "2")
+        transform = cache.get(stylesheet)
+        self.assertIsInstance(transform, etree.XSLT)
+        self.assertIs(cache.get(stylesheet), transform)
+        self.assertEqual(cache.info(), dict(hits=1, misses=1, size=1, maxsize=2))
+        # preload
+        cache.preload([os.path.join(XSL, 'identity.xsl'), os.path.join(XSL, 'original_to_drop_field.xsl')])
+        # the least recently used entry has been evicted
+        self.assertEqual(cache.info()['size'], 2)
+        cache.get(stylesheet)
+        self.assertEqual(cache.info()['misses'], 4)
+        # explicit invalidation
+        cache.invalidate(stylesheet)
+        self.assertEqual(cache.info()['size'], 1)
+        cache.invalidate()
+        self.assertEqual(cache.info()['size'], 0)
+        # changes to a stylesheet or to the stylesheets it includes trigger a recompilation
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for fn in ['migrate_v1_to_v2.xsl', 'identity.xsl']:
+                shutil.copy(os.path.join(os.path.dirname(stylesheet), fn), tmpdir)
+            _stylesheet = os.path.join(tmpdir, 'migrate_v1_to_v2.xsl')
+            transform = cache.get(_stylesheet)
+            self.assertIs(cache.get(_stylesheet), transform)
+            stat = os.stat(os.path.join(tmpdir, 'identity.xsl'))
+            os.utime(os.path.join(tmpdir, 'identity.xsl'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertIsNot(cache.get(_stylesheet), transform)
+        finally:
+            shutil.rmtree(tmpdir)
+        # the process-wide cache is used by migrate_by_stylesheet
+        misses = STYLESHEET_CACHE.info()['misses']
+        migrate_by_stylesheet(os.path.join(XML, 'original.xml'), stylesheet, segmentation_details="details")
+        migrate_by_stylesheet(os.path.join(XML, 'original.xml'), stylesheet, segmentation_details="details")
+        self.assertLessEqual(STYLESHEET_CACHE.info()['misses'], misses + 1)
+
     def test_parse_args(self):
         """Test correct arguments"""
         # default with -t/--target-version
@@ -125,6 +202,17 @@ class TestUtils(unittest.TestCase):
         fn_v08 = os.path.join(XML, 'test2_v0.8.0.dev1.sff')
         source_version_v08 = get_source_version(fn_v08)
         self.assertEqual(source_version_v08, '0.8.0.dev1')
+        # only the beginning of the file is read so a truncated file still works
+        with open(fn_v07, 'rb') as f:
+            head = f.read(1000)
+        with tempfile.NamedTemporaryFile(suffix='.sff', delete=False) as f:
+            f.write(head)
+        self.assertEqual(get_source_version(f.name), '0.7.0.dev0')
+        with self.assertRaises(etree.XMLSyntaxError):
+            get_source_version(f.name, stream=False)
+        os.remove(f.name)
+        # non-trivial paths fall back to a full parse
+        self.assertEqual(get_source_version(fn_v07, path="/segmentation[1]/version"), '0.7.0.dev0')
 
     def test_get_migration_path(self):
         """Determine the sequence of migrations to perform"""
@@ -138,6 +226,38 @@ class TestUtils(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, r".*invalid migration end.*"):
             get_migration_path('1', '9', version_list=version_list)
 
+    def test_migration_registry(self):
+        """Plan the cheapest path through the graph of migrations"""
+        # bundled migrations are discovered without being imported
+        registry = MigrationRegistry()
+        migration = registry.get_migration('0.7.0.dev0', '0.8.0.dev1')
+        self.assertIsNone(migration._module)
+        self.assertEqual(migration.stylesheet, get_stylesheet('0.7.0.dev0', '0.8.0.dev1'))
+        self.assertEqual(registry.get_path('0.7.0.dev0', '0.8.0.dev1'), [('0.7.0.dev0', '0.8.0.dev1')])
+        self.assertIs(registry.get_module('0.7.0.dev0', '0.8.0.dev1'), get_module('0.7.0.dev0', '0.8.0.dev1'))
+        self.assertEqual(get_migration_path('1', '2'), [('1', '2')])
+        # shortcuts are taken when they are cheaper
+        registry = MigrationRegistry()
+        for source, target in [('1', '2'), ('2', '3'), ('3', '4')]:
+            registry.register(source, target, module_name='module_v{}_to_v{}'.format(source, target))
+        self.assertEqual(registry.get_path('1', '4'), [('1', '2'), ('2', '3'), ('3', '4')])
+        plans = registry.plans('4')
+        self.assertIs(registry.plans('4'), plans)
+        registry.register('1', '3', module_name='module_v1_to_v3', cost=1.5)
+        self.assertEqual(registry.get_path('1', '4'), [('1', '3'), ('3', '4')])
+        self.assertEqual(registry.get_path('2', '4'), [('2', '3'), ('3', '4')])
+        # equal costs prefer fewer hops
+        registry.register('1', '3', module_name='module_v1_to_v3', cost=2.0)
+        self.assertEqual(registry.get_path('1', '4'), [('1', '3'), ('3', '4')])
+        # unreachable targets have empty paths
+        self.assertEqual(registry.get_path('4', '1'), [])
+        with self.assertRaisesRegex(ValueError, r".*invalid migration start.*"):
+            registry.get_path('0', '4')
+        with self.assertRaisesRegex(ValueError, r".*invalid migration end.*"):
+            registry.get_path('1', '9')
+        with self.assertRaisesRegex(ValueError, r".*invalid cost.*"):
+            registry.register('1', '4', cost=0)
+
     def test_do_migration_example(self):
         """Toy migration example"""
         version_list = ['1', '2']
@@ -159,6 +279,32 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(output.xpath('/segmentation/details/text()')[0], _text)
         os.remove(args.outfile)
 
+    def test_do_migration_chain(self):
+        """Chain several hops in memory, falling back to files for modules without migrate_tree"""
+        module = get_module('1', '2')
+        stylesheet = get_stylesheet('1', '2')
+        file_module = types.SimpleNamespace(PARAM_LIST=module.PARAM_LIST, migrate=module.migrate)
+        tree_module = types.SimpleNamespace(PARAM_LIST=module.PARAM_LIST, migrate_tree=module.migrate_tree)
+        outfile = os.path.join(XML, "my_chain_output.xml")
+        args = parse_args("{} --target-version 4 --outfile {}".format(os.path.join(XML, "original.xml"), outfile))
+        before = set(os.listdir(XML))
+        for modules in [
+            [tree_module, tree_module, tree_module],  # entirely in memory
+            [tree_module, file_module, tree_module],  # file-based hop in the middle
+            [file_module, tree_module, file_module],  # file-based first and last hops
+        ]:
+            _modules = iter(modules)
+            with unittest.mock.patch('sfftk_migrate.migrate.get_module', lambda source, target: next(_modules)), \
+                    unittest.mock.patch('sfftk_migrate.migrate.get_stylesheet', lambda source, target: stylesheet):
+                status = do_migration(args, value_list=["details"], version_list=['1', '2', '3', '4'])
+            self.assertEqual(status, os.EX_OK)
+            output = etree.parse(outfile)
+            self.assertEqual(output.xpath('/segmentation/version/text()')[0], '2')
+            self.assertEqual(len(output.xpath('/segmentation/details')), 3)
+            # no temporary files are left behind
+            self.assertEqual(set(os.listdir(XML)), before.union({os.path.basename(outfile)}))
+            os.remove(outfile)
+
     def test_do_migration(self):
         """Do an actual migration using the convenience function"""
         # try a null migration
@@ -216,6 +362,11 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(len(params), 1)
         with self.assertRaises(ValueError):
             get_params(module.PARAM_LIST, value_list=[_text, _text])
+        # values by name never prompt
+        self.assertEqual(get_params(module.PARAM_LIST, param_dict={'segmentation_details': _text}),
+                         {'segmentation_details': _text})
+        with self.assertRaisesRegex(ValueError, r".*no value provided.*"):
+            get_params(module.PARAM_LIST, param_dict=dict())
 
     def test_list_versions(self):
         """Test that we can list the supported versions"""
@@ -258,6 +409,26 @@ class TestMigrations(unittest.TestCase):
         sys.stderr.write('\n')
         sys.stderr.write('migrated:\n' + etree.tostring(migrated).decode('utf-8'))
 
+    def test_get_dropped_fields(self):
+        """Test the structured report of dropped fields"""
+        original = etree.parse(os.path.join(XML, 'original.xml'))
+        counts = count_tag_paths(original)
+        self.assertEqual(list(counts.keys()), [
+            '/segmentation', '/segmentation/name', '/segmentation/version', '/segmentation/segment',
+            '/segmentation/segment/name'
+        ])
+        self.assertEqual(sum(counts.values()), 5)
+        migrated = transform_by_stylesheet(original, os.path.join(XSL, 'original_to_drop_field.xsl'))
+        self.assertEqual(dict(get_dropped_fields(original, migrated)), {'/segmentation/name': 1})
+        # nothing is dropped by the identity transform
+        migrated = transform_by_stylesheet(original, os.path.join(XSL, 'identity.xsl'))
+        self.assertEqual(len(get_dropped_fields(original, migrated)), 0)
+        # meshes are summarised by tag path
+        original = etree.parse(os.path.join(XML, 'test2.sff'))
+        migrated = transform_by_stylesheet(original, get_stylesheet("0.7.0.dev0", "0.8.0.dev1"))
+        dropped_fields = get_dropped_fields(original, migrated)
+        self.assertEqual(dropped_fields['/segmentation/segmentList/segment/meshList/mesh/polygonList/P'], 2904)
+
     def test_original_to_change_field_rename_field(self):
         """Test changing a field by renaming it"""
         original = os.path.join(XML, 'original.xml')
@@ -339,6 +510,91 @@ class TestMigrations(unittest.TestCase):
         sys.stderr.write('migrated:\n' + etree.tostring(migrated).decode('utf-8'))
         self.assertTrue(same)
 
+    def test_rules(self):
+        """Test that declarative rules migrate the same way as the equivalent stylesheets"""
+        outfile = os.path.join(XML, 'tmp_rules.xml')
+        for original, stylesheet, rules, params in [
+            ('original.xml', 'original_to_add_field.xsl',
+             [add_field('segment', 'details', param='segmentation_details')], dict(segmentation_details='details')),
+            ('original.xml', 'original_to_drop_field.xsl', [drop_field('/segmentation/name')], dict()),
+            ('original.xml', 'original_to_change_field_rename_field.xsl', [rename_field('/segmentation/name', 'names')],
+             dict()),
+            ('original.xml', 'original_to_change_field_add_attribute.xsl',
+             [add_attribute('/segmentation/name', 'lang', param='segmentation_name_lang')],
+             dict(segmentation_name_lang='en')),
+            ('original.xml', 'original_to_change_field_drop_attribute.xsl', [drop_attribute('*', 'id')], dict()),
+            ('original.xml', 'original_to_change_field_rename_attribute.xsl',
+             [rename_attribute('*', 'id', 'segment_id')], dict()),
+            ('original.xml', 'original_to_change_field_change_value.xsl',
+             [change_value('segment[@id=1]/name', param='segment_name')], dict(segment_name='a new name')),
+            ('original_list.xml', 'original_to_change_value_list.xsl',
+             [change_value_list('segment/name', 'This is {}')], dict()),
+        ]:
+            reference = migrate_by_stylesheet(os.path.join(XML, original), os.path.join(XSL, stylesheet), **params)
+            self.assertEqual(RuleSet(rules).params, list(params.keys()))
+            apply_rules(os.path.join(XML, original), outfile, [rules], params_list=[params])
+            migrated = etree.parse(outfile)
+            self.assertTrue(compare_elements(etree.XML(reference), migrated.getroot()), stylesheet)
+        # rules are validated
+        with self.assertRaisesRegex(ValueError, r".*invalid path.*"):
+            drop_field('segment[id=1]')
+        with self.assertRaisesRegex(ValueError, r".*either a value or a param.*"):
+            change_value('name')
+        with self.assertRaisesRegex(TypeError, r".*invalid rule.*"):
+            RuleSet(['drop_field'])
+        with self.assertRaisesRegex(ValueError, r".*no value provided for param.*"):
+            apply_rules(os.path.join(XML, 'original.xml'), outfile, [[change_value('name', param='name')]])
+        os.remove(outfile)
+
+    def test_fused_rules(self):
+        """Test that consecutive hops migrated by rules are fused into a single pass"""
+        rule_sets = [
+            [change_value('/segmentation/version', value='2'), add_field('segment', 'details', param='details'),
+             rename_attribute('segment', 'id', 'segment_id')],
+            [rename_field('segment/name', 'label'), add_field('segment', 'details', value='3'),
+             add_field('details', 'note', value='a note', text='\n\t')],
+            [drop_field('/segmentation/name'), change_value_list('label', 'This is {}'),
+             add_attribute('segment[@segment_id=1]', 'kind', value='first'), rename_field('details', 'info')],
+        ]
+        params_list = [dict(details='2'), dict(), dict()]
+        original = os.path.join(XML, 'original_list.xml')
+        # fusing is the same as applying the rule sets one after another
+        current = original
+        for i, (rules, params) in enumerate(zip(rule_sets, params_list)):
+            outfile = os.path.join(XML, 'tmp_rules_{}.xml'.format(i))
+            apply_rules(current, outfile, [rules], params_list=[params])
+            current = outfile
+        fused = os.path.join(XML, 'tmp_rules_fused.xml')
+        apply_rules(original, fused, rule_sets, params_list=params_list)
+        with open(current, 'rb') as f, open(fused, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        for i in range(len(rule_sets) - 1):
+            os.remove(os.path.join(XML, 'tmp_rules_{}.xml'.format(i)))
+        # do_migration fuses the hops of modules with rules
+        modules = iter([types.SimpleNamespace(RULES=rules) for rules in rule_sets])
+        args = parse_args("{} --target-version 4 --outfile {}".format(original, fused))
+        before = set(os.listdir(XML))
+        with unittest.mock.patch('sfftk_migrate.migrate.get_module', lambda source, target: next(modules)), \
+                profiling() as profiler:
+            status = do_migration(args, param_dict=dict(details='2'), version_list=['1', '2', '3', '4'])
+        self.assertEqual(status, os.EX_OK)
+        stages = dict((record['path'], record) for record in profiler.report()['stages'])
+        self.assertEqual(stages['do_migration/hop v1->v2->v3->v4/migrate/apply_rules']['counters']['rule_sets'], 3)
+        with open(current, 'rb') as f, open(fused, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(set(os.listdir(XML)), before)
+        os.remove(fused)
+        os.remove(current)
+        # the rules of a module which also has a stylesheet are used by the other engines
+        outputs = list()
+        for engine in ['tree', 'streaming']:
+            args = parse_args("{} --target-version 2 --outfile {} --engine {}".format(original, fused, engine))
+            do_migration(args, param_dict=dict(segmentation_details='details'), version_list=['1', '2'])
+            with open(fused, 'rb') as f:
+                outputs.append(f.read())
+            os.remove(fused)
+        self.assertEqual(outputs[0], outputs[1])
+
 
 class TestEMDBSFFMigrations(unittest.TestCase):
     def test_migrate_mesh_exceptions(self):
@@ -352,6 +608,8 @@ class TestEMDBSFFMigrations(unittest.TestCase):
             module.migrate_mesh(mesh, triangles_mode='other')
         with self.assertRaisesRegex(ValueError, r".*invalid vertices mode.*"):
             module.migrate_mesh(mesh, vertices_mode='other')
+        with self.assertRaisesRegex(ValueError, r".*invalid mesh engine.*"):
+            module.migrate_mesh(mesh, engine='other')
         # no geometry
         verts, norms, tris = module.migrate_mesh(mesh)
         self.assertIsInstance(verts, etree._Element)
@@ -371,6 +629,139 @@ class TestEMDBSFFMigrations(unittest.TestCase):
         self.assertEqual(tris.get("endianness"), signature.parameters['endianness'].default)
         self.assertEqual(tris.get("data"), "")
 
+    @unittest.skipIf(get_module('0.7.0.dev0', '0.8.0.dev1').numpy is None, "numpy is not installed")
+    def test_migrate_mesh_engines(self):
+        """Test that the numpy and pure-Python mesh engines produce identical elements"""
+        module = get_module('0.7.0.dev0', '0.8.0.dev1')
+        for fn in ['test2.sff', 'test7.sff']:
+            original = etree.parse(os.path.join(XML, fn))
+            for mesh in original.xpath('/segmentation/segmentList/segment/meshList/mesh'):
+                for endianness in ['little', 'big']:
+                    python_elements = module.migrate_mesh(mesh, endianness=endianness, engine='python')
+                    numpy_elements = module.migrate_mesh(mesh, endianness=endianness, engine='numpy')
+                    for python_element, numpy_element in zip(python_elements, numpy_elements):
+                        self.assertEqual(etree.tostring(python_element), etree.tostring(numpy_element))
+        # a vertex with 2 coordinates next to one with 4 is invalid even though there are 3 per vertex overall
+        mesh = etree.fromstring(
+            '<mesh><vertexList numVertices="2">'
+            '<v vID="0"><x>0</x><y>0</y></v><v vID="1"><x>1</x><y>1</y><z>1</z><z>1</z></v>'
+            '</vertexList><polygonList numPolygons="1"><P PID="0"><v>0</v><v>1</v><v>0</v></P></polygonList></mesh>'
+        )
+        for engine in ['python', 'numpy']:
+            with self.assertRaisesRegex(ValueError, r".*invalid vertex.*"):
+                module.migrate_mesh(mesh, engine=engine)
+
+    def test_mesh_encoding(self):
+        """Test that 'auto' picks the narrowest type which represents every index and that types are range checked"""
+        module = get_module('0.7.0.dev0', '0.8.0.dev1')
+        original = etree.parse(os.path.join(XML, 'test7.sff'))
+        engines = ['python'] if module.numpy is None else ['python', 'numpy']
+        for mesh in original.xpath('/segmentation/segmentList/segment/meshList/mesh'):
+            _, _, triangles = module.migrate_mesh(mesh)
+            expected = struct.unpack('<{}I'.format(3 * int(triangles.get('num_triangles'))),
+                                     base64.b64decode(triangles.get('data')))
+            for engine in engines:
+                _, _, auto_triangles = module.migrate_mesh(mesh, triangles_mode='auto', engine=engine)
+                mode = auto_triangles.get('mode')
+                self.assertEqual(mode, module.get_triangles_mode(max(expected)))
+                self.assertEqual(struct.unpack('<{}{}'.format(len(expected), MODE[mode]),
+                                               base64.b64decode(auto_triangles.get('data'))), expected)
+                if mode != 'uint8':
+                    with self.assertRaisesRegex(ValueError, r".*out of range for mode uint8.*"):
+                        module.migrate_mesh(mesh, triangles_mode='uint8', engine=engine)
+        self.assertEqual([module.get_triangles_mode(i) for i in [0, 255, 256, 2 ** 16, 2 ** 32]],
+                         ['uint8', 'uint8', 'uint16', 'uint32', 'uint64'])
+        # vertices too large for float32
+        mesh = etree.fromstring(
+            '<mesh><vertexList><v vID="0"><x>1e39</x><y>0</y><z>0</z></v></vertexList>'
+            '<polygonList><P PID="0"><v>0</v><v>0</v><v>0</v></P></polygonList></mesh>'
+        )
+        for engine in engines:
+            with self.assertRaisesRegex(ValueError, r".*vertex coordinate out of range for mode float32.*"):
+                module.migrate_mesh(mesh, engine=engine)
+            vertices, _, _ = module.migrate_mesh(mesh, vertices_mode='float64', engine=engine)
+            self.assertEqual(vertices.get('mode'), 'float64')
+        # from the command line
+        outfile = os.path.join(XML, 'test7_auto.sff')
+        args = parse_args("{} -o {} --mesh-encoding auto".format(os.path.join(XML, 'test7.sff'), outfile))
+        self.assertEqual(args.mesh_encoding, dict(triangles_mode='auto'))
+        try:
+            self.assertEqual(do_migration(args), os.EX_OK)
+            modes = etree.parse(outfile).xpath('//triangles/@mode')
+            self.assertTrue(modes and set(modes) <= {'uint8', 'uint16'})
+        finally:
+            os.remove(outfile)
+        args = parse_args("file.sff --mesh-encoding vertices=float64,triangles=int16,endianness=big")
+        self.assertEqual(args.mesh_encoding, dict(vertices_mode='float64', triangles_mode='int16', endianness='big'))
+        self.assertEqual(parse_args("file.sff --mesh-encoding vertices=float16"), os.EX_USAGE)
+
+    def test_compact_meshes(self):
+        """Test that compaction welds duplicate vertices, drops unreferenced ones and keeps the geometry"""
+        module = get_module('0.7.0.dev0', '0.8.0.dev1')
+        # vertices 0 and 2 are identical (as are their normals) and vertex 4 is not referenced
+        coordinates = [(0, 0, 0), (1, 0, 0), (0, 0, 0), (0, 1, 0), (5, 5, 5)]
+        vertices = ''.join(
+            '<v vID="{}" designation="surface"><x>{}</x><y>{}</y><z>{}</z></v>'
+            '<v vID="{}" designation="normal"><x>0</x><y>0</y><z>1</z></v>'.format(2 * i, x, y, z, 2 * i + 1)
+            for i, (x, y, z) in enumerate(coordinates)
+        )
+        polygons = ''.join(
+            '<P PID="{}">{}</P>'.format(i, ''.join('<v>{}</v><v>{}</v>'.format(2 * j, 2 * j + 1) for j in triangle))
+            for i, triangle in enumerate([(0, 1, 3), (2, 3, 1)])
+        )
+        mesh = etree.fromstring('<mesh id="0"><vertexList>{}</vertexList><polygonList>{}</polygonList></mesh>'.format(
+            vertices, polygons))
+        engines = ['python'] if module.numpy is None else ['python', 'numpy']
+        elements = [module.migrate_mesh(mesh, compact=True, engine=engine) for engine in engines]
+        for _elements in elements[1:]:
+            self.assertEqual([etree.tostring(e) for e in _elements], [etree.tostring(e) for e in elements[0]])
+        _vertices, _normals, _triangles = elements[0]
+        self.assertEqual((_vertices.get('num_vertices'), _normals.get('num_normals')), ('3', '3'))
+        _coordinates = struct.unpack('<9f', base64.b64decode(_vertices.get('data')))
+        indices = struct.unpack('<6I', base64.b64decode(_triangles.get('data')))
+        self.assertEqual([_coordinates[3 * i:3 * i + 3] for i in indices],
+                         [tuple(map(float, coordinates[i])) for i in [0, 1, 3, 2, 3, 1]])
+        # from the command line
+        outfile = os.path.join(XML, 'test7_compact.sff')
+        args = parse_args("{} -o {} --compact-meshes -v".format(os.path.join(XML, 'test7.sff'), outfile))
+        try:
+            with profiling() as profiler, unittest.mock.patch(
+                    'sfftk_migrate.migrations.migrate_v0_7_0_dev0_to_v0_8_0_dev1._print') as _print:
+                self.assertEqual(do_migration(args), os.EX_OK)
+            meshes = [record for record in profiler.report()['stages'] if record['name'] == 'migrate_mesh'][0]
+            self.assertEqual(meshes['counters']['removed_vertices'], 0)
+            self.assertIn('compacting meshes removed', _print.call_args[0][0])
+        finally:
+            os.remove(outfile)
+
+    def test_migrate_meshes_parallel(self):
+        """Test that converting meshes in parallel gives the same result as converting them serially"""
+        module = get_module('0.7.0.dev0', '0.8.0.dev1')
+        original = etree.parse(os.path.join(XML, 'test7.sff'))
+        meshes = original.xpath('/segmentation/segmentList/segment/meshList/mesh') + [etree.Element("mesh")]
+        serial = module.migrate_meshes(meshes)
+        self.assertEqual(len(serial), len(meshes))
+        for executor in ['process', 'thread']:
+            parallel = module.migrate_meshes(meshes, workers=2, executor=executor)
+            self.assertEqual(
+                [etree.tostring(element) for elements in serial for element in elements],
+                [etree.tostring(element) for elements in parallel for element in elements],
+            )
+        # more meshes than can be pending at a time
+        self.assertEqual(module.encode_meshes(meshes * 5, workers=2), module.encode_meshes(meshes) * 5)
+        with self.assertRaisesRegex(ValueError, r".*invalid executor.*"):
+            module.migrate_meshes(meshes, workers=2, executor='other')
+        with self.assertRaisesRegex(ValueError, r".*invalid vertices mode.*"):
+            module.migrate_meshes(meshes, vertices_mode='float16', workers=2)
+        # the whole migration
+        stylesheet = get_stylesheet("0.7.0.dev0", "0.8.0.dev1")
+        args = parse_args("{} --mesh-workers 2".format(os.path.join(XML, 'test7.sff')))
+        self.assertEqual(args.mesh_workers, 2)
+        parallel = module.migrate_tree(original, stylesheet, args)
+        args.mesh_workers = None
+        serial = module.migrate_tree(original, stylesheet, args)
+        self.assertEqual(etree.tostring(serial), etree.tostring(parallel))
+
     def test_v0_7_0_dev0_to_v0_8_0_dev0(self):
         """Test migration from v0.7.0.dev0 to v0.8.0.dev1"""
         original = os.path.join(XML, 'test2.sff')
@@ -405,6 +796,12 @@ class TestEMDBSFFMigrations(unittest.TestCase):
         # let's see what it looks like
         migrated_decoded = etree.tostring(migrated, xml_declaration=True, encoding='UTF-8', pretty_print=True).decode(
             'utf-8')
+        # the single-parse pipeline in the module should produce the same document
+        outfile = os.path.join(XML, 'test2_single_parse.sff')
+        args = parse_args("{} --outfile {}".format(original, outfile))
+        module.migrate(original, outfile, stylesheet, args)
+        self.assertTrue(compare_elements(migrated.getroot(), etree.parse(outfile).getroot()))
+        os.remove(outfile)
         # sys.stderr.write('migrated:\n' + migrated_decoded)
         # with open(os.path.join(XML, 'test2_v0.8.0.dev1.sff'), 'w') as f:
         #     f.write(migrated_decoded)
@@ -526,6 +923,154 @@ class TestEMDBSFFMigrations(unittest.TestCase):
         with open(os.path.join(XML, 'test_shape_segmentation_v0.8.0.dev1.sff'), 'w') as f:
             f.write(migrated_decoded)
 
+    def test_streaming_engine(self):
+        """Test that the streaming engine produces the same output as the tree engine"""
+        for name in ['emd_1547.sff', 'file_v0.7.0.dev0.sff', 'test2.sff', 'test7.sff', 'test_shape_segmentation.sff']:
+            outputs = list()
+            for engine in ['tree', 'streaming']:
+                outfile = os.path.join(XML, 'tmp_{}_{}.sff'.format(engine, name))
+                args = parse_args("{} --outfile {} --engine {}".format(os.path.join(XML, name), outfile, engine))
+                with profiling() as profiler:
+                    status = do_migration(args)
+                self.assertEqual(status, os.EX_OK)
+                with open(outfile, 'rb') as f:
+                    outputs.append(f.read())
+                os.remove(outfile)
+            self.assertEqual(outputs[0], outputs[1])
+            stages = dict((record['name'], record) for record in profiler.report()['stages'])
+            self.assertIn('stream_by_stylesheet', stages)
+        # the meshes of segments are converted but lattices are left alone
+        infile = os.path.join(XML, 'emd_1547.sff')
+        outfile = os.path.join(XML, 'tmp_streaming.sff')
+        module = get_module("0.7.0.dev0", "0.8.0.dev1")
+        with unittest.mock.patch.object(module, '_insert_meshes', wraps=module._insert_meshes) as _insert_meshes:
+            self.assertEqual(do_migration(parse_args("{} --outfile {} --engine streaming".format(infile, outfile))),
+                             os.EX_OK)
+        os.remove(outfile)
+        self.assertEqual(_insert_meshes.call_count, len(etree.parse(infile).xpath('/segmentation/segmentList/segment')))
+        # invalid engines are rejected
+        args = parse_args("{} --outfile {}".format(os.path.join(XML, 'test7.sff'), os.path.join(XML, 'tmp.sff')))
+        args.engine = 'magic'
+        with self.assertRaisesRegex(ValueError, r".*invalid engine.*"):
+            do_migration(args)
+
+    def test_native_engine(self):
+        """Differential test of the native engine against the stylesheet on every v0.7.0.dev0 file"""
+        module = get_module("0.7.0.dev0", "0.8.0.dev1")
+        stylesheet = get_stylesheet("0.7.0.dev0", "0.8.0.dev1")
+        args = parse_args("file.sff --engine native")
+        self.assertEqual(args.engine, 'native')
+        synthetic = os.path.join(XML, 'tmp_synthetic.sff')
+        generate(synthetic, segments=3, vertices=10, shapes=4, transforms=2, lattice_size=1000)
+        infiles = [synthetic] + sorted(
+            os.path.join(XML, name) for name in os.listdir(XML) if name.endswith('.sff') and not name.startswith('tmp')
+        )
+        try:
+            migrated_files = 0
+            for infile in infiles:
+                if get_source_version(infile) != "0.7.0.dev0":
+                    continue
+                original = etree.parse(infile)
+                expected = etree.tostring(module.migrate_tree(original, stylesheet, args), pretty_print=True)
+                actual = etree.tostring(module.migrate_native(original, args), pretty_print=True)
+                self.assertEqual(expected, actual, infile)
+                migrated_files += 1
+        finally:
+            os.remove(synthetic)
+        self.assertGreater(migrated_files, 1)
+
+
+class TestTiming(unittest.TestCase):
+    def test_stage_without_profiling(self):
+        """Stages are no-ops unless profiling"""
+        with stage('nothing') as _stage:
+            _stage.count(elements=1)
+        with profiling() as profiler:
+            pass
+        self.assertEqual(profiler.report()['stages'], [])
+
+    def test_profile_migration(self):
+        """Test profiling a migration"""
+        outfile = os.path.join(XML, 'test7_profiled.sff')
+        args = parse_args("{} --outfile {} --profile".format(os.path.join(XML, 'test7.sff'), outfile))
+        self.assertTrue(args.profile)
+        self.assertEqual(args.profile_format, 'text')
+        reports = list()
+        with profiling(listener=reports.append) as profiler:
+            do_migration(args)
+        os.remove(outfile)
+        report = profiler.report()
+        self.assertEqual(reports[0]['stages'], report['stages'])
+        stages = dict((record['path'], record) for record in report['stages'])
+        hop = 'do_migration/hop v0.7.0.dev0->v0.8.0.dev1'
+        for path in [
+            'do_migration', 'do_migration/get_source_version', hop, hop + '/parse', hop + '/migrate',
+            hop + '/migrate/transform_by_stylesheet/xslt', hop + '/migrate/migrate_mesh', 'do_migration/write',
+        ]:
+            self.assertIn(path, stages)
+            self.assertGreaterEqual(stages[path]['seconds'], 0)
+        self.assertEqual(stages[hop + '/parse']['counters']['bytes_read'],
+                         os.path.getsize(os.path.join(XML, 'test7.sff')))
+        self.assertEqual(stages[hop + '/migrate/migrate_mesh']['counters']['meshes'], 3)
+        self.assertGreater(stages[hop + '/migrate/migrate_mesh']['counters']['vertices'], 0)
+        self.assertGreater(stages['do_migration/write']['counters']['bytes_written'], 0)
+        # reports may be aggregated and rendered
+        aggregated = aggregate([report, report])
+        self.assertEqual(aggregated['stages'][0]['calls'], 2)
+        self.assertIn('migrate_mesh', format_report(aggregated))
+        self.assertEqual(json.loads(format_report(report, format='json'))['stages'][0]['name'], 'do_migration')
+        with self.assertRaises(ValueError):
+            format_report(report, format='xml')
+
+    def test_profile_templates(self):
+        """Test profiling the templates of a stylesheet"""
+        original = etree.parse(os.path.join(XML, 'test7.sff'))
+        stylesheet = get_stylesheet("0.7.0.dev0", "0.8.0.dev1")
+        with self.assertRaises(ValueError):
+            get_template_profile(transform_by_stylesheet(original, stylesheet))
+        templates = get_template_profile(transform_by_stylesheet(original, stylesheet, profile_templates=True))
+        matches = [template['match'] for template in templates]
+        self.assertIn('/segmentation/segmentList', matches)
+        self.assertEqual(templates, sorted(templates, key=lambda template: template['seconds'], reverse=True))
+        self.assertTrue(all(template['calls'] >= 1 for template in templates))
+        # the profiler collects template profiles when asked to
+        outfile = os.path.join(XML, 'test7_profiled.sff')
+        args = parse_args("{} --outfile {} --profile-templates".format(os.path.join(XML, 'test7.sff'), outfile))
+        with profiling(templates=args.profile_templates) as profiler:
+            do_migration(args)
+        os.remove(outfile)
+        report = profiler.report()
+        self.assertEqual(report['templates'][0]['stylesheet'], stylesheet)
+        self.assertIn('/segmentation/segmentList', format_report(report))
+        with profiling() as profiler:
+            transform_by_stylesheet(original, stylesheet)
+        self.assertNotIn('templates', profiler.report())
+
+
+class TestSynthetic(unittest.TestCase):
+    def test_generate(self):
+        """Test that synthetic documents can be migrated"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for kwargs in [dict(), dict(normals=False, shapes=3, transforms=2, lattice_size=1000), dict(vertices=0)]:
+                infile = os.path.join(tmpdir, 'synthetic.sff')
+                outfile = os.path.join(tmpdir, 'synthetic_out.sff')
+                params = generate(infile, segments=3, **kwargs)
+                self.assertEqual(get_source_version(infile), '0.7.0.dev0')
+                original = etree.parse(infile)
+                self.assertEqual(len(original.xpath('/segmentation/segmentList/segment')), 3)
+                self.assertEqual(len(original.xpath('//meshList/mesh/vertexList/v[not(@designation="normal")]')),
+                                 params['num_vertices'])
+                args = parse_args("{} --outfile {}".format(infile, outfile))
+                self.assertEqual(do_migration(args), os.EX_OK)
+                migrated = etree.parse(outfile)
+                self.assertEqual(sum(int(n) for n in migrated.xpath('//mesh/triangles/@num_triangles')),
+                                 params['num_triangles'])
+            with self.assertRaises(ValueError):
+                generate(infile, vertices=2)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 class TestMain(unittest.TestCase):
     def test_parse_args(self):
@@ -547,3 +1092,756 @@ class TestMain(unittest.TestCase):
         args = parse_args(cmd, use_shlex=False)
         self.assertEqual(args.infile, "file.xml")
         self.assertEqual(args.outfile, "nothing.xml")
+
+    def test_lazy_imports(self):
+        """Test that informational commands do not import the migration machinery"""
+        script = "import sys; sys.argv = ['sff-migrate', '-V']; import sfftk_migrate.main as m; m.main(); " \
+                 "print(' '.join(sorted(sys.modules)))"
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], stderr=subprocess.DEVNULL, universal_newlines=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        modules = output.split()
+        for module in ['lxml', 'lxml.etree', 'multiprocessing', 'numpy', 'sfftk_migrate.migrate',
+                       'sfftk_migrate.batch']:
+            self.assertNotIn(module, modules)
+
+
+class TestBatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.tmpdir, 'in', 'sub'))
+        for fn, dest in [('test2.sff', 'in'), ('emd_1547.sff', 'in'), ('test_shape_segmentation.sff', 'in/sub')]:
+            shutil.copy(os.path.join(XML, fn), os.path.join(cls.tmpdir, dest))
+        with open(os.path.join(cls.tmpdir, 'in', 'broken.sff'), 'w') as f:
+            f.write('<segmentation>')
+        with open(os.path.join(cls.tmpdir, 'in', 'notes.txt'), 'w') as f:
+            f.write('not a segmentation')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_collect_files(self):
+        """Test collecting files from directories, globs and manifests"""
+        indir = os.path.join(self.tmpdir, 'in')
+        infiles = collect_files([indir])
+        self.assertEqual(
+            [os.path.relpath(infile, indir) for infile in infiles],
+            ['broken.sff', 'emd_1547.sff', 'test2.sff', os.path.join('sub', 'test_shape_segmentation.sff')],
+        )
+        self.assertEqual(len(collect_files([os.path.join(indir, '*.sff')])), 3)
+        manifest = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(manifest, 'w') as f:
+            f.write('# inputs\n{}\n\n{}\n'.format(infiles[1], infiles[1]))
+        self.assertEqual(collect_files([], manifest=manifest), [infiles[1]])
+
+    def test_migrate_batch(self):
+        """Test migrating a directory in worker processes and in-process"""
+        indir = os.path.join(self.tmpdir, 'in')
+        infiles = collect_files([indir])
+        for workers in [0, 2]:
+            outdir = os.path.join(self.tmpdir, 'out{}'.format(workers))
+            results = migrate_batch(infiles, '0.8.0.dev1', outdir=outdir, root=indir, workers=workers)
+            self.assertEqual([result['infile'] for result in results], infiles)
+            self.assertEqual([result['status'] for result in results], [os.EX_SOFTWARE, os.EX_OK, os.EX_OK, os.EX_OK])
+            self.assertIn('XMLSyntaxError', results[0]['error'])
+            self.assertTrue(os.path.exists(os.path.join(outdir, 'sub', 'test_shape_segmentation_v0.8.0.dev1.sff')))
+            self.assertEqual(get_source_version(results[2]['outfile']), '0.8.0.dev1')
+            self.assertEqual(summarise(results), os.EX_SOFTWARE)
+            self.assertEqual(summarise(results[1:]), os.EX_OK)
+        profiled = migrate_batch(infiles[1:2], '0.8.0.dev1', outdir=outdir, root=indir, workers=0, profile=True)
+        self.assertEqual(profiled[0]['profile']['stages'][0]['name'], 'do_migration')
+
+    def test_migrate_up_to_date(self):
+        """Test that files already at the target version are reported as skipped"""
+        infile = os.path.join(self.tmpdir, 'up_to_date.sff')
+        self.assertEqual(migrate_file((os.path.join(XML, 'test2.sff'), infile, '0.8.0.dev1', dict(), None,
+                                       False))['status'], os.EX_OK)
+        outfile = os.path.join(self.tmpdir, 'up_to_date_out.sff')
+        result = migrate_file((infile, outfile, '0.8.0.dev1', dict(), None, False))
+        self.assertEqual((result['status'], result['skipped'], result['outfile']), (os.EX_OK, True, None))
+        self.assertFalse(os.path.exists(outfile))
+        with unittest.mock.patch('sfftk_migrate.batch._print') as _print:
+            self.assertEqual(summarise([result]), os.EX_OK)
+        self.assertIn('1 skipped', _print.call_args[0][0])
+
+    def test_migrate_file_timeout(self):
+        """Test that a slow migration times out"""
+        with unittest.mock.patch('sfftk_migrate.batch.do_migration', lambda args, param_dict: time.sleep(5)):
+            result = migrate_file(('in.sff', 'out.sff', '0.8.0.dev1', dict(), 0.1, False))
+        self.assertEqual(result['status'], os.EX_TEMPFAIL)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "workers must inherit the mock")
+    def test_migrate_batch_stuck_worker(self):
+        """Test that a worker which cannot time itself out is terminated and replaced"""
+        def _migration(args, param_dict):
+            if args.infile == 'stuck.sff':
+                # e.g. a long libxml2 call, which the worker's alarm cannot interrupt
+                while True:
+                    try:
+                        time.sleep(10)
+                    except MigrationTimeout:
+                        pass
+            return os.EX_OK
+
+        start = time.monotonic()
+        with unittest.mock.patch('sfftk_migrate.batch.do_migration', _migration):
+            results = migrate_batch(['stuck.sff', 'in.sff'], '0.8.0.dev1', outdir=self.tmpdir, workers=1,
+                                    timeout=0.1)
+        self.assertEqual([result['status'] for result in results], [os.EX_TEMPFAIL, os.EX_OK])
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_parse_batch_args(self):
+        """Test batch arguments"""
+        args = parse_batch_args("dir1 dir2 -j 4 --timeout 10 -p segmentation_details=some=details -d out")
+        self.assertEqual(args.paths, ['dir1', 'dir2'])
+        self.assertEqual(args.workers, 4)
+        self.assertEqual(args.timeout, 10)
+        self.assertEqual(args.param_dict, {'segmentation_details': 'some=details'})
+        self.assertEqual(args.outdir, 'out')
+        self.assertEqual(parse_batch_args("dir -p nothing"), os.EX_USAGE)
+        self.assertEqual(parse_batch_args(""), os.EX_USAGE)
+
+
+class TestAIO(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.tmpdir = tempfile.mkdtemp()
+        self.infiles = list()
+        for i in range(3):
+            for fn in ['test2.sff', 'emd_1547.sff']:
+                infile = os.path.join(self.tmpdir, '{}_{}'.format(i, fn))
+                shutil.copy(os.path.join(XML, fn), infile)
+                self.infiles.append(infile)
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_migrate_file(self):
+        """Test migrating a single file from a coroutine"""
+        outfile = os.path.join(self.tmpdir, 'out.sff')
+        status = self.loop.run_until_complete(aio.migrate_file(self.infiles[0], outfile))
+        self.assertEqual(status, os.EX_OK)
+        self.assertEqual(get_source_version(outfile), VERSION_LIST[-1])
+
+    def test_migrate_many(self):
+        """Test migrating many files concurrently"""
+        results = self.loop.run_until_complete(aio.migrate_many(self.infiles + ['missing.sff'], limit=3))
+        self.assertEqual([result['infile'] for result in results], self.infiles + ['missing.sff'])
+        self.assertEqual([result['status'] for result in results], [os.EX_OK] * len(self.infiles) + [os.EX_IOERR])
+        for result in results[:-1]:
+            self.assertEqual(get_source_version(result['outfile']), VERSION_LIST[-1])
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(aio.migrate_many(self.infiles, limit=0))
+
+    def test_migrate_many_cancel(self):
+        """Test that cancelling stops migrations which have not started"""
+        started = list()
+
+        def _slow_migration(args, param_dict):
+            started.append(args.infile)
+            time.sleep(0.2)
+            return os.EX_OK
+
+        with unittest.mock.patch('sfftk_migrate.aio.do_migration', _slow_migration):
+            task = self.loop.create_task(aio.migrate_many(self.infiles, limit=1))
+            self.loop.call_later(0.1, task.cancel)
+            with self.assertRaises(asyncio.CancelledError):
+                self.loop.run_until_complete(task)
+            # let the running migration finish
+            time.sleep(0.3)
+        self.assertEqual(started, self.infiles[:1])
+
+
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'emd_1547.sff')
+        shutil.copy(os.path.join(XML, 'emd_1547.sff'), self.infile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _serve(self, **kwargs):
+        server = MigrationServer(**kwargs).start()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        return server, thread
+
+    def _request(self, server, method, path, body=None, headers=None):
+        if server.socket_path is not None:
+            class Connection(http.client.HTTPConnection):
+                def connect(self):
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.connect(server.socket_path)
+
+            connection = Connection('localhost')
+        else:
+            connection = http.client.HTTPConnection(*server.address)
+        try:
+            connection.request(method, path, body=body, headers=headers or dict())
+            response = connection.getresponse()
+            return response.status, response.getheader('Content-Type'), response.read()
+        finally:
+            connection.close()
+
+    def test_serve(self):
+        """Test migrating files and documents through the daemon"""
+        server, thread = self._serve(port=0, workers=2)
+        try:
+            status, _, body = self._request(server, 'GET', '/health')
+            self.assertEqual((status, json.loads(body.decode('utf-8'))['status']), (200, 'ok'))
+            outfile = os.path.join(self.tmpdir, 'out.sff')
+            status, _, body = self._request(server, 'POST', '/migrate', body=json.dumps(dict(
+                infile=self.infile, outfile=outfile)), headers={'Content-Type': 'application/json'})
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body.decode('utf-8'))['status'], os.EX_OK)
+            self.assertEqual(get_source_version(outfile), VERSION_LIST[-1])
+            with open(self.infile, 'rb') as f:
+                status, content_type, body = self._request(server, 'POST', '/migrate?target_version={}'.format(
+                    VERSION_LIST[-1]), body=f.read(), headers={'Content-Type': 'application/xml'})
+            self.assertEqual((status, content_type), (200, 'application/xml'))
+            with open(outfile, 'rb') as f:
+                self.assertEqual(body, f.read())
+            # documents which are already at the target version are returned as they are
+            with open(outfile, 'rb') as f:
+                migrated = f.read()
+            status, content_type, body = self._request(server, 'POST', '/migrate', body=migrated,
+                                                       headers={'Content-Type': 'application/xml'})
+            self.assertEqual((status, content_type, body), (200, 'application/xml', migrated))
+            status, _, body = self._request(server, 'POST', '/migrate', body=json.dumps(dict(infile=outfile)),
+                                            headers={'Content-Type': 'application/json'})
+            result = json.loads(body.decode('utf-8'))
+            self.assertEqual((status, result['status'], result['skipped'], result['outfile']),
+                             (200, os.EX_OK, True, outfile))
+            status, _, body = self._request(server, 'POST', '/migrate', body=json.dumps(dict(
+                infile=os.path.join(self.tmpdir, 'missing.sff'))), headers={'Content-Type': 'application/json'})
+            self.assertEqual(status, 500)
+            self.assertEqual(self._request(server, 'POST', '/migrate', body='[]',
+                                           headers={'Content-Type': 'application/json'})[0], 400)
+            metrics = json.loads(self._request(server, 'GET', '/metrics')[2].decode('utf-8'))
+            self.assertEqual((metrics['submitted'], metrics['completed'], metrics['failed']), (5, 4, 1))
+            self.assertEqual(self._request(server, 'POST', '/shutdown')[0], 202)
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(server.health()['status'], 'stopping')
+        # documents posted in the body leave nothing behind
+        self.assertIsNone(server.tmpdir)
+
+    def test_serve_backpressure(self):
+        """Test that jobs are refused when the queue is full and queued jobs complete on shutdown"""
+        socket_path = os.path.join(self.tmpdir, 'serve.sock')
+        release = threading.Event()
+
+        def _migrate_file(job):
+            release.wait()
+            return dict(infile=job[0], outfile=job[1], status=os.EX_OK, error=None)
+
+        with unittest.mock.patch('sfftk_migrate.serve.migrate_file', _migrate_file):
+            server, thread = self._serve(socket_path=socket_path, workers=1, queue_size=1)
+            try:
+                running = server.submit(self.infile)
+                # wait for the worker to take the first job
+                while server.health()['running'] == 0:
+                    time.sleep(0.01)
+                queued = server.submit(self.infile)
+                with self.assertRaises(ServerBusy):
+                    server.submit(self.infile)
+                status, _, body = self._request(server, 'POST', '/migrate', body=json.dumps(dict(
+                    infile=self.infile)), headers={'Content-Type': 'application/json'})
+                self.assertEqual(status, 503)
+                # documents are refused before they are read, let alone written to disk
+                with open(self.infile, 'rb') as f:
+                    status = self._request(server, 'POST', '/migrate', body=f.read(),
+                                           headers={'Content-Type': 'application/xml'})[0]
+                self.assertEqual(status, 503)
+                self.assertEqual(os.listdir(server.tmpdir), [])
+                self.assertEqual(server.metrics()['rejected'], 3)
+                server.shutdown()
+                with self.assertRaises(ServerBusy):
+                    server.submit(self.infile)
+            finally:
+                release.set()
+                server.shutdown()
+                thread.join()
+        self.assertEqual(running.wait()['status'], os.EX_OK)
+        self.assertEqual(queued.wait()['status'], os.EX_OK)
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_serve_max_handlers(self):
+        """Test that connections beyond the number of requests handled at once are refused without being read"""
+        server, thread = self._serve(port=0, workers=1, max_handlers=1)
+        try:
+            # a client which never sends its request holds the only handler
+            idle = socket.create_connection(server.address)
+            try:
+                time.sleep(0.1)
+                status, _, body = self._request(server, 'GET', '/health')
+                self.assertEqual((status, json.loads(body.decode('utf-8'))['error']), (503, 'too many connections'))
+            finally:
+                idle.close()
+            for _ in range(100):
+                status = self._request(server, 'GET', '/health')[0]
+                if status == 200:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(status, 200)
+            self.assertGreaterEqual(server.metrics()['rejected'], 1)
+        finally:
+            server.shutdown()
+            thread.join()
+        with self.assertRaises(ValueError):
+            MigrationServer(max_handlers=0)
+
+    def test_parse_serve_args(self):
+        """Test serve arguments"""
+        args = parse_serve_args("--socket /tmp/sff.sock -j 2 -q 8")
+        self.assertEqual((args.socket, args.workers, args.queue_size), ('/tmp/sff.sock', 2, 8))
+        self.assertEqual(parse_serve_args("-j 0"), os.EX_USAGE)
+        with self.assertRaises(ValueError):
+            MigrationServer(queue_size=0)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_migration(self):
+        """Test that repeat migrations are served from the cache"""
+        infile = os.path.join(self.tmpdir, 'emd_1547.sff')
+        shutil.copy(os.path.join(XML, 'emd_1547.sff'), infile)
+        outfiles = [os.path.join(self.tmpdir, 'out{}.sff'.format(i)) for i in range(3)]
+        args = parse_args("{} -o {} --cache {}".format(infile, outfiles[0], self.cache_dir))
+        with profiling() as profiler:
+            self.assertEqual(do_migration(args), os.EX_OK)
+        self.assertEqual(ResultCache(self.cache_dir).info()['entries'], 1)
+        self.assertIn('cache_store', [record['name'] for record in profiler.report()['stages']])
+        # a hit does not migrate
+        args = parse_args("{} -o {} --cache {} --cache-link".format(infile, outfiles[1], self.cache_dir))
+        with unittest.mock.patch('sfftk_migrate.migrate._migrate_hop', side_effect=AssertionError), profiling() as \
+                profiler:
+            self.assertEqual(do_migration(args), os.EX_OK)
+        lookup = [record for record in profiler.report()['stages'] if record['name'] == 'cache_lookup'][0]
+        self.assertEqual(lookup['counters'], {'hits': 1})
+        with open(outfiles[0], 'rb') as f, open(outfiles[1], 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        key = ResultCache(self.cache_dir).entries()[0]['key']
+        self.assertTrue(os.path.samefile(outfiles[1], os.path.join(self.cache_dir, key[:2], key)))
+        # a different input is a miss
+        with open(infile, 'ab') as f:
+            f.write(b'\n')
+        args = parse_args("{} -o {} --cache {}".format(infile, outfiles[2], self.cache_dir))
+        self.assertEqual(do_migration(args), os.EX_OK)
+        self.assertEqual(ResultCache(self.cache_dir).info()['entries'], 2)
+
+    def test_cached_params(self):
+        """Test that XSL params are part of the key"""
+        outfile = os.path.join(self.tmpdir, 'out.xml')
+        args = parse_args("{} -t 2 -o {} --cache {}".format(os.path.join(XML, 'original.xml'), outfile,
+                                                             self.cache_dir))
+        for details in ['first', 'second', 'first']:
+            self.assertEqual(do_migration(args, param_dict=dict(segmentation_details=details)), os.EX_OK)
+            self.assertEqual(etree.parse(outfile).xpath('/segmentation/details/text()')[0], details)
+        self.assertEqual(ResultCache(self.cache_dir).info()['entries'], 2)
+
+    def test_cached_includes(self):
+        """Test that the stylesheets a stylesheet includes are part of the key"""
+        stylesheets_dir = os.path.join(self.tmpdir, 'stylesheets')
+        shutil.copytree(STYLESHEETS_DIR, stylesheets_dir)
+        stylesheet = os.path.join(stylesheets_dir, 'migrate_v1_to_v2.xsl')
+        outfile = os.path.join(self.tmpdir, 'out.xml')
+        args = parse_args("{} -t 2 -o {} --cache {}".format(os.path.join(XML, 'original.xml'), outfile,
+                                                             self.cache_dir))
+        with unittest.mock.patch('sfftk_migrate.migrate.get_stylesheet', lambda source, target: stylesheet):
+            for _ in range(2):
+                self.assertEqual(do_migration(args, param_dict=dict(segmentation_details='details')), os.EX_OK)
+            self.assertEqual(ResultCache(self.cache_dir).info()['entries'], 1)
+            with open(os.path.join(stylesheets_dir, 'identity.xsl'), 'a') as f:
+                f.write('<!-- changed -->\n')
+            with profiling() as profiler:
+                self.assertEqual(do_migration(args, param_dict=dict(segmentation_details='details')), os.EX_OK)
+        lookup = [record for record in profiler.report()['stages'] if record['name'] == 'cache_lookup'][0]
+        self.assertEqual(lookup['counters'], {'hits': 0})
+        self.assertEqual(ResultCache(self.cache_dir).info()['entries'], 2)
+
+    def test_incremental(self):
+        """Test that converted meshes are reused when the rest of the file changes"""
+        infile = os.path.join(self.tmpdir, 'in.sff')
+        generate(infile, segments=3, vertices=10)
+        outfile = os.path.join(self.tmpdir, 'out.sff')
+        cmd = "{} -o {} --cache {} --incremental".format(infile, outfile, self.cache_dir)
+        self.assertEqual(do_migration(parse_args(cmd)), os.EX_OK)
+        self.assertEqual(PayloadCache(self.cache_dir).info()['entries'], 3)
+        # the payloads are not outputs but are reported (and pruned) with them
+        info = ResultCache(self.cache_dir).info()
+        self.assertEqual((info['entries'], info['payloads']), (1, 3))
+        self.assertEqual(len(ResultCache(self.cache_dir).entries()), 1)
+        # change something other than the meshes
+        original = etree.parse(infile)
+        original.find('name').text = 'renamed'
+        original.write(infile)
+        module = get_module('0.7.0.dev0', '0.8.0.dev1')
+        with unittest.mock.patch.object(module, 'encode_mesh', side_effect=AssertionError), profiling() as profiler:
+            self.assertEqual(do_migration(parse_args(cmd)), os.EX_OK)
+        meshes = [record for record in profiler.report()['stages'] if record['name'] == 'migrate_mesh'][0]
+        self.assertEqual(meshes['counters']['reused_meshes'], 3)
+        expected = os.path.join(self.tmpdir, 'expected.sff')
+        self.assertEqual(do_migration(parse_args("{} -o {}".format(infile, expected))), os.EX_OK)
+        with open(outfile, 'rb') as f, open(expected, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(parse_args("{} --incremental".format(infile)), os.EX_USAGE)
+        # a corrupt payload is a miss
+        payload_cache = PayloadCache(self.cache_dir)
+        key = payload_cache.entries()[0]['key']
+        with open(payload_cache._path(key), 'rb') as f:
+            _, data = f.read().split(b'\n', 1)
+        with open(payload_cache._path(key), 'wb') as f:
+            f.write(b'ten 0 6 uint32\n' + data)
+        self.assertIsNone(payload_cache.get_payload(key))
+
+    def test_eviction(self):
+        """Test that the least recently used entries are evicted first"""
+        cache = ResultCache(self.cache_dir, max_bytes=250)
+        fn = os.path.join(self.tmpdir, 'entry')
+        with open(fn, 'wb') as f:
+            f.write(b'x' * 100)
+        for i, key in enumerate(['aa01', 'bb02']):
+            cache.put(key, fn)
+            os.utime(os.path.join(self.cache_dir, key[:2], key), (1000 + i, 1000 + i))
+        # using an entry makes it the most recently used
+        self.assertTrue(cache.get('aa01', os.path.join(self.tmpdir, 'out')))
+        self.assertFalse(cache.get('cc03', os.path.join(self.tmpdir, 'out')))
+        cache.put('cc03', fn)
+        self.assertEqual(sorted(entry['key'] for entry in cache.entries()), ['aa01', 'cc03'])
+        self.assertEqual(cache.info()['bytes'], 200)
+        self.assertEqual(len(cache.prune(max_bytes=0)), 2)
+        self.assertEqual(cache.info()['entries'], 0)
+
+    def test_prune_by_age(self):
+        """Test that pruning by age alone keeps the entries used recently"""
+        cache = ResultCache(self.cache_dir)
+        fn = os.path.join(self.tmpdir, 'entry')
+        with open(fn, 'wb') as f:
+            f.write(b'x' * 100)
+        for key in ['aa01', 'bb02']:
+            cache.put(key, fn)
+        os.utime(os.path.join(self.cache_dir, 'aa', 'aa01'), (1000, 1000))
+        with unittest.mock.patch('sfftk_migrate.main._print'):
+            self.assertEqual(cache_main(['prune', '-c', self.cache_dir, '--max-age', '7']), os.EX_OK)
+        self.assertEqual([entry['key'] for entry in cache.entries()], ['bb02'])
+        self.assertEqual(cache.prune(), [])
+        self.assertEqual(cache.info()['entries'], 1)
+
+    def test_cached_batch(self):
+        """Test that worker processes share a cache"""
+        infiles = list()
+        for fn in ['emd_1547.sff', 'test2.sff']:
+            infiles.append(os.path.join(self.tmpdir, fn))
+            shutil.copy(os.path.join(XML, fn), infiles[-1])
+        for outdir in ['out1', 'out2']:
+            results = migrate_batch(infiles, VERSION_LIST[-1], outdir=os.path.join(self.tmpdir, outdir), workers=2,
+                                    cache_dir=self.cache_dir)
+            self.assertEqual([result['status'] for result in results], [os.EX_OK, os.EX_OK])
+        self.assertEqual(ResultCache(self.cache_dir).info()['entries'], 2)
+
+    def test_parse_cache_args(self):
+        """Test cache arguments and sizes"""
+        self.assertEqual(parse_size('10G'), 10 * 2 ** 30)
+        self.assertEqual(parse_size('1.5k'), 1536)
+        self.assertEqual(parse_size('100'), 100)
+        with self.assertRaises(ValueError):
+            parse_size('ten')
+        args = parse_cache_args("prune -c {} --max-size 1M --max-age 30".format(self.cache_dir))
+        self.assertEqual((args.action, args.max_size, args.max_age), ('prune', 2 ** 20, 30))
+        self.assertEqual(parse_cache_args("prune -c {}".format(self.cache_dir)), os.EX_USAGE)
+        self.assertEqual(parse_args("file.sff --cache {} --cache-size 2K".format(self.cache_dir)).cache_size, 2048)
+        self.assertEqual(parse_args("file.sff --cache-size lots"), os.EX_USAGE)
+
+
+class TestPassthrough(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_text_ranges(self):
+        """Test that only plain payloads at the path are located"""
+        document = b"""<?xml version="1.0"?>
+<segmentation><data>ignored</data><latticeList>
+<!-- <lattice><data>comment</data></lattice> -->
+<lattice id="0"><size/><data>QUJD
+REVG==</data></lattice>
+<lattice id="1"><data>&#65;BC</data></lattice>
+<lattice id="2"><data/></lattice>
+<lattice id="3"><data encoding="base64">R0hJ</data></lattice>
+</latticeList></segmentation>"""
+        ranges = find_text_ranges(document, '/segmentation/latticeList/lattice/data')
+        self.assertEqual([document[start:end] for start, end in ranges], [b'QUJD\nREVG==', b'R0hJ'])
+        with self.assertRaises(ValueError):
+            find_text_ranges(document, '/segmentation')
+        # empty lists have no payloads
+        path = '/segmentation/latticeList/lattice/data'
+        self.assertEqual(find_text_ranges(b'<segmentation><segmentList/><latticeList/></segmentation>', path), [])
+        self.assertEqual(find_text_ranges(b'<segmentation><latticeList />\n</segmentation>', path), [])
+        # lists in comments, CDATA sections and processing instructions are not the list
+        for markup in [b'<!-- <latticeList><lattice><data>Q09N</data></lattice></latticeList> -->',
+                       b'<![CDATA[<latticeList><lattice><data>Q0RB</data></lattice></latticeList>]]>',
+                       b'<?pi <latticeList><lattice><data>UElJ</data></lattice></latticeList>?>']:
+            document = b'<segmentation>' + markup + b'<latticeList><lattice><data>R0hJ</data></lattice></latticeList>' \
+                b'</segmentation>'
+            ranges = find_text_ranges(document, path)
+            self.assertEqual([document[start:end] for start, end in ranges], [b'R0hJ'], markup)
+        # malformed documents are reported rather than crashing the scan
+        for malformed in [b'<segmentation><latticeList><lattice><data>QUJD', b'<segmentation><latticeList><lattice',
+                          b'<segmentation><latticeList></lattice></latticeList></latticeList>']:
+            with self.assertRaises(PassthroughError):
+                find_text_ranges(malformed, path)
+        # a file with an empty lattice list migrates with pass-through on
+        with open(os.path.join(XML, 'test_shape_segmentation.sff'), 'rb') as f:
+            source = f.read()
+        end = source.index(b'</segmentation>')
+        infile = os.path.join(self.tmpdir, 'empty_lattices.sff')
+        with open(infile, 'wb') as f:
+            f.write(source[:end] + b'<latticeList/>' + source[end:])
+        outfile = os.path.join(self.tmpdir, 'out.sff')
+        self.assertEqual(do_migration(parse_args("{} -o {}".format(infile, outfile))), os.EX_OK)
+        self.assertTrue(os.path.exists(outfile))
+
+    def test_copy_range(self):
+        """Test that a copy which sendfile gives up on part of the way through is completed from where it stopped"""
+        src_name, out_name = os.path.join(self.tmpdir, 'src'), os.path.join(self.tmpdir, 'out')
+        with open(src_name, 'wb') as f:
+            f.write(bytes(range(256)) * 4)
+        calls = list()
+
+        def _sendfile(out_fd, in_fd, offset, count, sendfile=os.sendfile):
+            calls.append(offset)
+            if len(calls) > 1:
+                raise OSError("sendfile failed")
+            return sendfile(out_fd, in_fd, offset, min(count, 100))
+
+        with open(src_name, 'rb') as src, open(out_name, 'wb') as out, \
+                unittest.mock.patch('os.sendfile', _sendfile):
+            out.write(b'head')
+            _copy_range(src, out, 10, 900)
+            out.write(b'tail')
+        self.assertEqual(calls, [10, 110])
+        with open(src_name, 'rb') as f, open(out_name, 'rb') as g:
+            self.assertEqual(g.read(), b'head' + f.read()[10:900] + b'tail')
+
+    def test_passthrough_migration(self):
+        """Test that passing lattices through gives the same output as parsing them"""
+        infile = os.path.join(XML, 'emd_1547.sff')
+        outfiles = [os.path.join(self.tmpdir, 'out{}.sff'.format(i)) for i in range(3)]
+        with profiling() as profiler:
+            self.assertEqual(do_migration(parse_args("{} -o {}".format(infile, outfiles[0]))), os.EX_OK)
+        scan = [record for record in profiler.report()['stages'] if record['name'] == 'passthrough_scan'][0]
+        self.assertEqual(scan['counters']['payloads'], 1)
+        self.assertEqual(do_migration(parse_args("{} -o {} --engine native".format(infile, outfiles[1]))), os.EX_OK)
+        self.assertEqual(do_migration(parse_args("{} -o {} --no-passthrough".format(infile, outfiles[2]))),
+                         os.EX_OK)
+        with open(outfiles[2], 'rb') as f:
+            expected = f.read()
+        for outfile in outfiles[:2]:
+            with open(outfile, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_passthrough_fallback(self):
+        """Test that migrations which drop payloads are repeated without pass-through"""
+        infile = os.path.join(XML, 'emd_1547.sff')
+        passthrough = Passthrough.scan(infile, ['/segmentation/latticeList/lattice/data'])
+        tree = passthrough.parse()
+        for data in tree.xpath('/segmentation/latticeList/lattice/data'):
+            data.text = 'dropped'
+        with self.assertRaises(PassthroughError):
+            passthrough.write(tree, os.path.join(self.tmpdir, 'out.sff'))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        outfile = os.path.join(self.tmpdir, 'out.sff')
+        with unittest.mock.patch('sfftk_migrate.passthrough.Passthrough.write', side_effect=PassthroughError):
+            self.assertEqual(do_migration(parse_args("{} -o {}".format(infile, outfile))), os.EX_OK)
+        self.assertEqual(len(etree.parse(outfile).xpath('/segmentation/lattice_list/lattice/data')), 1)
+
+
+class TestParsing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parser_options(self):
+        """Test that options are set per thread and validated"""
+        self.assertTrue(get_options()['huge_tree'])
+        self.assertFalse(get_options()['resolve_entities'])
+        with parser_options(remove_blank_text=True, huge_tree=None):
+            self.assertTrue(get_options()['remove_blank_text'])
+            self.assertTrue(get_options()['huge_tree'])
+            options = list()
+            thread = threading.Thread(target=lambda: options.append(get_options()))
+            thread.start()
+            thread.join()
+            self.assertFalse(options[0]['remove_blank_text'])
+            tree = etree.fromstring(b'<a>\n  <b>text</b>\n</a>', get_parser())
+            self.assertIsNone(tree.text)
+        self.assertFalse(get_options()['remove_blank_text'])
+        previous = configure(use_mmap=True)
+        try:
+            self.assertTrue(get_options()['use_mmap'])
+        finally:
+            configure(**previous)
+        with self.assertRaises(ValueError):
+            configure(recover=True)
+
+    def test_huge_documents(self):
+        """Test that text nodes beyond libxml2's default limits are parsed"""
+        fn = os.path.join(self.tmpdir, 'huge.xml')
+        with open(fn, 'wb') as f:
+            f.write(b'<segmentation><data>' + b'A' * 11 * 10 ** 6 + b'</data></segmentation>')
+        self.assertEqual(len(parse_document(fn).getroot()[0].text), 11 * 10 ** 6)
+        with parser_options(use_mmap=True):
+            self.assertEqual(len(parse_document(fn).getroot()[0].text), 11 * 10 ** 6)
+        with parser_options(huge_tree=False):
+            with self.assertRaises(etree.XMLSyntaxError):
+                parse_document(fn)
+
+    def test_mmap(self):
+        """Test that parsing from a memory map makes no difference to the output"""
+        infile = os.path.join(XML, 'emd_1547.sff')
+        outfiles = [os.path.join(self.tmpdir, 'out{}.sff'.format(i)) for i in range(2)]
+        self.assertEqual(do_migration(parse_args("{} -o {} --no-passthrough".format(infile, outfiles[0]))),
+                         os.EX_OK)
+        self.assertEqual(do_migration(parse_args("{} -o {} --no-passthrough --mmap".format(infile, outfiles[1]))),
+                         os.EX_OK)
+        with open(outfiles[0], 'rb') as f, open(outfiles[1], 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_memory_guard(self):
+        """Test that documents which are not expected to fit in memory are not parsed"""
+        infile = os.path.join(XML, 'emd_1547.sff')
+        self.assertGreater(estimate_footprint(infile), os.path.getsize(infile))
+        outfile = os.path.join(self.tmpdir, 'out.sff')
+        args = parse_args("{} -o {} --memory-limit 10K".format(infile, outfile))
+        self.assertEqual(args.memory_limit, 10240)
+        with unittest.mock.patch('sfftk_migrate.migrate._print') as _print:
+            self.assertEqual(do_migration(args), os.EX_UNAVAILABLE)
+        self.assertIn('expected to need', _print.call_args[0][0])
+        self.assertFalse(os.path.exists(outfile))
+        with parser_options(memory_limit=10240):
+            with self.assertRaises(DocumentTooLarge):
+                parse_document(infile)
+        self.assertEqual(parse_args("{} --memory-limit lots".format(infile)), os.EX_USAGE)
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _compress(self, infile, compression):
+        """Copy `infile` into the temporary directory compressed with `compression`"""
+        fn = os.path.join(self.tmpdir, os.path.basename(infile) + EXTENSIONS[compression])
+        with open(infile, 'rb') as f, open_output(fn, compression) as g:
+            shutil.copyfileobj(f, g)
+        return fn
+
+    def test_get_output_name(self):
+        """Test that compression extensions are kept with the extension before them"""
+        self.assertEqual(get_output_name('dir/file.sff.gz', '0.8.0.dev1', prefix=''), 'dir/file_v0.8.0.dev1.sff.gz')
+        self.assertEqual(get_output_name('file.sff', '0.8.0.dev1', prefix='', compression='xz'),
+                         'file_v0.8.0.dev1.sff.xz')
+        self.assertEqual(get_output_name('file.sff.bz2', '0.8.0.dev1', prefix='', compression='none'),
+                         'file_v0.8.0.dev1.sff')
+        self.assertEqual(get_output_name('file.sff', '0.8.0.dev1'), 'tmp_file_v0.8.0.dev1.sff')
+
+    def test_compressed_migration(self):
+        """Test that compressed inputs and outputs migrate to the same document with every engine"""
+        infile = os.path.join(XML, 'emd_1547.sff')
+        for engine in ENGINES:
+            expected_outfile = os.path.join(self.tmpdir, 'expected.sff')
+            self.assertEqual(do_migration(parse_args("{} -o {} --engine {}".format(
+                infile, expected_outfile, engine))), os.EX_OK)
+            with open(expected_outfile, 'rb') as f:
+                expected = f.read()
+            for compression in sorted(EXTENSIONS):
+                _infile = self._compress(infile, compression)
+                self.assertEqual(get_source_version(_infile), '0.7.0.dev0')
+                args = parse_args("{} --engine {}".format(_infile, engine))
+                self.assertEqual(args.outfile, os.path.join(self.tmpdir, 'emd_1547_v0.8.0.dev1.sff' +
+                                                            EXTENSIONS[compression]))
+                self.assertEqual(do_migration(args), os.EX_OK)
+                self.assertEqual(get_compression(args.outfile), compression)
+                with open_input(args.outfile) as f:
+                    self.assertEqual(f.read(), expected, (engine, compression))
+                # compress the output of a plain input explicitly
+                outfile = os.path.join(self.tmpdir, 'out.sff')
+                self.assertEqual(do_migration(parse_args("{} -o {} --engine {} --compress {}".format(
+                    infile, outfile, engine, compression))), os.EX_OK)
+                self.assertEqual(get_compression(outfile), compression)
+                os.remove(outfile)
+            self.assertEqual(sorted(fn for fn in os.listdir(self.tmpdir) if fn.endswith('.tmp')), [])
+
+    def test_compressed_estimate(self):
+        """Test that the footprint of a compressed document is estimated from its decompressed size"""
+        infile = os.path.join(XML, 'test7.sff')
+        _infile = self._compress(infile, 'gzip')
+        self.assertLess(os.path.getsize(_infile), os.path.getsize(infile))
+        self.assertEqual(get_size(_infile), os.path.getsize(infile))
+        self.assertGreater(estimate_footprint(_infile), os.path.getsize(infile))
+        self.assertIsNone(Passthrough.scan(_infile, ['/segmentation/latticeList/lattice/data']))
+
+    def test_compressed_estimate_is_bounded(self):
+        """Test that the footprint of a large compressed document is estimated from a bounded prefix"""
+        infile = os.path.join(self.tmpdir, 'large.sff')
+        # segments are much smaller than the prefix so that it is representative of the document
+        generate(infile, segments=100, vertices=200)
+        self.assertGreater(os.path.getsize(infile), 4 * SAMPLES * SAMPLE_SIZE)
+        expected = estimate_footprint(infile)
+        for name in sorted(EXTENSIONS):
+            _infile = self._compress(infile, name)
+            read = list()
+
+            def _open(fn, mode='r', *args, **kwargs):
+                f = open(fn, mode, *args, **kwargs)
+                _read = f.read
+
+                def counted_read(*args):
+                    data = _read(*args)
+                    read.append(len(data))
+                    return data
+
+                f.read = counted_read
+                return f
+
+            with unittest.mock.patch('sfftk_migrate.compression.open', side_effect=_open, create=True):
+                footprint = estimate_footprint(_infile)
+            # a bz2 block decompresses to as many as 900kB
+            self.assertLess(sum(read), 2 * SAMPLES * SAMPLE_SIZE, name)
+            self.assertLess(sum(read), os.path.getsize(_infile) // 2, name)
+            # the start of a synthetic document is representative of the rest
+            self.assertAlmostEqual(footprint / expected, 1, delta=0.2, msg=name)
+
+    def test_collect_compressed_files(self):
+        """Test that batches pick up compressed files and keep their compression"""
+        infile = os.path.join(XML, 'test7.sff')
+        _infile = self._compress(infile, 'xz')
+        shutil.copy(infile, self.tmpdir)
+        self.assertEqual(collect_files([self.tmpdir]), [os.path.join(self.tmpdir, 'test7.sff'), _infile])
+        outdir = os.path.join(self.tmpdir, 'out')
+        results = migrate_batch([_infile], '0.8.0.dev1', outdir=outdir, workers=0)
+        self.assertEqual(results[0]['status'], os.EX_OK)
+        self.assertEqual(results[0]['outfile'], os.path.join(outdir, 'test7_v0.8.0.dev1.sff.xz'))
+        self.assertEqual(get_compression(results[0]['outfile']), 'xz')
+        results = migrate_batch([_infile], '0.8.0.dev1', outdir=outdir, workers=0, compress='none')
+        self.assertEqual(results[0]['outfile'], os.path.join(outdir, 'test7_v0.8.0.dev1.sff'))
+        self.assertIsNone(get_compression(results[0]['outfile']))
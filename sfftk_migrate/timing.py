@@ -0,0 +1,233 @@
+"""
+timing
+======
+
+The `timing` module provides lightweight per-stage instrumentation of migrations.
+
+Stages are marked in the code with the :py:func:`stage` context manager. Unless a :py:func:`profiling` context is
+active on the current thread, :py:func:`stage` returns a shared no-op object so the cost of instrumentation is a
+thread-local lookup per stage.
+
+.. code-block:: python
+
+    from sfftk_migrate.timing import profiling, format_report
+
+    with profiling() as profiler:
+        do_migration(args)
+    print(format_report(profiler.report()))
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_state = threading.local()
+
+
+class _NullStage(object):
+    """Returned by :py:func:`stage` when profiling is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def count(self, **counters):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.counters = OrderedDict()
+        self.record = None
+
+    def __enter__(self):
+        self.record = self.profiler._start(self.name, self.counters)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.record['seconds'] = time.perf_counter() - self.start
+        self.profiler._stop()
+        return False
+
+    def count(self, **counters):
+        """Add to the counters of this stage e.g. `count(vertices=10)`"""
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class Profiler(object):
+    """Collects timings and counters for nested stages
+
+    :param bool templates: also profile the templates of every XSL transform (see
+        :py:func:`sfftk_migrate.migrate.get_template_profile`)
+    """
+
+    def __init__(self, templates=False):
+        self.profile_templates = templates
+        self.templates = list()
+        self.records = list()
+        self._stack = list()
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def _start(self, name, counters):
+        path = '/'.join([record['name'] for record in self._stack] + [name])
+        record = OrderedDict([
+            ('name', name), ('path', path), ('depth', len(self._stack)), ('seconds', None), ('counters', counters),
+        ])
+        self.records.append(record)
+        self._stack.append(record)
+        return record
+
+    def _stop(self):
+        self._stack.pop()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add_templates(self, stylesheet, templates):
+        """Record the template profile of a transform by `stylesheet`"""
+        self.templates.append(OrderedDict([('stylesheet', stylesheet), ('templates', templates)]))
+
+    def report(self):
+        """The profile as a JSON-serialisable dictionary
+
+        :return: a dictionary with the `total_seconds` and a list of `stages` in the order they started
+        :rtype: dict
+        """
+        total = self.seconds if self.seconds is not None else time.perf_counter() - self.start
+        report = OrderedDict([
+            ('total_seconds', total),
+            ('stages', [dict(record, counters=dict(record['counters'])) for record in self.records]),
+        ])
+        if self.profile_templates:
+            report['templates'] = list(self.templates)
+        return report
+
+
+def stage(name):
+    """Mark a stage to be timed
+
+    :param str name: the name of the stage
+    :return: a context manager whose `count(**counters)` method adds to the stage's counters
+    """
+    profiler = getattr(_state, 'profiler', None)
+    if profiler is None:
+        return _NULL_STAGE
+    return profiler.stage(name)
+
+
+def is_profiling():
+    """Whether profiling is active on this thread; use this to guard the computation of expensive counters"""
+    return getattr(_state, 'profiler', None) is not None
+
+
+def get_profiler():
+    """The active profiler on this thread or `None`"""
+    return getattr(_state, 'profiler', None)
+
+
+@contextmanager
+def profiling(listener=None, templates=False):
+    """Profile all stages run on this thread within the context
+
+    :param listener: a callable which is passed the report (see :py:meth:`Profiler.report`) when the context exits
+    :param bool templates: also profile the templates of every XSL transform
+    :return: the profiler
+    :rtype: :py:class:`Profiler`
+    """
+    previous = getattr(_state, 'profiler', None)
+    profiler = Profiler(templates=templates)
+    _state.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        profiler.seconds = time.perf_counter() - profiler.start
+        _state.profiler = previous
+        if listener is not None:
+            listener(profiler.report())
+
+
+def aggregate(reports):
+    """Sum the times and counters of many reports by stage path
+
+    :param list reports: reports from :py:meth:`Profiler.report`
+    :return: a report with one entry per distinct stage path, with a `calls` count
+    :rtype: dict
+    """
+    stages = OrderedDict()
+    total = 0.0
+    for report in reports:
+        total += report['total_seconds']
+        for record in report['stages']:
+            aggregated = stages.setdefault(record['path'], OrderedDict([
+                ('name', record['name']), ('path', record['path']), ('depth', record['depth']), ('seconds', 0.0),
+                ('calls', 0), ('counters', dict()),
+            ]))
+            aggregated['seconds'] += record['seconds'] or 0.0
+            aggregated['calls'] += 1
+            for key, value in record['counters'].items():
+                aggregated['counters'][key] = aggregated['counters'].get(key, 0) + value
+    return OrderedDict([('total_seconds', total), ('stages', list(stages.values()))])
+
+
+def format_report(report, format='text'):
+    """Render a report
+
+    :param dict report: a report from :py:meth:`Profiler.report` or :py:func:`aggregate`
+    :param str format: either 'text' or 'json' [default: 'text']
+    :return: the rendered report
+    :rtype: str
+    """
+    if format == 'json':
+        return json.dumps(report, indent=2)
+    if format != 'text':
+        raise ValueError("invalid report format: {}".format(format))
+    total = report['total_seconds'] or 0.0
+    lines = ["{:<48} {:>10} {:>7}".format('stage', 'seconds', '%')]
+    for record in report['stages']:
+        seconds = record['seconds'] or 0.0
+        line = "{:<48} {:>10.4f} {:>7.1f}".format(
+            '  ' * record['depth'] + record['name'], seconds, 100.0 * seconds / total if total else 0.0,
+        )
+        if record.get('calls', 1) != 1:
+            line += "  calls={}".format(record['calls'])
+        if record['counters']:
+            line += "  " + " ".join("{}={}".format(key, value) for key, value in record['counters'].items())
+        lines.append(line)
+    lines.append("{:<48} {:>10.4f}".format('total', total))
+    for entry in report.get('templates', list()):
+        lines.append("")
+        lines.append(format_template_profile(entry['templates'], stylesheet=entry['stylesheet']))
+    return "\n".join(lines)
+
+
+def format_template_profile(templates, stylesheet=None):
+    """Render a template profile (see :py:func:`sfftk_migrate.migrate.get_template_profile`) as text
+
+    :param list templates: the template profile
+    :param str stylesheet: the name of the stylesheet, used as a heading
+    :return: the rendered profile
+    :rtype: str
+    """
+    lines = list()
+    if stylesheet is not None:
+        lines.append("templates in {}:".format(stylesheet))
+    lines.append("{:<56} {:>8} {:>10} {:>10}".format('template', 'calls', 'seconds', 'average'))
+    for template in templates:
+        description = template['match'] or template['name']
+        if template['mode']:
+            description += " (mode={})".format(template['mode'])
+        lines.append("{:<56} {:>8} {:>10.5f} {:>10.5f}".format(
+            description, template['calls'], template['seconds'], template['average_seconds'],
+        ))
+    return "\n".join(lines)